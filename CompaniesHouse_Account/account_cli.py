@@ -0,0 +1,125 @@
+'''
+
+Companies House Account Command Line
+
+Shared command line of the account scripts (xml_parser.py, account_processing_Ver_1.py). Inputs are resolved when the
+script is run rather than when it is imported, so that worker processes, which import the script again under the
+spawn and forkserver start methods, do not repeat the directory globbing. Inputs are given either as paths (files,
+directories, glob patterns or monthly ZIP archives) or as months, looked up as the Accounts_Monthly_Data-<Month><Year>
+folder or ZIP archive under a data root. Every month is written as its own source month.
+
+'''
+
+import os
+import glob
+import argparse
+import datetime
+
+
+def build_parser(description, engines=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('inputs', nargs='*',
+                        help='account files, directories, glob patterns or Accounts_Monthly_Data ZIP archives')
+    parser.add_argument('--months', nargs='+', metavar='YYYY-MM',
+                        help='months to process, read from Accounts_Monthly_Data-<Month><Year> under --data-root')
+    parser.add_argument('--data-root', default='.', help='directory holding the monthly folders or ZIP archives')
+    parser.add_argument('--source-month', metavar='YYYY-MM', help='month the inputs were published, for the output partitions')
+    parser.add_argument('--workers', type=int, help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--chunksize', type=int, help='number of files sent to a worker at a time')
+    parser.add_argument('--output-dir', help='root directory of the yearly account dataset')
+    parser.add_argument('--fact-dir', help='root directory of the fact dataset')
+    parser.add_argument('--mode', choices=['facts', 'years'], help="'facts' keeps every parsed fact as well as the yearly tables")
+    parser.add_argument('--format', choices=['parquet', 'csv'], help='output format of the yearly tables')
+    parser.add_argument('--no-resume', action='store_true', help='parse every file again instead of skipping those in the manifest')
+    parser.add_argument('--retry-failed', action='store_true', help='parse the files the manifest records as failed again')
+    parser.add_argument('--no-streaming', action='store_true', help='hold a whole checkpoint (or without resume the whole run) before writing it out')
+    parser.add_argument('--no-cache', action='store_true', help='do not read or write the parse cache')
+    parser.add_argument('--no-metrics', action='store_true', help='do not time the files or print the run report')
+    parser.add_argument('--start-method', choices=['fork', 'spawn', 'forkserver'], help='how worker processes are started')
+    parser.add_argument('--measure-startup', action='store_true', help='only time how long the worker pool takes to start')
+    if engines:
+        parser.add_argument('--engine', choices=engines, help='xml parser used on the files')
+    return parser
+
+
+def script_settings(args):
+    '''
+    Module settings of the account scripts given on the command line,
+    settings left out keep the value set in the script.
+    '''
+    settings = {'num_workers': args.workers, 'chunksize': args.chunksize, 'output_dir': args.output_dir,
+                'fact_dir': args.fact_dir, 'output_mode': args.mode, 'output_format': args.format,
+                'start_method': args.start_method, 'parse_engine': getattr(args, 'engine', None)}
+    settings = {name: value for name, value in settings.items() if value is not None}
+    if args.no_resume:
+        settings['resume'] = False
+    if args.retry_failed:
+        settings['retry_failed'] = True
+    if args.no_streaming:
+        settings['streaming'] = False
+    if args.no_cache:
+        settings['cache_dir'] = None
+    if args.no_metrics:
+        settings['report_metrics'] = False
+    return settings
+
+
+def month_name(month):
+    '''
+    Name of the Companies House bulk download of a month, e.g. '2022-01'
+    -> 'Accounts_Monthly_Data-January2022'.
+    '''
+    return 'Accounts_Monthly_Data-' + datetime.datetime.strptime(month, '%Y-%m').strftime('%B%Y')
+
+
+def expand_inputs(paths, suffixes):
+    '''
+    Resolve paths into (account files, ZIP archives). Directories are
+    searched for files with the given suffixes, anything else that does
+    not exist is taken as a glob pattern.
+    '''
+    files = []
+    zip_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            matches = sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(suffixes))
+        elif os.path.exists(path):
+            matches = [path]
+        else:
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise FileNotFoundError('No account files match {}'.format(path))
+
+        for match in matches:
+            if match.lower().endswith('.zip'):
+                zip_files.append(match)
+            elif os.path.isdir(match):
+                files.extend(expand_inputs([match], suffixes)[0])
+            else:
+                files.append(match)
+
+    # the same file given twice is parsed once
+    return list(dict.fromkeys(files)), list(dict.fromkeys(zip_files))
+
+
+def month_inputs(month, data_root, suffixes):
+    name = os.path.join(data_root, month_name(month))
+    paths = [path for path in (name, name + '.zip') if os.path.exists(path)]
+    if not paths:
+        raise FileNotFoundError('Neither {0} nor {0}.zip exists'.format(name))
+    return expand_inputs(paths, suffixes)
+
+
+def month_runs(args, suffixes, default_month):
+    '''
+    Yield (source month, files, zip files) for every run asked for on the
+    command line: one per month of --months, or a single one for the
+    explicit inputs.
+    '''
+    if args.months:
+        for month in args.months:
+            files, zip_files = month_inputs(month, args.data_root, suffixes)
+            yield month, files, zip_files
+    if args.inputs:
+        files, zip_files = expand_inputs(args.inputs, suffixes)
+        yield args.source_month or default_month, files, zip_files
@@ -0,0 +1,208 @@
+'''
+
+Companies House Account Data Extraction
+
+Vectorised version of the per-year extraction in account_processing_Ver_1.extract_account_data. All the concepts it
+needs are selected and given a fiscal year in one pass over the elements, and each metric is then a single
+drop_duplicates/groupby over the whole frame rather than a boolean mask per concept and per year. The frame can hold
+the elements of many files at once, so a worker can extract a whole chunk of filings in one go. The same rows are
+extracted from the long fact table of account_facts with extract_fact_rows.
+
+The rules are the same as extract_account_data:
+- every metric takes the last value reported for the year
+- fixed assets fall back to the sum of propertyplantequipment and investmentsfixedassets
+- current assets prefer currentassets, then cashbankonhand, then debtors
+- equity only looks at the last two distinct equity facts
+- with four or more creditors facts, the first two (within 15 elements) are current and the next two non-current
+  liabilities, otherwise a year with exactly two creditors facts is split the same way
+- a year only gets a row when totalassetslesscurrentliabilities is set and non-zero
+
+'''
+
+import pandas as pd
+
+
+YEARS = ['2018', '2019', '2020', '2021']
+
+COLUMNS = ['CompanyNumber', 'CompanyName', 'fixedasset', 'currentasset', 'currentliability',
+           'totalassetslesscurrentliabilities', 'noncurrentliability', 'netliability', 'netassetslessnetliability',
+           'equity']
+
+NAME_CONCEPT = 'entitycurrentlegalorregisteredname'
+OTHER_FIXED_ASSETS = ['propertyplantequipment', 'investmentsfixedassets']
+CURRENT_ASSETS = ['debtors', 'cashbankonhand', 'currentassets']
+CONCEPTS = [NAME_CONCEPT, 'fixedassets', 'creditors', 'totalassetslesscurrentliabilities', 'netassetsliabilities',
+            'equity'] + OTHER_FIXED_ASSETS + CURRENT_ASSETS
+
+# within each group the concept listed last wins
+CONCEPT_RANK = {concept: rank for rank, concept in enumerate(OTHER_FIXED_ASSETS + CURRENT_ASSETS)}
+
+
+def elements_frame(docs):
+    '''
+    Flatten the elements of many parsed files into one DataFrame, keyed by
+    file and by the element's position within its file. The elements of a
+    targeted parse keep the position they had in the whole document ('pos'),
+    so that the 15 element window on creditors sees the same elements.
+
+    Keyword arguments:
+    docs -- list of (file, doc) pairs, doc as returned by process_account
+    '''
+    records = []
+    for file, doc in docs:
+        if not isinstance(doc, dict) or not isinstance(doc.get('elements'), list):
+            continue
+        company_number = doc['doc_companieshouseregisterednumber']
+        for pos, element in enumerate(doc['elements']):
+            record = dict(element)
+            record['file'] = file
+            record['company_number'] = company_number
+            record['pos'] = element.get('pos', pos)
+            records.append(record)
+
+    frame = pd.DataFrame(records)
+    for column in ['file', 'company_number', 'pos', 'name', 'value', 'unit', 'date']:
+        if column not in frame.columns:
+            frame[column] = pd.Series(dtype=object)
+    return frame
+
+
+def facts_frame(facts):
+    '''
+    Elements frame of a fact table (see account_facts), so that the rows
+    can be extracted from the facts as well as from the parsed docs. Each
+    source_file is a file, its facts keep their order in the table.
+    '''
+    files = facts['source_file'].astype(str)
+    frame = pd.DataFrame({'file': files, 'company_number': facts['company_number'].astype(str),
+                          'pos': files.groupby(files, sort=False).cumcount(),
+                          'name': facts['concept'].astype(str),
+                          'value': facts['value'].astype(object).where(facts['value'].notna(), facts['text']),
+                          'unit': facts['unit'].astype(object),
+                          'date': facts['period_end'].dt.strftime('%Y-%m-%d').astype(object).fillna('NA')})
+    return frame.reset_index(drop=True)
+
+
+def as_float(value):
+    try:
+        return True, float(value)
+    except:
+        return False, None
+
+
+def last_by_year(facts):
+    return facts.drop_duplicates(['file', 'year'], keep='last').set_index(['file', 'year'])['value'].to_dict()
+
+
+def liability_split(key, current, non_current, count, first, second, last):
+    '''
+    get_liability for one (file, year), on the precomputed lookups.
+    '''
+    if key in current and key in non_current:
+        ok_current, float_current = as_float(current[key])
+        ok_non_current, float_non_current = as_float(non_current[key])
+        if ok_current and ok_non_current:
+            return current[key], non_current[key], float_current + float_non_current
+
+    n = count.get(key, 0)
+    if n == 0:
+        return None, None, None
+    if n == 2:
+        ok_current, float_current = as_float(first[key])
+        ok_non_current, float_non_current = as_float(second[key])
+        if not (ok_current and ok_non_current):
+            return None, None, None
+        return first[key], second[key], float_current + float_non_current
+
+    return last[key], None, last[key]
+
+
+def extract_fiscal_rows(frame, years=YEARS):
+    '''
+    Extract the per-year account rows for every file in an elements frame.
+
+    Keyword arguments:
+    frame -- DataFrame from elements_frame, in file and element order
+    years -- fiscal years to return, anything else is treated as 'before'
+
+    Returns a dict of file -> list with one dict per year (empty when the
+    file has no totalassetslesscurrentliabilities for it), in the order of
+    years, like read_account_Data.
+    '''
+    years = [str(year) for year in years]
+    dedup_columns = [column for column in frame.columns if column not in ('file', 'company_number', 'pos')]
+
+    facts = frame[frame['name'].isin(CONCEPTS)].copy()
+    year = facts['date'].astype(str).str.split('-').str[0]
+    facts['year'] = year.where(year.isin(years), 'before')
+    by_concept = {concept: facts[facts['name'] == concept] for concept in CONCEPTS}
+
+    names = by_concept[NAME_CONCEPT].drop_duplicates('file').set_index('file')['value'].to_dict()
+    company_numbers = frame.drop_duplicates('file').set_index('file')['company_number'].to_dict()
+
+    talcl = last_by_year(by_concept['totalassetslesscurrentliabilities'])
+    net_assets = last_by_year(by_concept['netassetsliabilities'])
+
+    fixed_assets = last_by_year(by_concept['fixedassets'].drop_duplicates(dedup_columns + ['file']))
+    other_fixed = facts[facts['name'].isin(OTHER_FIXED_ASSETS)].drop_duplicates(dedup_columns + ['file'])
+    other_fixed = other_fixed.assign(rank=other_fixed['name'].map(CONCEPT_RANK)).sort_values(['file', 'rank', 'pos'], kind='stable')
+    other_fixed = other_fixed.groupby(['file', 'year'], sort=False)['value'].agg(list).to_dict()
+
+    current_assets = facts[facts['name'].isin(CURRENT_ASSETS)]
+    current_assets = current_assets.assign(rank=current_assets['name'].map(CONCEPT_RANK)).sort_values(['file', 'rank', 'pos'], kind='stable')
+    current_assets = last_by_year(current_assets)
+
+    equity = by_concept['equity'].drop_duplicates(dedup_columns + ['file'])
+    equity = last_by_year(equity.groupby('file', sort=False).tail(2))
+
+    creditors = by_concept['creditors']
+    grouped = creditors.groupby('file', sort=False)['pos']
+    size = grouped.transform('size')
+    split = size >= 4
+    keep = ~split | (creditors['pos'] <= grouped.transform('first') + 15)
+    creditors, split = creditors[keep], split[keep]
+    rank = creditors.groupby('file', sort=False).cumcount()
+    current = last_by_year(creditors[split & (rank < 2)])
+    non_current = last_by_year(creditors[split & (rank >= 2) & (rank < 4)])
+
+    rank_in_year = creditors.groupby(['file', 'year'], sort=False).cumcount()
+    count = creditors.groupby(['file', 'year'], sort=False).size().to_dict()
+    first = creditors[rank_in_year == 0].set_index(['file', 'year'])['value'].to_dict()
+    second = creditors[rank_in_year == 1].set_index(['file', 'year'])['value'].to_dict()
+    last = last_by_year(creditors)
+
+    rows = {}
+    for file in company_numbers:
+        rows[file] = []
+        for year in years:
+            key = (file, year)
+            if not talcl.get(key):
+                rows[file].append({})
+                continue
+
+            if key in fixed_assets:
+                fixed_asset = fixed_assets[key]
+            else:
+                fixed_asset = pd.Series(other_fixed[key], dtype=object).sum() if key in other_fixed else None
+            current_liability, non_current_liability, liability = liability_split(key, current, non_current, count,
+                                                                                  first, second, last)
+            rows[file].append(dict(zip(COLUMNS, [company_numbers[file], names.get(file, 'no_name'), fixed_asset,
+                                                 current_assets.get(key), current_liability, talcl[key],
+                                                 non_current_liability, liability, net_assets.get(key),
+                                                 equity.get(key)])))
+
+    return rows
+
+
+def extract_fact_rows(facts, years=YEARS):
+    '''
+    extract_fiscal_rows over a fact table, keyed by source_file.
+    '''
+    return extract_fiscal_rows(facts_frame(facts), years)
+
+
+def extract_account_rows(doc, file, years=YEARS):
+    '''
+    Vectorised drop-in for extract_account_data on a single parsed file.
+    '''
+    return extract_fiscal_rows(elements_frame([(file, doc)]), years).get(file, [{} for year in years])
@@ -0,0 +1,124 @@
+'''
+
+Companies House Account Fact Table
+
+Keep every fact parsed from an account file as one row of a long table (company_number, concept, period_end, value,
+text, unit, source_file) instead of picking a handful of concepts for a fixed set of years. Numeric facts go in 'value'
+(float64), everything else in 'text'. The per-year wide tables are a pivot over this table, for whatever fiscal years
+appear in the filings.
+
+'''
+
+import numpy as np
+import pandas as pd
+
+
+FACT_COLUMNS = ['company_number', 'concept', 'period_end', 'value', 'text', 'unit', 'source_file']
+CATEGORY_COLUMNS = ['company_number', 'concept', 'unit', 'source_file']
+
+
+def empty_facts():
+    return compact_facts(pd.DataFrame({column: [] for column in FACT_COLUMNS}))
+
+
+def compact_facts(facts):
+    '''
+    Give a fact table its compact dtypes: categories for the repeated
+    strings, float64 values and datetime period ends.
+    '''
+    facts = facts[FACT_COLUMNS].copy()
+    for column in CATEGORY_COLUMNS:
+        facts[column] = facts[column].astype('category')
+    facts['period_end'] = pd.to_datetime(facts['period_end'], errors='coerce')
+    facts['value'] = facts['value'].astype('float64')
+    facts['text'] = facts['text'].astype(object)
+    return facts
+
+
+def doc_facts(doc):
+    '''
+    Turn the doc dict returned by process_account into a fact table.
+    Returns an empty table when the file could not be opened or parsed.
+    '''
+    if not isinstance(doc, dict) or not doc.get('elements'):
+        return empty_facts()
+
+    elements = doc['elements']
+    numeric = [isinstance(element['value'], float) for element in elements]
+    facts = pd.DataFrame({
+        'company_number': doc['doc_companieshouseregisterednumber'],
+        'concept': [element['name'] for element in elements],
+        'period_end': [element['date'] for element in elements],
+        'value': [element['value'] if is_numeric else np.nan for element, is_numeric in zip(elements, numeric)],
+        'text': [None if is_numeric else str(element['value']) for element, is_numeric in zip(elements, numeric)],
+        'unit': [element['unit'] for element in elements],
+        'source_file': doc['doc_name'],
+    })
+
+    return compact_facts(facts)
+
+
+def concat_facts(frames):
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return empty_facts()
+    return compact_facts(pd.concat(frames, ignore_index=True))
+
+
+def fiscal_year(facts):
+    '''
+    Fiscal year of each fact from its period end, as a nullable integer.
+    '''
+    return facts['period_end'].dt.year.astype('Int64')
+
+
+def pivot_fiscal_years(facts, concepts, static=None, required=None, keep='last'):
+    '''
+    Pivot a fact table into one wide DataFrame per fiscal year, with one
+    row per filing and year.
+
+    Keyword arguments:
+    facts -- fact table, as returned by doc_facts/concat_facts
+    concepts -- dict of concept -> output column, taken per fiscal year
+    static -- dict of concept -> output column, taken once per filing
+              whatever its period (company name, dormant flag, ...)
+    required -- output column that has to be set and non-zero for a row
+                to be kept, as the year-by-year scripts do with TALCL
+    keep -- 'first' or 'last' fact when a concept repeats within a year
+
+    Returns a dict of fiscal year -> DataFrame
+    '''
+    static = static or {}
+    facts = facts[facts['concept'].isin(list(concepts) + list(static))]
+    reported = facts['value'].astype(object).where(facts['value'].notna(), facts['text'])
+    facts = facts.assign(reported=reported, fiscal_year=fiscal_year(facts))
+    facts['concept'] = facts['concept'].astype(str)
+    facts['source_file'] = facts['source_file'].astype(str)
+
+    yearly = facts[facts['concept'].isin(list(concepts)) & facts['fiscal_year'].notna()]
+    yearly = yearly.drop_duplicates(['source_file', 'fiscal_year', 'concept'], keep=keep)
+    wide = yearly.pivot(index=['source_file', 'fiscal_year'], columns='concept', values='reported')
+    wide = wide.rename(columns=concepts).reset_index()
+
+    filings = facts.drop_duplicates('source_file')[['source_file', 'company_number']]
+    wide = wide.merge(filings, on='source_file', how='left')
+    if static:
+        once = facts[facts['concept'].isin(list(static))].drop_duplicates(['source_file', 'concept'], keep='first')
+        once = once.pivot(index='source_file', columns='concept', values='reported').rename(columns=static)
+        wide = wide.merge(once, left_on='source_file', right_index=True, how='left')
+
+    wide = wide.rename(columns={'company_number': 'CompanyNumber'})
+    wide['CompanyNumber'] = wide['CompanyNumber'].astype(str)
+    for column in list(static.values()) + list(concepts.values()):
+        if column not in wide.columns:
+            wide[column] = None
+
+    if required is not None:
+        wide = wide[wide[required].notna() & (wide[required] != 0)]
+
+    output_columns = ['CompanyNumber'] + list(static.values()) + list(concepts.values())
+    frames = {}
+    for year, frame in wide.groupby('fiscal_year'):
+        frames[int(year)] = frame[output_columns].reset_index(drop=True)
+
+    return frames
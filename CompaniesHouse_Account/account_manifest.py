@@ -0,0 +1,211 @@
+'''
+
+Companies House Account Run Manifest
+
+Make account runs incremental and resumable. Every file that has been parsed is recorded in a manifest
+(output_dir/_manifest.jsonl) keyed by path, size and mtime, or by member name, size and CRC for files read out of a
+ZIP archive. Results are checkpointed to disk every few thousand files as their own Parquet part, and the manifest
+only records a file once its part has been written. A rerun after a crash, or with a new monthly folder added,
+skips everything already in the manifest and adds new parts next to the old ones. A file whose parse raises does not
+bring the run down: it is recorded in the manifest with its error and skipped by later runs unless they retry failures.
+
+'''
+
+import os
+import re
+import json
+import time
+import functools
+
+import account_pipeline
+import account_metrics
+
+
+# leading underscore so pyarrow's dataset discovery skips it
+MANIFEST_NAME = '_manifest.jsonl'
+PART_PATTERN = re.compile(r'^part-(ck\d+x\d+)-')
+
+
+def file_key(path):
+    stat = os.stat(path)
+    return '{}|{}|{}'.format(path, stat.st_size, stat.st_mtime_ns)
+
+
+def member_key(zip_path, info):
+    return '{}::{}|{}|{:08x}'.format(zip_path, info.filename, info.file_size, info.CRC)
+
+
+class Manifest:
+    '''
+    Append-only record of the files already parsed into output_dir, of
+    the checkpoint part each of them was written to, and of the files that
+    failed with their error.
+    '''
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.keys = set()
+        self.parts = set()
+        self.failed = {}
+        self.run_id = 'ck{}'.format(time.time_ns())
+        self.num_parts = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by a crash, its part is an orphan
+                        continue
+                    if 'error' in entry:
+                        self.failed[entry['key']] = entry['error']
+                        continue
+                    self.keys.add(entry['key'])
+                    self.parts.add(entry['part'])
+                    self.failed.pop(entry['key'], None)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def new_part(self):
+        self.num_parts += 1
+        return '{}x{:05d}'.format(self.run_id, self.num_parts)
+
+    def append(self, entries):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as manifest:
+            for entry in entries:
+                manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+    def record(self, keys, part):
+        self.append({'key': key, 'part': part} for key in keys)
+        self.keys.update(keys)
+        self.parts.add(part)
+        for key in keys:
+            self.failed.pop(key, None)
+
+    def record_failures(self, failures):
+        # failures is a list of (key, error text)
+        self.append({'key': key, 'error': error} for key, error in failures)
+        self.failed.update(failures)
+
+
+def remove_orphan_parts(output_dirs, manifest):
+    '''
+    Delete checkpoint parts that were written but never made it into the
+    manifest, so the files they hold are not counted twice on a rerun.
+    '''
+    removed = 0
+    for output_dir in output_dirs:
+        for root, dirs, names in os.walk(output_dir):
+            for name in names:
+                match = PART_PATTERN.match(name)
+                if match and match.group(1) not in manifest.parts:
+                    os.remove(os.path.join(root, name))
+                    removed += 1
+    return removed
+
+
+def error_text(error):
+    return '{}: {}'.format(type(error).__name__, error)[:500]
+
+
+def read_keyed(pair, read_fn):
+    # Worker: (key, result, None), or (key, None, error text) when read_fn raises
+    key, item = pair
+    try:
+        return key, read_fn(item), None
+    except Exception as e:
+        return key, None, error_text(e)
+
+
+def read_keyed_batch(pairs, read_fn):
+    '''
+    Batched read_keyed. When read_fn raises on the batch, its items are
+    read again one at a time to find the ones that fail.
+    '''
+    keys = [key for key, item in pairs]
+    try:
+        return list(zip(keys, read_fn([item for key, item in pairs]), [None] * len(keys)))
+    except Exception as e:
+        if len(pairs) == 1:
+            return [(keys[0], None, error_text(e))]
+    # the records of the failed attempt would count its files twice
+    account_metrics.drain()
+    return [entry for pair in pairs for entry in read_keyed_batch([pair], read_fn)]
+
+
+def run_incremental(keyed_items, read_fn, write_fn, output_dirs, checkpoint_every=5000, batched=False, retry_failed=False,
+                    flush_every=None, **pipeline_kwargs):
+    '''
+    Parse only the items not yet in the manifest and checkpoint the results.
+
+    Keyword arguments:
+    keyed_items -- iterable of (key, item), e.g. (file_key(f), f)
+    read_fn -- worker function, as for account_pipeline.run_pipeline
+    write_fn -- called as write_fn(results, part) in the parent to write a
+                checkpoint, with part to be used in the file names
+    output_dirs -- directories written by write_fn, the first one holds
+                   the manifest
+    checkpoint_every -- number of files per checkpoint
+    batched -- read_fn takes and returns lists, see run_pipeline
+    retry_failed -- parse the files recorded as failed by earlier runs
+                    again, instead of skipping them
+    flush_every -- write a checkpoint in pieces of this many files as they
+                   come in, part being '<checkpoint part>-<piece>', so the
+                   parent holds flush_every results rather than
+                   checkpoint_every. The checkpoint is only recorded in the
+                   manifest once all its pieces are written
+
+    Returns the number of files parsed in this run
+    '''
+    manifest = Manifest(output_dirs[0])
+    removed = remove_orphan_parts(output_dirs, manifest)
+    if removed:
+        print('Removed {} checkpoint files not in the manifest'.format(removed))
+
+    todo = [(key, item) for key, item in keyed_items if key not in manifest and (retry_failed or key not in manifest.failed)]
+    print('{} files already parsed, {} failed before{}, {} to go'.format(
+        len(manifest.keys), len(manifest.failed), ' and retried' if retry_failed else '', len(todo)))
+    if not todo:
+        return 0
+
+    wrapper = read_keyed_batch if batched else read_keyed
+    results = account_pipeline.run_pipeline(todo, functools.partial(wrapper, read_fn=read_fn), batched=batched,
+                                            **pipeline_kwargs)
+
+    keys = []
+    buffer = []
+    part = None
+    piece = 0
+    num_failed = 0
+    for key, result, error in results:
+        if error is not None:
+            # nothing of the file is written, so it can be recorded straight away
+            manifest.record_failures([(key, error)])
+            num_failed += 1
+            continue
+        keys.append(key)
+        buffer.append(result)
+        checkpoint = len(keys) >= checkpoint_every
+        if checkpoint or (flush_every and len(buffer) >= flush_every):
+            part = part or manifest.new_part()
+            write_fn(buffer, part if not flush_every else '{}-{}'.format(part, piece))
+            buffer, piece = [], piece + 1
+        if checkpoint:
+            manifest.record(keys, part)
+            keys, part, piece = [], None, 0
+
+    if keys:
+        part = part or manifest.new_part()
+        if buffer:
+            write_fn(buffer, part if not flush_every else '{}-{}'.format(part, piece))
+        manifest.record(keys, part)
+
+    if num_failed:
+        print('{} files failed, recorded in {} and skipped by later runs unless failures are retried'.format(
+            num_failed, manifest.path))
+    return len(todo)
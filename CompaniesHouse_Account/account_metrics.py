@@ -0,0 +1,249 @@
+'''
+
+Companies House Account Run Metrics
+
+Per-file instrumentation of the account parsers. While a worker processes a file it records how long each stage took
+(open, parse, scrape, extract), how many elements were scraped and how the file ended up (ok, too few elements, an
+exception in a given stage, ...). Recording is off unless the run asks for it, in which case the finished records of
+a worker ride back to the parent with its results and are folded into a RunMetrics: latency histograms per stage, the
+slowest files and a failure taxonomy, printed at the end of the run and saved as JSON.
+
+'''
+
+import json
+import time
+import heapq
+import bisect
+import functools
+import contextlib
+import collections
+
+
+STAGES = ('open', 'parse', 'scrape', 'extract')
+# upper edges of the latency histogram bins, in milliseconds
+BIN_EDGES_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, float('inf')]
+
+# worker side state, set by measured() in the workers of a run that records metrics
+enabled = False
+# record of the file this worker is processing
+_record = None
+# finished records not yet sent back to the parent
+_pending = []
+
+
+class FileRecord:
+
+    __slots__ = ('file', 'start', 'stages', 'stage', 'elements', 'outcome', 'error')
+
+    def __init__(self, file):
+        self.file = file
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.stage = None
+        self.elements = None
+        self.outcome = None
+        self.error = None
+
+    def finish(self):
+        # plain tuple, cheap to pickle back to the parent
+        return (self.file, time.perf_counter() - self.start, self.stages, self.elements, self.outcome or 'ok', self.error)
+
+
+def instrument_file(fn):
+    '''
+    Decorator for a function taking a file as first argument: the outermost
+    instrumented call for a file opens its record and closes it on return,
+    nested calls (process_account inside read_account_Data) add to it. An
+    exception is recorded against the stage it was raised in and re-raised.
+    '''
+    @functools.wraps(fn)
+    def wrapper(file, *args, **kwargs):
+        global _record
+        if not enabled or _record is not None:
+            return fn(file, *args, **kwargs)
+
+        _record = FileRecord(file)
+        try:
+            return fn(file, *args, **kwargs)
+        except Exception as e:
+            failure(_record.stage or fn.__name__, e)
+            raise
+        finally:
+            _pending.append(_record.finish())
+            _record = None
+    return wrapper
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Time the enclosed block as a stage of the current file. The stage is
+    left set if the block raises, so the failure is put down to it.
+    '''
+    record = _record
+    if record is None:
+        yield
+        return
+
+    previous = record.stage
+    record.stage = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.stages[name] = record.stages.get(name, 0.0) + time.perf_counter() - start
+    record.stage = previous
+
+
+def count_elements(elements):
+    if _record is not None and isinstance(elements, list):
+        _record.elements = len(elements)
+
+
+def outcome(category, error=None):
+    '''
+    Set how the current file ended up. The first outcome set sticks, so a
+    caller does not overwrite the reason given deeper down.
+    '''
+    if _record is not None and _record.outcome is None:
+        _record.outcome = category
+        _record.error = None if error is None else str(error)[:200]
+
+
+def failure(stage_name, error):
+    outcome('{}:{}'.format(stage_name, type(error).__name__), error)
+
+
+def share_stage(name, seconds, count):
+    '''
+    Split the time of a stage run once for a whole batch (e.g. the
+    vectorised extraction) evenly over the last count finished records.
+    '''
+    if not enabled or not count:
+        return
+    share = seconds / count
+    for i in range(max(0, len(_pending) - count), len(_pending)):
+        file, total, stages, elements, category, error = _pending[i]
+        stages[name] = stages.get(name, 0.0) + share
+        _pending[i] = (file, total + share, stages, elements, category, error)
+
+
+def drain():
+    global _pending
+    records, _pending = _pending, []
+    return records
+
+
+def measured(item, read_fn):
+    '''
+    Worker side wrapper set up by account_pipeline.run_pipeline: run read_fn
+    with recording on and return its result with the records of the files
+    it processed.
+    '''
+    global enabled
+    enabled = True
+    try:
+        result = read_fn(item)
+    except Exception as e:
+        # the records travel back with the exception, which the parent re-raises
+        e.metrics_records = drain()
+        raise
+    return result, drain()
+
+
+class RunMetrics:
+    '''
+    Parent side aggregate of the file records of a run.
+
+    Keyword arguments:
+    top -- number of slowest files kept
+    examples -- number of example files kept per failure category
+    '''
+
+    def __init__(self, top=20, examples=5):
+        self.top = top
+        self.examples = examples
+        self.files = 0
+        self.seconds = 0.0
+        self.stage_seconds = collections.defaultdict(float)
+        self.histograms = collections.defaultdict(lambda: [0] * len(BIN_EDGES_MS))
+        self.elements = 0
+        self.outcomes = collections.Counter()
+        self.failures = collections.defaultdict(list)
+        self.slowest = []
+
+    def add(self, records):
+        for file, seconds, stages, elements, category, error in records:
+            self.files += 1
+            self.seconds += seconds
+            self.histograms['total'][bisect.bisect_left(BIN_EDGES_MS, seconds * 1000)] += 1
+            for name, stage_seconds in stages.items():
+                self.stage_seconds[name] += stage_seconds
+                self.histograms[name][bisect.bisect_left(BIN_EDGES_MS, stage_seconds * 1000)] += 1
+            if elements:
+                self.elements += elements
+
+            self.outcomes[category] += 1
+            if category != 'ok' and len(self.failures[category]) < self.examples:
+                self.failures[category].append((file, error))
+
+            # the file count breaks ties so that stages are never compared
+            entry = (seconds, self.files, file, stages, category)
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def summary(self):
+        return {'files': self.files, 'seconds': self.seconds, 'elements': self.elements,
+                'stage_seconds': dict(self.stage_seconds),
+                'histograms_ms': {name: dict(zip([str(edge) for edge in BIN_EDGES_MS], counts))
+                                  for name, counts in self.histograms.items()},
+                'outcomes': dict(self.outcomes),
+                'failures': {category: [{'file': file, 'error': error} for file, error in examples]
+                             for category, examples in self.failures.items()},
+                'slowest': [{'file': file, 'seconds': seconds, 'stages': stages, 'outcome': category}
+                            for seconds, n, file, stages, category in sorted(self.slowest, reverse=True)]}
+
+    def report(self):
+        lines = ['Run report: {} files, {:.1f}s of worker time, {} elements scraped'.format(
+            self.files, self.seconds, self.elements)]
+        if not self.files:
+            return lines[0]
+
+        lines.append('')
+        lines.append('Time by stage:')
+        for name in list(STAGES) + sorted(set(self.stage_seconds) - set(STAGES)):
+            if name in self.stage_seconds:
+                lines.append('  {:<10} {:>9.1f}s {:>6.1%}  {:.2f} ms/file'.format(
+                    name, self.stage_seconds[name], self.stage_seconds[name] / self.seconds,
+                    self.stage_seconds[name] * 1000 / self.files))
+        other = self.seconds - sum(self.stage_seconds.values())
+        lines.append('  {:<10} {:>9.1f}s {:>6.1%}'.format('other', other, other / self.seconds))
+
+        lines.append('')
+        lines.append('Latency histograms (ms):')
+        names = ['total'] + [name for name in STAGES if name in self.histograms]
+        lines.append('  {:>8} '.format('<=') + ''.join('{:>10}'.format(name) for name in names))
+        for i, edge in enumerate(BIN_EDGES_MS):
+            counts = [self.histograms[name][i] for name in names]
+            if any(counts):
+                lines.append('  {:>8} '.format(edge) + ''.join('{:>10}'.format(count) for count in counts))
+
+        lines.append('')
+        lines.append('Outcomes:')
+        for category, count in self.outcomes.most_common():
+            lines.append('  {:<36} {:>9} {:>6.1%}'.format(category, count, count / self.files))
+            for file, error in self.failures.get(category, []):
+                lines.append('      {}{}'.format(file, ': ' + error if error else ''))
+
+        lines.append('')
+        lines.append('Slowest files:')
+        for seconds, n, file, stages, category in sorted(self.slowest, reverse=True):
+            lines.append('  {:>9.1f} ms  {}  {}  {}'.format(seconds * 1000, file, category, ' '.join(
+                '{}={:.1f}'.format(name, stage_seconds * 1000) for name, stage_seconds in stages.items())))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
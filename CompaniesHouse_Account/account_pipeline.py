@@ -0,0 +1,195 @@
+'''
+
+Companies House Account Pipeline Runner
+
+Run a per-file parse function over a large number of account files on a pool of warm workers. Parser state is loaded
+once per worker by an initializer, files are dispatched in chunks to cut the per-file IPC round trip, and results are
+streamed back unordered as they complete. Only a few chunks per worker are in flight at a time, so the files are taken
+from their iterator as the work goes and memory stays bounded however many there are. Throughput is printed as the run goes so chunk size and worker count can be
+tuned on a real month.
+
+'''
+
+import os
+import time
+import queue
+import functools
+import importlib
+import itertools
+import multiprocessing
+
+import account_metrics
+
+
+def chunked(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_items(items, read_fn):
+    # Worker: read_fn over every item of a chunk
+    return [read_fn(item) for item in items]
+
+
+def bounded_unordered(pool, fn, tasks, max_in_flight):
+    '''
+    Like pool.imap_unordered(fn, tasks, 1), but a task is only taken from
+    tasks once fewer than max_in_flight tasks are submitted and not yet
+    collected. imap_unordered feeds the whole iterable to the pool up front.
+    '''
+    finished = queue.Queue()
+    tasks = iter(tasks)
+    in_flight = 0
+    more = True
+    while True:
+        while more and in_flight < max_in_flight:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                more = False
+                break
+            pool.apply_async(fn, (task,), callback=lambda result: finished.put((True, result)),
+                             error_callback=lambda error: finished.put((False, error)))
+            in_flight += 1
+
+        if not in_flight:
+            return
+        ok, result = finished.get()
+        in_flight -= 1
+        if not ok:
+            raise result
+        yield result
+
+
+def pool_context(start_method=None, preload=()):
+    '''
+    Multiprocessing context for the pool. The modules in preload are
+    imported once before the workers are forked from the parent ('fork')
+    or from the fork server ('forkserver'), so workers start with them
+    loaded instead of importing them each as under 'spawn'.
+    '''
+    context = multiprocessing.get_context(start_method)
+    if context.get_start_method() == 'fork':
+        for module in preload:
+            importlib.import_module(module)
+    elif context.get_start_method() == 'forkserver' and preload:
+        context.set_forkserver_preload(list(preload))
+    return context
+
+
+def run_pipeline(items, read_fn, num_workers=None, chunksize=32, initializer=None, initargs=(), batched=False,
+                 report_every=10000, stats=None, metrics=None, start_method=None, preload=(), max_in_flight=None):
+    '''
+    Yield read_fn's results for every item, unordered.
+
+    Keyword arguments:
+    items -- iterable of files (or whatever read_fn takes)
+    read_fn -- picklable function run in the workers
+    num_workers -- size of the pool, defaults to cpu_count()
+    chunksize -- number of items sent to a worker at a time
+    initializer -- run once in each worker when it starts, e.g. to import
+                   or reload the parser module
+    batched -- read_fn takes a whole chunk (list of items) and returns a
+               list of results, e.g. to extract a chunk in one DataFrame
+    report_every -- print the throughput every this many items
+    stats -- optional dict filled with files, seconds and files_per_sec
+    metrics -- optional account_metrics.RunMetrics, turns on per-file stage
+               timing in the workers and collects their records
+    start_method -- 'fork', 'spawn' or 'forkserver', None for the default
+    preload -- modules to import in the fork server, see pool_context
+    max_in_flight -- chunks submitted to the pool and not yet collected,
+                     defaults to two per worker
+    '''
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    # every task is a chunk of items
+    if not batched:
+        read_fn = functools.partial(map_items, read_fn=read_fn)
+    if metrics is not None:
+        read_fn = functools.partial(account_metrics.measured, read_fn=read_fn)
+
+    start = time.perf_counter()
+    done = 0
+    context = pool_context(start_method, preload)
+    with context.Pool(num_workers, initializer=initializer, initargs=initargs) as pool:
+        results = bounded_unordered(pool, read_fn, chunked(items, chunksize), max_in_flight)
+
+        next_report = report_every
+        try:
+            for result in results:
+                if metrics is not None:
+                    result, records = result
+                    metrics.add(records)
+                for r in result:
+                    done += 1
+                    yield r
+
+                if done >= next_report:
+                    elapsed = time.perf_counter() - start
+                    print('{} files in {:.1f}s, {:.1f} files/sec'.format(done, elapsed, done / elapsed))
+                    next_report += report_every
+        except Exception as e:
+            # keep the record of the file that brought the run down
+            if metrics is not None:
+                metrics.add(getattr(e, 'metrics_records', []))
+            raise
+
+    elapsed = time.perf_counter() - start
+    print('Finished {} files in {:.1f}s, {:.1f} files/sec with {} workers and chunksize {}'.format(
+        done, elapsed, done / elapsed if elapsed else 0.0, num_workers, chunksize))
+    if stats is not None:
+        stats.update({'files': done, 'seconds': elapsed, 'files_per_sec': done / elapsed if elapsed else 0.0,
+                      'num_workers': num_workers, 'chunksize': chunksize})
+
+
+_ready = None
+
+
+def mark_ready(modules, initializer, initargs):
+    global _ready
+    for module in modules:
+        importlib.import_module(module)
+    if initializer is not None:
+        initializer(*initargs)
+    _ready = time.time()
+
+
+def ready_time(i):
+    # hold the worker a little so that every worker of the pool gets a task
+    time.sleep(0.05)
+    return os.getpid(), _ready
+
+
+def worker_startup(num_workers=None, modules=(), initializer=None, initargs=(), method=None, preload=()):
+    '''
+    Time how long a pool takes before its workers can take work: start
+    the process, import modules (e.g. the parser script, as spawn and
+    forkserver workers do) and run the initializer.
+
+    Keyword arguments:
+    num_workers -- size of the pool, defaults to cpu_count()
+    modules -- names of the modules a worker imports before it is ready
+    initializer -- as for run_pipeline
+    method -- start method, 'fork', 'spawn' or 'forkserver', None for
+              the platform default
+    preload -- modules to import in the fork server, see pool_context
+
+    Returns a dict with the seconds until the first and the last worker
+    was ready, and the mean over the workers
+    '''
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    context = pool_context(method, preload)
+
+    start = time.time()
+    with context.Pool(num_workers, initializer=mark_ready, initargs=(list(modules), initializer, initargs)) as pool:
+        ready = dict(pool.map(ready_time, range(num_workers), 1))
+    seconds = sorted(ready_at - start for ready_at in ready.values())
+    return {'method': context.get_start_method(), 'num_workers': num_workers, 'workers_seen': len(seconds),
+            'first_ready': seconds[0], 'last_ready': seconds[-1], 'mean_ready': sum(seconds) / len(seconds)}
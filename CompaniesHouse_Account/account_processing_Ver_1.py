@@ -34,31 +34,39 @@ Ver. 1.0.1 Update Notes (03/08/2023):
 
 
 
-import pandas as pd
-import networkx as nx
-import json
-import glob
-from tqdm import tqdm
-import httpx
-
-from stream_read_xbrl import stream_read_xbrl_zip
-
-from xbrl_import import xbrl_parser as xp
-import os
-import numpy as np
-import pandas as pd
+import sys
+import functools
 import importlib
-import datetime
+import time
 import multiprocessing
-import concurrent.futures
 
+import xml_parser
+import zip_reader
+import account_cli
+import account_pipeline
+import account_manifest
+import account_metrics
+import parse_cache
 
 
+# pandas, xbrl_parser (with bs4), account_extract and account_facts are only imported in the functions that use them,
+# so the script loads in milliseconds and a spawned worker only pays for the ones its work needs (the ZIP members,
+# parsed by xml_parser, never import xbrl_parser)
+xp = None
 
-def mapping(date): 
-    avail_year = set(['2018', '2019', '2020', '2021'])
+def xbrl_parser(): 
+    global xp
+    if xp is None: 
+        xp = importlib.import_module('xbrl_import.xbrl_parser')
+    return xp
+
+
+# Fiscal years read_account_Data splits out, the fact table (read_account_facts) keeps every year
+avail_years = set(['2018', '2019', '2020', '2021'])
+
+def mapping(date, avail_year=avail_years): 
     year = date.split('-')[0]
-    if year not in avail_year: 
+    if avail_year is not None and year not in avail_year: 
         year = 'before'
     return year
 
@@ -102,17 +110,112 @@ def get_fixed_asset(fixed_asset, other_fix, year):
 
 
 
-def read_account_Data(file): 
+def init_worker(settings=None): 
+    # Load the parser state once per worker instead of once per file, and take the settings of the run (see
+    # WORKER_SETTINGS), which 'spawn' and 'forkserver' workers would otherwise only know the defaults of
+    if xp is not None: 
+        importlib.reload(xp)
+    globals().update(settings or {})
+
+
+# Cache of parsed files keyed by their content and the parser version, None to turn it off
+cache_dir = 'account_parse_cache'
+cache_max_gb = 20
+parse_cache_store = None
+
+def worker_cache(): 
+    global parse_cache_store
+    if parse_cache_store is None and cache_dir: 
+        parse_cache_store = parse_cache.ParseCache(cache_dir, cache_max_gb * 2**30)
+    return parse_cache_store
+
+
+def xp_process_account(file): 
+    # xbrl_parser opens, parses and scrapes in one call
+    with account_metrics.stage('parse'): 
+        doc = xbrl_parser().process_account(file)
+    if isinstance(doc, dict): 
+        account_metrics.count_elements(doc.get('elements'))
+    return doc
+
+
+@account_metrics.instrument_file
+def parse_account(file, content=None, concepts=None): 
+    cache = worker_cache()
+
+    # try getting the first file (an XML, or XBRL, file)
+    if content is None: 
+        if cache is None: 
+            return xp_process_account(file)
+        with account_metrics.stage('open'): 
+            with open(file, 'rb') as f: 
+                raw = f.read()
+        return parse_cache.cached_parse(cache, file, raw, parse_cache.module_version(xbrl_parser()), lambda: xp_process_account(file))
+
+    # members read out of a ZIP archive are parsed in memory with the streaming engine, 
+    # which can skip every fact outside of concepts. Inline XBRL facts are named by their concept, as xbrl_parser does
+    version = parse_cache.module_version(xml_parser) + 'lxml-inline' + parse_cache.concepts_version(concepts)
+    return parse_cache.cached_parse(cache, file, content, version, 
+                                    lambda: xml_parser.process_account(file, engine='lxml', content=content, concepts=concepts, 
+                                                                       inline_names=True))
+
+
+# Only parse the concepts account_extract reads when extracting the yearly rows (ZIP members only, 
+# xbrl_parser always reads the whole file)
+targeted = True
+target_concepts_set = None
+
+def target_concepts(): 
+    global target_concepts_set
+    if target_concepts_set is None: 
+        import account_extract
+        target_concepts_set = frozenset(account_extract.CONCEPTS)
+    return target_concepts_set
+
+# Settings read inside the workers, handed to them by init_worker
+WORKER_SETTINGS = ['cache_dir', 'cache_max_gb', 'targeted']
+
+def worker_settings(): 
+    return {name: globals()[name] for name in WORKER_SETTINGS}
+
+
+@account_metrics.instrument_file
+def read_account_Data(file, content=None): 
+    import account_extract
+    doc = parse_account(file, content, target_concepts() if targeted else None)
+    with account_metrics.stage('extract'): 
+        rows = account_extract.extract_account_rows(doc, file)
+    if not any(rows): 
+        account_metrics.outcome('no_fiscal_year')
+    return rows
+
+
+def read_account_batch(files): 
+    # Parse a chunk of files, then extract all their rows in one DataFrame pass
+    import account_extract
+    docs = [(file, parse_account(file)) for file in files]
+    start = time.perf_counter()
+    rows = account_extract.extract_fiscal_rows(account_extract.elements_frame(docs))
+    account_metrics.share_stage('extract', time.perf_counter() - start, len(files))
+    return [rows.get(file, [{}, {}, {}, {}]) for file in files]
+
+
+@account_metrics.instrument_file
+def read_account_facts(file, content=None): 
+    # The long fact table of the file, the yearly rows are extracted from it in the parent (see fact_year_frames)
+    import account_facts
+    doc = parse_account(file, content)
+    with account_metrics.stage('extract'): 
+        return account_facts.doc_facts(doc)
+
+
+# Original per-concept extraction, account_extract gives the same rows in a fraction of the time
+def extract_account_data(doc, file): 
+    import pandas as pd
     account_data_2021 = {}
     account_data_2020 = {}
     account_data_2019 = {}
     account_data_2018 = {}
-    
-    
-    importlib.reload(xp)
-
-    # try getting the first file (an XML, or XBRL, file)
-    doc = xp.process_account(file)
 
     # display for fun
     
@@ -305,44 +408,153 @@ def read_account_Data(file):
     return [account_data_2018, account_data_2019, account_data_2020, account_data_2021]
     
 
-# Please Change the directory here! 
-files = glob.glob('Accounts_Monthly_Data-February2022/*.html')
-
-##########
-# Can do all accounts in one go
-# files_6 = glob.glob('Accounts_Monthly_Data-June/*.html')
-# files_7 = glob.glob('Accounts_Monthly_Data-July/*.html')
-# files_8 = glob.glob('Accounts_Monthly_Data-August/*.html')
-# files_9 = glob.glob('Accounts_Monthly_Data-September/*.html')
-# ...
-# files = files_6
-# files.extend(files_7)
-# files.extend(files_8)
-# files.extend(files_9)
+# Set from the command line, e.g. 
+#   python account_processing_Ver_1.py --months 2022-02 2022-03
+#   python account_processing_Ver_1.py 'Accounts_Monthly_Data-February2022/*.html' --source-month 2022-02
+# or the monthly ZIPs directly without extracting them: python account_processing_Ver_1.py Accounts_Monthly_Data-February2022.zip
+# Nothing is globbed at import, so spawned workers start straight away
+files = []
+zip_files = []
+# Files read from directories and ZIP archives. The plain XBRL .xml filings are xml_parser's
+ACCOUNT_SUFFIXES = ('.html',)
 
 
-
-final_2021 = []
-final_2020 = []
-final_2019 = []
-final_2018 = []
 account_before_2018 = []
 no_name_companies = []
 
 # Maybe change the num_workers to cpu_count() - 1/2
 num_workers = multiprocessing.cpu_count()
-def main():
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        
-        results = executor.map(read_account_Data, files)
-
-    return results
-
-if __name__ == "__main__":
-    print('Start Scraping Account Data')
+# Pool start method, None for the platform default ('fork' on Linux). Under 'forkserver' the preload modules are
+# imported once in the server and workers start in milliseconds, under 'spawn' every worker imports what it uses itself.
+# xbrl_parser is left out, only the workers parsing loose files with it import it
+start_method = None
+preload = ['account_processing_Ver_1', 'pandas']
+
+# 'parquet' appends this month to a dataset partitioned by fiscal year and source month, 'csv' writes one file per year
+# Reload the whole history with account_writer.read_account_parquet('account_parquet', columns=[...])
+output_format = 'parquet'
+output_dir = 'account_parquet'
+source_month = '2022-02'
+
+# 'years' for the 2018-2021 tables only, 'facts' also keeps every parsed fact (all concepts, all years) in fact_dir
+# Reload it with account_writer.read_fact_parquet('account_facts', concepts=[...])
+output_mode = 'facts'
+fact_dir = 'account_facts'
+
+# Number of files sent to a worker at a time, raise it for 1M+ file months
+chunksize = 64
+
+# Time every stage of every file and print a report of slow and failed files at the end, saved to metrics_path
+report_metrics = True
+metrics_path = 'account_run_report_{source_month}.json'
+run_metrics = None
 
+def main():
+    if zip_files: 
+        read_fn = read_account_facts if output_mode == 'facts' else read_account_Data
+        return zip_reader.process_zip_archives(zip_files, read_fn, num_workers, batch_size=chunksize, suffixes=ACCOUNT_SUFFIXES, 
+                                               initializer=init_worker, initargs=(worker_settings(),), metrics=run_metrics, 
+                                               start_method=start_method, preload=preload)
+
+    if output_mode == 'facts': 
+        return account_pipeline.run_pipeline(files, read_account_facts, num_workers, chunksize, initializer=init_worker, 
+                                             initargs=(worker_settings(),), metrics=run_metrics, start_method=start_method, preload=preload)
+
+    # Whole chunks go through the vectorised extraction in one go
+    return account_pipeline.run_pipeline(files, read_account_batch, num_workers, chunksize, initializer=init_worker, 
+                                         initargs=(worker_settings(),), batched=True, metrics=run_metrics, start_method=start_method, preload=preload)
+
+# Skip files already recorded in output_dir/_manifest.jsonl and checkpoint every checkpoint_every files,
+# so a crashed run or a newly added month only parses what is new (parquet output only)
+resume = True
+checkpoint_every = 5000
+# Files that failed are recorded in the manifest and skipped by later runs, True to parse them again
+retry_failed = False
+
+def year_frames(results): 
+    import pandas as pd
+    return {int(year): pd.DataFrame([r[i] for r in results if r[i]]) for i, year in enumerate(sorted(avail_years))}
+
+def fact_year_frames(facts): 
+    # Yearly tables extracted from a fact table, with the same rules as account_extract on the parsed docs
+    import account_extract
+    return year_frames(list(account_extract.extract_fact_rows(facts).values()))
+
+def chunk_frames(results): 
+    # (fact table or None, dict of fiscal year -> DataFrame) of a chunk of results
+    import account_facts
+    if output_mode == 'facts': 
+        facts = account_facts.concat_facts(results)
+        return facts, fact_year_frames(facts)
+    return None, year_frames(results)
+
+def write_checkpoint(results, part): 
+    import account_writer
+    facts, frames = chunk_frames(results)
+    if facts is not None: 
+        account_writer.write_fact_parquet(facts, fact_dir, source_month, part=part)
+    account_writer.write_account_parquet(frames, output_dir, source_month, part=part)
+
+def resume_main(): 
+    read_fn = read_account_facts if output_mode == 'facts' else read_account_Data
+    if zip_files: 
+        keyed_files = zip_reader.iter_zip_member_keys(zip_files, ACCOUNT_SUFFIXES)
+        read_fn, batched = functools.partial(zip_reader.read_zip_batch, read_fn=read_fn), True
+    else: 
+        keyed_files = ((account_manifest.file_key(file), file) for file in files)
+        if output_mode != 'facts': 
+            read_fn, batched = read_account_batch, True
+        else: 
+            batched = False
+
+    output_dirs = [output_dir, fact_dir] if output_mode == 'facts' else [output_dir]
+    return account_manifest.run_incremental(keyed_files, read_fn, write_checkpoint, output_dirs, checkpoint_every, 
+                                            batched, retry_failed, stream_chunk_files if streaming else None, 
+                                            num_workers=num_workers, chunksize=chunksize, 
+                                            initializer=init_worker, initargs=(worker_settings(),), metrics=run_metrics, 
+                                            start_method=start_method, preload=preload)
+
+def write_run_report(): 
+    print(run_metrics.report())
+    run_metrics.save(metrics_path.format(source_month=source_month))
+
+# Write results as they come back from the workers instead of collecting the whole month first, so the parent only
+# holds stream_chunk_files files of results (parquet output only). With resume (the default) every checkpoint is
+# written in pieces of stream_chunk_files files, so checkpoint_every can be raised to keep fewer parts without holding
+# more results; without resume (--no-resume) each partition is one file written a row group at a time
+streaming = True
+stream_chunk_files = 5000
+row_group_size = 100000
+
+def stream_main(): 
+    import account_writer
+    num_parsed = 0
+    with account_writer.AccountStreamWriter(output_dir, source_month, fact_dir if output_mode == 'facts' else None, 
+                                            row_group_size=row_group_size) as writer: 
+        for results in account_pipeline.chunked(main(), stream_chunk_files): 
+            facts, frames = chunk_frames(results)
+            if facts is not None: 
+                writer.write_facts(facts)
+            writer.write_years(frames)
+            num_parsed += len(results)
+    print("Rows written by fiscal year: {}".format(writer.rows_written()))
+    return num_parsed
+
+def collect_main(): 
+    # Original flow: collect the whole run, then write it out
+    import pandas as pd
+    import account_facts
+    import account_extract
+    import account_writer
     results = main()
 
+    if output_mode == 'facts': 
+        facts = account_facts.concat_facts(results)
+        account_writer.write_fact_parquet(facts, fact_dir, source_month)
+        results = list(account_extract.extract_fact_rows(facts).values())
+
+    # local to the run, so that the months of one cli call do not pile up in each other's tables
+    final_2018, final_2019, final_2020, final_2021 = [], [], [], []
     for r in results: 
         if r[0]: 
             final_2018.append(r[0])
@@ -352,24 +564,74 @@ if __name__ == "__main__":
             final_2020.append(r[2])
         if r[3]:
             final_2021.append(r[3])
-        
+    
     df_2018 = pd.DataFrame(final_2018)
     df_2019 = pd.DataFrame(final_2019)
     df_2020 = pd.DataFrame(final_2020)
     df_2021 = pd.DataFrame(final_2021)
 
 
-    # Please Name Based on the month of the data 
-    # Naming Convention: account_20**_1.csv for Account_Monthly_Data-January
-    df_2018.to_csv('account_2018_2.csv', index=False)
-    df_2019.to_csv('account_2019_2.csv', index=False)
-    df_2020.to_csv('account_2020_2.csv', index=False)
-    df_2021.to_csv('account_2021_2.csv', index=False)
-
-
-
-
-
-
-    
+    if output_format == 'parquet': 
+        account_writer.write_account_parquet({2018: df_2018, 2019: df_2019, 2020: df_2020, 2021: df_2021}, output_dir, source_month)
+    else: 
+        # Named after the month of the data (source_month) 
+        # Naming Convention: account_20**_1.csv for Account_Monthly_Data-January
+        month = int(source_month.split('-')[1])
+        df_2018.to_csv('account_2018_{}.csv'.format(month), index=False)
+        df_2019.to_csv('account_2019_{}.csv'.format(month), index=False)
+        df_2020.to_csv('account_2020_{}.csv'.format(month), index=False)
+        df_2021.to_csv('account_2021_{}.csv'.format(month), index=False)
+
+def run_inputs(): 
+    # Parse files and zip_files for source_month with the settings above, and print the run report, 
+    # also after a crash to see which file brought the run down
+    global run_metrics
+    run_metrics = account_metrics.RunMetrics() if report_metrics else None
+    try: 
+        if resume and output_format == 'parquet': 
+            print("Number of new files parsed: {}".format(resume_main()))
+        elif streaming and output_format == 'parquet': 
+            print("Number of files parsed: {}".format(stream_main()))
+        else: 
+            collect_main()
+    finally: 
+        parse_cache.trim_cache(cache_dir, cache_max_gb * 2**30)
+        if run_metrics is not None: 
+            write_run_report()
+
+def run(files=(), zip_files=(), source_month=None, **settings): 
+    # API entry point, e.g. run(['a.html', 'b.html'], source_month='2022-02', num_workers=8, output_mode='years')
+    module = sys.modules[__name__]
+    for name, value in settings.items(): 
+        if not hasattr(module, name): 
+            raise TypeError("Unknown setting {}".format(name))
+        setattr(module, name, value)
+    module.files = list(files)
+    module.zip_files = list(zip_files)
+    if source_month is not None: 
+        module.source_month = source_month
+    run_inputs()
+
+def cli(argv=None): 
+    arg_parser = account_cli.build_parser('Parse Companies House account files into yearly tables with xbrl_parser')
+    args = arg_parser.parse_args(argv)
+    settings = account_cli.script_settings(args)
+
+    if args.measure_startup: 
+        for method in multiprocessing.get_all_start_methods(): 
+            for attempt in ('first', 'second'): 
+                startup = account_pipeline.worker_startup(settings.get('num_workers', num_workers), modules=preload, 
+                                                          initializer=init_worker, method=method, preload=preload)
+                print('{} pool, {}: workers ready after {:.3f}s (first) to {:.3f}s (last)'.format(
+                    method, attempt, startup['first_ready'], startup['last_ready']))
+        return
+
+    if not args.inputs and not args.months: 
+        arg_parser.error('give account files, directories or ZIP archives, or --months')
+
+    for month, month_files, month_zip_files in account_cli.month_runs(args, ACCOUNT_SUFFIXES, source_month): 
+        print('Start Scraping Account Data for {}: {} files, {} ZIP archives'.format(month, len(month_files), len(month_zip_files)))
+        run(month_files, month_zip_files, month, **settings)
 
+if __name__ == "__main__":
+    cli()
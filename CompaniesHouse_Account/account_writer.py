@@ -0,0 +1,303 @@
+'''
+
+Companies House Account Data Writer
+
+Write the per-year account DataFrames as one typed Parquet dataset, partitioned by fiscal year and source month
+(e.g. account_parquet/fiscal_year=2021/source_month=2022-02/part-0.parquet), instead of one CSV per year and month.
+Financial columns are stored as float64, company numbers and names dictionary-encoded. Writing a month only replaces
+that month's partitions, so the dataset can be built up month by month and reloaded, or column-projected, in one go.
+AccountStreamWriter writes the same layout a row group at a time as results come in, in bounded memory.
+
+'''
+
+import os
+import functools
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+# Columns stored dictionary-encoded, everything not listed here or in
+# TEXT_COLUMNS is a financial value and stored as float64
+ID_COLUMNS = ['CompanyNumber', 'CompanyName']
+TEXT_COLUMNS = ['CompanyDormant', 'section_480']
+
+PARTITIONING = ds.partitioning(pa.schema([('fiscal_year', pa.int16()), ('source_month', pa.string())]), flavor='hive')
+
+
+def account_table(df, fiscal_year, source_month):
+    '''
+    Convert one year's account DataFrame into a typed Arrow table with
+    the partition columns attached.
+    '''
+    fields = []
+    arrays = []
+    for column in df.columns:
+        if column in ID_COLUMNS:
+            array = pa.array(df[column].astype(str), pa.string()).dictionary_encode()
+        elif column in TEXT_COLUMNS:
+            array = pa.array(df[column].astype(object).where(df[column].notna(), None), pa.string())
+        else:
+            array = pa.array(pd.to_numeric(df[column], errors='coerce').astype('float64'), pa.float64())
+        fields.append(pa.field(column, array.type))
+        arrays.append(array)
+
+    fields.append(pa.field('fiscal_year', pa.int16()))
+    arrays.append(pa.array([fiscal_year] * len(df), pa.int16()))
+    fields.append(pa.field('source_month', pa.string()))
+    arrays.append(pa.array([source_month] * len(df), pa.string()))
+
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def write_options(part):
+    # A whole month replaces its partitions, a checkpoint part is added next to the others
+    if part is None:
+        return {'existing_data_behavior': 'delete_matching', 'basename_template': 'part-{i}.parquet'}
+    return {'existing_data_behavior': 'overwrite_or_ignore', 'basename_template': 'part-' + part + '-{i}.parquet'}
+
+
+def write_account_parquet(frames, output_dir, source_month, part=None):
+    '''
+    Write one month of account data to the partitioned dataset. Rerunning
+    a month overwrites its own partitions and leaves other months alone.
+
+    Keyword arguments:
+    frames -- dict of fiscal year -> DataFrame, e.g. {2021: df_2021}
+    output_dir -- root directory of the dataset
+    source_month -- month the filings were published, e.g. '2022-02'
+    part -- checkpoint id (see account_manifest), adds the rows as a new
+            part of the month instead of replacing it
+    '''
+    for fiscal_year, df in frames.items():
+        if len(df) == 0:
+            continue
+        ds.write_dataset(account_table(df, int(fiscal_year), source_month), output_dir, format='parquet',
+                         partitioning=PARTITIONING, **write_options(part))
+
+
+def read_account_parquet(output_dir, columns=None, fiscal_years=None, source_months=None):
+    '''
+    Load the account dataset back into a DataFrame, reading only the
+    requested columns and partitions.
+
+    Keyword arguments:
+    output_dir -- root directory of the dataset
+    columns -- list of columns to read, None for all
+    fiscal_years -- list of fiscal years to keep, None for all
+    source_months -- list of source months to keep, None for all
+    '''
+    dataset = ds.dataset(output_dir, format='parquet', partitioning=PARTITIONING)
+
+    condition = None
+    if fiscal_years is not None:
+        condition = ds.field('fiscal_year').isin([int(year) for year in fiscal_years])
+    if source_months is not None:
+        months = ds.field('source_month').isin(list(source_months))
+        condition = months if condition is None else condition & months
+
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+FACT_PARTITIONING = ds.partitioning(pa.schema([('source_month', pa.string())]), flavor='hive')
+
+
+def write_fact_parquet(facts, output_dir, source_month, part=None):
+    '''
+    Write one month of the long fact table (see account_facts) to a
+    dataset partitioned by source month. Like write_account_parquet,
+    rerunning a month only replaces that month unless part is given.
+    '''
+    if len(facts) == 0:
+        return
+    table = pa.Table.from_pandas(facts, preserve_index=False)
+    table = table.append_column(pa.field('source_month', pa.string()), pa.array([source_month] * len(facts), pa.string()))
+    ds.write_dataset(table, output_dir, format='parquet', partitioning=FACT_PARTITIONING, **write_options(part))
+
+
+def read_fact_parquet(output_dir, columns=None, concepts=None, source_months=None):
+    '''
+    Load the fact dataset, optionally only some columns, concepts and months.
+    '''
+    dataset = ds.dataset(output_dir, format='parquet', partitioning=FACT_PARTITIONING)
+
+    condition = None
+    if concepts is not None:
+        condition = ds.field('concept').isin(list(concepts))
+    if source_months is not None:
+        months = ds.field('source_month').isin(list(source_months))
+        condition = months if condition is None else condition & months
+
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def partition_dir(output_dir, **partitions):
+    return os.path.join(output_dir, *['{}={}'.format(key, value) for key, value in partitions.items()])
+
+
+class PartitionWriter:
+    '''
+    One Parquet file of a partition, written a row group at a time.
+    DataFrames are buffered until row_group_size rows have come in, then
+    converted with to_table and written out, so only one row group is
+    ever held in memory. The schema is that of the first row group, later
+    ones are conformed to it: missing columns come out as nulls, a column
+    the schema does not have is an error rather than being dropped.
+    '''
+
+    def __init__(self, path, to_table, row_group_size=100000):
+        self.path = path
+        self.to_table = to_table
+        self.row_group_size = row_group_size
+        self.frames = []
+        self.rows = 0
+        self.written = 0
+        self.writer = None
+
+    def write(self, df):
+        if len(df) == 0:
+            return
+        self.frames.append(df)
+        self.rows += len(df)
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def conform(self, table):
+        unknown = [name for name in table.column_names if name not in self.writer.schema.names]
+        if unknown:
+            raise ValueError('Columns {} are not in the schema of {}, set by its first row group: {}'.format(
+                unknown, self.path, self.writer.schema.names))
+        columns = []
+        for field in self.writer.schema:
+            if field.name in table.column_names:
+                columns.append(table[field.name].cast(field.type))
+            else:
+                columns.append(pa.nulls(len(table), field.type))
+        return pa.Table.from_arrays(columns, schema=self.writer.schema)
+
+    def flush(self):
+        if not self.frames:
+            return
+        table = self.to_table(pd.concat(self.frames, ignore_index=True))
+        self.frames, self.rows = [], 0
+
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = self.conform(table)
+        self.writer.write_table(table, row_group_size=len(table))
+        self.written += len(table)
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def clear_partition(directory):
+    # same as write_dataset's delete_matching: a rerun replaces the month's partition
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.endswith('.parquet'):
+                os.remove(os.path.join(directory, name))
+
+
+class AccountStreamWriter:
+    '''
+    Streaming counterpart of write_account_parquet and write_fact_parquet:
+    results are written as they come back from the workers, one open file
+    per fiscal year (and one for the facts) of the month, so the memory of
+    the parent stays at about one row group per file however many files
+    are processed. Files land in the same partitioned layout, and read
+    back with read_account_parquet and read_fact_parquet.
+
+    Keyword arguments:
+    output_dir -- root directory of the account dataset
+    source_month -- month the filings were published, e.g. '2022-02'
+    fact_dir -- root directory of the fact dataset, None for no facts
+    part -- checkpoint id to add the files next to the month's others,
+            None replaces the month's partitions
+    row_group_size -- rows buffered per file before a row group is written
+    '''
+
+    def __init__(self, output_dir, source_month, fact_dir=None, part=None, row_group_size=100000):
+        self.output_dir = output_dir
+        self.source_month = source_month
+        self.fact_dir = fact_dir
+        self.part = part
+        self.row_group_size = row_group_size
+        self.year_writers = {}
+        self.fact_writer = None
+
+    def file_name(self):
+        return 'part-0.parquet' if self.part is None else 'part-{}-0.parquet'.format(self.part)
+
+    def open_writer(self, directory, to_table):
+        if self.part is None:
+            clear_partition(directory)
+        return PartitionWriter(os.path.join(directory, self.file_name()), to_table, self.row_group_size)
+
+    def write_years(self, frames):
+        '''
+        Add rows to the yearly tables, frames is a dict of fiscal year ->
+        DataFrame as for write_account_parquet.
+        '''
+        for fiscal_year, df in frames.items():
+            fiscal_year = int(fiscal_year)
+            if len(df) == 0:
+                continue
+            if fiscal_year not in self.year_writers:
+                directory = partition_dir(self.output_dir, fiscal_year=fiscal_year, source_month=self.source_month)
+                to_table = functools.partial(partition_table, fiscal_year=fiscal_year, source_month=self.source_month)
+                self.year_writers[fiscal_year] = self.open_writer(directory, to_table)
+            self.year_writers[fiscal_year].write(df)
+
+    def write_facts(self, facts):
+        if self.fact_dir is None or len(facts) == 0:
+            return
+        if self.fact_writer is None:
+            directory = partition_dir(self.fact_dir, source_month=self.source_month)
+            self.fact_writer = self.open_writer(directory, fact_table)
+        self.fact_writer.write(facts)
+
+    def rows_written(self):
+        return {fiscal_year: writer.written for fiscal_year, writer in self.year_writers.items()}
+
+    def close(self):
+        for writer in self.year_writers.values():
+            writer.close()
+        if self.fact_writer is not None:
+            self.fact_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def partition_table(df, fiscal_year, source_month):
+    # the partition columns live in the directory names only
+    return account_table(df, fiscal_year, source_month).drop_columns(['fiscal_year', 'source_month'])
+
+
+def fact_table(facts):
+    '''
+    Arrow table of a fact chunk with a fixed schema, so that chunks whose
+    categories or text columns differ can go into the same file.
+    '''
+    arrays = []
+    for column in facts.columns:
+        values = facts[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            array = pa.array(values.astype(object).where(values.notna(), None), pa.string()).dictionary_encode()
+        elif column == 'text':
+            array = pa.array(values.astype(object).where(values.notna(), None), pa.string())
+        else:
+            array = pa.array(values)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=list(facts.columns))
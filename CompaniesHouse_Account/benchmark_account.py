@@ -0,0 +1,385 @@
+'''
+
+Companies House Account Parser Benchmark
+
+Time the account parsers on a synthetic corpus (see synthetic_filings.py) so that a change to xml_parser can be checked
+for speed before it is run on a real month. Every case runs in a fresh process and reports files/sec, p50/p99 latency
+per file and peak RSS: process_account, scrape_elements and read_account_Data of xml_parser for both engines at the
+file level, and read_account_Data over the whole directory on the worker pool of account_pipeline. Runs offline. The
+results are compared with the baselines stored in benchmark_baseline.json, set save_baseline to store new ones. Cases
+with errors are neither stored nor compared, and the pool cases only count on a machine with the baseline's number of
+CPUs (more than one). Inline XBRL (.html) filings are only timed at the parse level, as xml_parser reads only the .xml
+files of a month. Before
+the timings, check_targeted_rows makes sure that parsing only the concepts account_extract reads gives the same yearly
+rows (and liability split) as a full parse, on filings with a creditors note after the balance sheet, and
+check_mixed_zip that xml_parser reads only the .xml members of a monthly ZIP that also holds iXBRL .html filings.
+
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import platform
+import tempfile
+import zipfile
+import functools
+import multiprocessing
+
+import numpy as np
+
+import synthetic_filings
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def summarise(latencies, seconds, errors=0):
+    latencies = np.asarray(latencies) * 1000
+    return {'files': len(latencies), 'errors': errors, 'seconds': round(seconds, 4),
+            'files_per_sec': round(len(latencies) / seconds, 2) if seconds else 0.0,
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3) if len(latencies) else 0.0,
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3) if len(latencies) else 0.0}
+
+
+def time_files(files, prepare, run, repeat=1):
+    '''
+    Per-file latency of run(prepare(file)). prepare is not timed, e.g. to
+    read the file into memory or build its soup. Files the parser raises
+    on are counted as errors and still timed.
+    '''
+    latencies = []
+    total = 0.0
+    errors = 0
+    for r in range(repeat):
+        for file in files:
+            argument = prepare(file)
+            start = time.perf_counter()
+            try:
+                run(argument)
+            except Exception:
+                errors += 1
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            total += elapsed
+    return summarise(latencies, total, errors)
+
+
+def read_bytes(file):
+    with open(file, 'rb') as f:
+        return file, f.read()
+
+
+def build_soup(file):
+    from bs4 import BeautifulSoup
+    with open(file, 'rb') as f:
+        return BeautifulSoup(f.read(), 'xml'), file
+
+
+def run_case(case, files, repeat, num_workers):
+    '''
+    Run one benchmark case in the current process and return its result.
+    Imports happen here so that every case starts from a fresh process.
+    '''
+    import xml_parser
+    # the parse cache would time unpickling instead of parsing
+    xml_parser.cache_dir = None
+
+    function, engine = case.split(':')
+    if function == 'process_account':
+        result = time_files(files, read_bytes, lambda a: xml_parser.process_account(a[0], engine=engine, content=a[1]), repeat)
+    elif function == 'scrape_elements' and engine == 'bs4':
+        result = time_files(files, build_soup, lambda a: xml_parser.scrape_elements(*a), repeat)
+    elif function == 'scrape_elements':
+        result = time_files(files, read_bytes, lambda a: xml_parser.scrape_elements_lxml(io.BytesIO(a[1]), a[0]), repeat)
+    elif function == 'read_account_Data':
+        result = time_files(files, read_bytes, lambda a: xml_parser.read_account_Data(a[0], engine=engine, content=a[1]), repeat)
+    elif function == 'directory':
+        import account_pipeline
+        stats = {}
+        read_fn = functools.partial(xml_parser.read_account_Data, engine=engine)
+        timings = list(account_pipeline.run_pipeline(files, functools.partial(timed_call, read_fn=read_fn), num_workers,
+                                                     chunksize=16, stats=stats, report_every=10**9))
+        result = summarise([latency for latency, error in timings], stats['seconds'], sum(error for latency, error in timings))
+        # latency is measured in the workers, throughput over the whole run
+        result['files_per_sec'] = round(stats['files_per_sec'], 2)
+        result['num_workers'] = stats['num_workers']
+        result['peak_rss_workers_mb'] = round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)
+    else:
+        raise ValueError('Unknown benchmark case {}'.format(case))
+
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+def timed_call(file, read_fn):
+    start = time.perf_counter()
+    try:
+        read_fn(file)
+    except Exception:
+        return time.perf_counter() - start, 1
+    return time.perf_counter() - start, 0
+
+
+def case_process(connection, case, files, repeat, num_workers):
+    try:
+        connection.send(run_case(case, files, repeat, num_workers))
+    except Exception as e:
+        connection.send({'error': repr(e)})
+    connection.close()
+
+
+def run_isolated(case, files, repeat=1, num_workers=None):
+    '''
+    Run a case in its own (non daemonic, so it can start a pool) process
+    so that its peak RSS is not inflated by the cases before it.
+    '''
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=case_process, args=(sender, case, files, repeat, num_workers))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def check_targeted_rows(files, engines=('lxml', 'bs4')):
+    '''
+    Files whose yearly rows from account_extract differ between a full
+    parse and a parse of account_extract.CONCEPTS only, e.g. because the
+    15 element window on creditors saw other elements.
+
+    Returns a list of (engine, file)
+    '''
+    import xml_parser
+    import account_extract
+    concepts = frozenset(account_extract.CONCEPTS)
+
+    mismatches = []
+    for file in files:
+        with open(file, 'rb') as f:
+            content = f.read()
+        for engine in engines:
+            full = xml_parser.process_account(file, engine=engine, content=content, inline_names=True)
+            targeted = xml_parser.process_account(file, engine=engine, content=content, concepts=concepts, inline_names=True)
+            if account_extract.extract_account_rows(full, file) != account_extract.extract_account_rows(targeted, file):
+                mismatches.append((engine, file))
+    return mismatches
+
+
+def check_mixed_zip(corpus_dir, num_files=10, seed=0):
+    '''
+    Run xml_parser in years and in facts mode over a ZIP of .xml and .html
+    filings. Returns a list of problems: a run that failed, members other
+    than .xml that were read, facts under the inline tag names
+    (nonfraction, nonnumeric) or a number of yearly rows different from a
+    run over the .xml filings alone.
+    '''
+    import xml_parser
+    import account_writer
+    xml_files = synthetic_filings.generate_corpus(os.path.join(corpus_dir, 'xml'), num_files, 'xml', seed)
+    html_files = synthetic_filings.generate_corpus(os.path.join(corpus_dir, 'html'), num_files, 'html', seed + 1)
+    zip_path = os.path.join(corpus_dir, 'Accounts_Monthly_Data-Mixed.zip')
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        for file in xml_files + html_files:
+            archive.write(file, os.path.basename(file))
+
+    settings = {'num_workers': 1, 'resume': False, 'cache_dir': None, 'report_metrics': False, 'output_format': 'parquet'}
+    saved = {name: getattr(xml_parser, name) for name in list(settings) + ['output_mode', 'output_dir', 'fact_dir']}
+    problems = []
+    try:
+        rows = {}
+        for output_mode in ('years', 'facts'):
+            for name, inputs in (('zip', {'zip_files': [zip_path]}), ('xml', {'files': xml_files})):
+                output_dir = os.path.join(corpus_dir, 'out_{}_{}'.format(output_mode, name))
+                try:
+                    xml_parser.run(source_month='2022-01', output_mode=output_mode, output_dir=output_dir,
+                                   fact_dir=output_dir + '_facts', **inputs, **settings)
+                except Exception as e:
+                    problems.append('{} {} run failed: {!r}'.format(output_mode, name, e))
+                    continue
+                rows[output_mode, name] = len(account_writer.read_account_parquet(output_dir))
+                if output_mode == 'facts':
+                    facts = account_writer.read_fact_parquet(output_dir + '_facts')
+                    read = set(facts['source_file'].astype(str).str.rsplit('.', n=1).str[-1])
+                    if read - {'xml'}:
+                        problems.append('{} facts: members read: {}'.format(name, sorted(read)))
+                    inline = set(facts['concept'].astype(str)) & {'nonfraction', 'nonnumeric'}
+                    if inline:
+                        problems.append('{} facts: inline tag names as concepts: {}'.format(name, sorted(inline)))
+            if rows.get((output_mode, 'zip')) != rows.get((output_mode, 'xml')):
+                problems.append('{}: {} yearly rows from the ZIP, {} from the .xml files'.format(
+                    output_mode, rows.get((output_mode, 'zip')), rows.get((output_mode, 'xml'))))
+    finally:
+        for name, value in saved.items():
+            setattr(xml_parser, name, value)
+    return problems
+
+
+def kind_cases(kind, cases):
+    # The cases run on a kind of filing: the yearly rows of xml_parser are only read from XBRL instances (.xml)
+    if kind == 'xml':
+        return cases
+    return [case for case in cases if case.split(':')[0] in PARSE_FUNCTIONS]
+
+
+def run_benchmarks(corpus_dir, cases, kinds, num_files, repeat=1, num_workers=None, seed=0, **filing_kwargs):
+    '''
+    Generate one corpus per kind of filing and run every case over it.
+
+    Keyword arguments:
+    corpus_dir -- directory the synthetic filings are written to
+    cases -- list of 'function:engine' cases, see benchmark_cases
+    kinds -- 'xml' and/or 'html' (inline XBRL)
+    num_files -- number of filings per corpus
+    repeat -- passes over the corpus for the file-level cases
+    num_workers -- pool size of the directory cases
+    filing_kwargs -- passed on to synthetic_filings.generate_corpus
+
+    Returns a dict of results keyed by 'corpus case'
+    '''
+    results = {}
+    for kind in kinds:
+        kind_dir = os.path.join(corpus_dir, kind)
+        files = synthetic_filings.generate_corpus(kind_dir, num_files, kind, seed, **dict(filing_kwargs))
+        size = sum(os.path.getsize(file) for file in files)
+        print('Generated {} {} filings, {:.1f} MB'.format(len(files), kind, size / 2**20))
+
+        for case in kind_cases(kind, cases):
+            name = '{}[{}] {}'.format(kind, num_files, case)
+            results[name] = run_isolated(case, files, repeat, num_workers)
+            print(format_result(name, results[name]))
+    return results
+
+
+def format_result(name, result):
+    if 'error' in result:
+        return '{:<42} failed: {}'.format(name, result['error'])
+    return '{:<42} {:>9.1f} files/sec  p50 {:>8.2f} ms  p99 {:>8.2f} ms  peak RSS {:>7.1f} MB  {} errors'.format(
+        name, result['files_per_sec'], result['p50_ms'], result['p99_ms'],
+        max(result['peak_rss_mb'], result.get('peak_rss_workers_mb', 0)), result['errors'])
+
+
+def machine():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def compare_baseline(results, baseline_path, tolerance=0.1):
+    '''
+    Print the change in files/sec and p99 against the stored baselines and
+    return the names of the cases that slowed down by more than tolerance.
+    '''
+    if not os.path.exists(baseline_path):
+        print('No baseline at {}'.format(baseline_path))
+        return []
+
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('machine') != machine():
+        print('Baseline was recorded on {}, compare with care'.format(baseline.get('machine')))
+
+    regressions = []
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        if 'error' in before or before.get('errors'):
+            print('{:<42} baseline recorded errors, not compared'.format(name))
+            continue
+        if 'error' in result or result.get('errors'):
+            print('{:<42} {}  <-- failed'.format(name, result.get('error') or '{} errors'.format(result['errors'])))
+            regressions.append(name)
+            continue
+        if name.split(' ')[-1].startswith('directory:') and not pool_comparable(baseline.get('machine')):
+            print('{:<42} pool case of a {} CPU baseline, not compared'.format(
+                name, (baseline.get('machine') or {}).get('cpu_count')))
+            continue
+        speed = result['files_per_sec'] / before['files_per_sec'] - 1 if before['files_per_sec'] else 0.0
+        p99 = result['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0.0
+        flag = ''
+        if speed < -tolerance:
+            flag = '  <-- slower'
+            regressions.append(name)
+        print('{:<42} files/sec {:+6.1%}  p99 {:+6.1%}  peak RSS {:+.1f} MB{}'.format(
+            name, speed, p99, result['peak_rss_mb'] - before['peak_rss_mb'], flag))
+    return regressions
+
+
+def pool_comparable(baseline_machine):
+    # Pool timings only mean something against a baseline with the same number of CPUs, and more than one
+    cpu_count = (baseline_machine or {}).get('cpu_count')
+    return cpu_count == os.cpu_count() and cpu_count > 1
+
+
+def save_results(results, baseline_path, settings):
+    # A case with errors would be no baseline to compare with, nor are pool timings on a single CPU
+    skipped = [name for name, result in results.items()
+               if 'error' in result or result.get('errors')
+               or (name.split(' ')[-1].startswith('directory:') and os.cpu_count() < 2)]
+    for name in skipped:
+        print('{:<42} not stored in the baseline'.format(name))
+    results = {name: result for name, result in results.items() if name not in skipped}
+    with open(baseline_path, 'w') as f:
+        json.dump({'machine': machine(), 'settings': settings, 'results': results}, f, indent=1, sort_keys=True)
+    print('Saved baseline to {}'.format(baseline_path))
+
+
+# Functions timed on inline XBRL filings as well, see kind_cases
+PARSE_FUNCTIONS = ['process_account', 'scrape_elements']
+benchmark_cases = ['process_account:bs4', 'process_account:lxml', 'scrape_elements:bs4', 'scrape_elements:lxml',
+                   'read_account_Data:bs4', 'read_account_Data:lxml', 'directory:lxml']
+# 'xml' for XBRL instances, 'html' for inline XBRL
+kinds = ['xml', 'html']
+num_files = 200
+repeat = 1
+# Pool size of the directory run, None for cpu_count()
+num_workers = None
+seed = 0
+# Shape of the synthetic filings, see synthetic_filings.generate_filing
+filing_settings = {'num_facts': 150, 'num_contexts': 12, 'num_dimensions': 1, 'negative_ratio': 0.05, 'num_units': 1}
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# True to overwrite the stored baselines with this run instead of comparing against them
+save_baseline = False
+# Relative drop in files/sec reported as a regression
+tolerance = 0.1
+
+# Number of filings per kind checked with check_targeted_rows, 0 to skip the check
+num_check_files = 50
+
+if __name__ == "__main__":
+    corpus_dir = tempfile.mkdtemp(prefix='account_benchmark_')
+    try:
+        for kind in (kinds if num_check_files else []):
+            check_files = synthetic_filings.generate_corpus(os.path.join(corpus_dir, 'check', kind), num_check_files, kind,
+                                                            seed, creditor_notes=True)
+            mismatches = check_targeted_rows(check_files)
+            print('{} {} filings: {} differ between a full and a targeted parse'.format(len(check_files), kind, len(mismatches)))
+            if mismatches:
+                print(mismatches[:5])
+                sys.exit(1)
+
+        if num_check_files:
+            problems = check_mixed_zip(os.path.join(corpus_dir, 'zip'), num_check_files // 5, seed)
+            print('Mixed .xml/.html ZIP: {}'.format('; '.join(problems) if problems else 'only the .xml members read'))
+            if problems:
+                sys.exit(1)
+
+        results = run_benchmarks(corpus_dir, benchmark_cases, kinds, num_files, repeat, num_workers, seed, **filing_settings)
+    finally:
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    settings = {'num_files': num_files, 'repeat': repeat, 'num_workers': num_workers, 'seed': seed,
+                'filings': filing_settings}
+    if save_baseline:
+        save_results(results, baseline_path, settings)
+    else:
+        regressions = compare_baseline(results, baseline_path, tolerance)
+        if regressions:
+            print('{} cases slower than the baseline'.format(len(regressions)))
+            sys.exit(1)
@@ -0,0 +1,156 @@
+'''
+
+Companies House Account Parse Cache
+
+On-disk cache of process_account output (the doc dict with its elements), keyed by a hash of the file's name and
+content and of the parser version. Rerunning the extraction over a month that has already been parsed then only pays
+for a hash and an unpickle per file. Only successful parses are cached, and an entry that cannot be read back is a
+miss. The cache is bounded in size: the parent process of a run trims it back under max_bytes once the run is done,
+removing the least recently used entries, so workers never walk the cache directory.
+
+'''
+
+import os
+import pickle
+import hashlib
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def module_version(module):
+    '''
+    Version of a parser module, taken from a hash of its source file so
+    that any change to the parser invalidates what it cached before.
+    '''
+    with open(module.__file__, 'rb') as source:
+        return hashlib.sha1(source.read()).hexdigest()[:16]
+
+
+def concepts_version(concepts):
+    '''
+    Suffix of the parser version for a parse restricted to a concept
+    whitelist, so that full and targeted parses are cached apart.
+    '''
+    if concepts is None:
+        return ''
+    return '-' + hashlib.sha1('|'.join(sorted(concepts)).encode()).hexdigest()[:12]
+
+
+class ParseCache:
+    '''
+    Content-addressed store of parsed docs.
+
+    Keyword arguments:
+    cache_dir -- directory of the cache, shared by all workers
+    max_bytes -- size the cache is trimmed back under by evict
+    '''
+
+    def __init__(self, cache_dir, max_bytes=20 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name, content, version):
+        digest = hashlib.sha256()
+        digest.update(version.encode())
+        digest.update(b'\0')
+        digest.update(os.path.basename(name).encode())
+        digest.update(b'\0')
+        digest.update(content)
+        key = digest.hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key[2:] + '.pkl')
+
+    def get(self, name, content, version):
+        path = self.path(name, content, version)
+        try:
+            with open(path, 'rb') as entry:
+                doc = pickle.load(entry)
+        except Exception:
+            # missing, or corrupt in any way (truncated, pickled by another version...), parsed again
+            self.misses += 1
+            return None
+
+        # the modification time doubles as last access for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return doc
+
+    def put(self, name, content, version, doc):
+        path = self.path(name, content, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as entry:
+            pickle.dump(doc, entry, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, path)
+
+    def evict(self):
+        '''
+        Remove least recently used entries until the cache is back under
+        90% of max_bytes. Walks the whole cache, so it is run once per run
+        by the parent rather than by the workers.
+        '''
+        entries = []
+        total = 0
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def parsed(doc):
+    # False for the results of a failed parse: 1 when the file could not be opened, an error or no elements
+    return isinstance(doc, dict) and 'Error' not in doc and isinstance(doc.get('elements'), list)
+
+
+def cached_parse(cache, name, content, version, parse_fn):
+    '''
+    Return the cached doc for this file, or parse it with parse_fn() and
+    cache the result if the parse succeeded. content is the raw bytes of
+    the file.
+    '''
+    if cache is None:
+        return parse_fn()
+
+    doc = cache.get(name, content, version)
+    if doc is None:
+        doc = parse_fn()
+        if parsed(doc):
+            cache.put(name, content, version, doc)
+    return doc
+
+
+def trim_cache(cache_dir, max_bytes):
+    # Parent side eviction at the end of a run, returns the number of entries removed
+    if not cache_dir or not os.path.isdir(cache_dir):
+        return 0
+    removed = ParseCache(cache_dir, max_bytes).evict()
+    if removed:
+        print('Removed {} least recently used entries from the parse cache {}'.format(removed, cache_dir))
+    return removed
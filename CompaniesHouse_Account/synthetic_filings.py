@@ -0,0 +1,237 @@
+'''
+
+Synthetic Companies House Account Filings
+
+Generate realistic-looking XBRL (.xml) and inline XBRL (.html) account files for benchmarking the parsers offline.
+Each filing has the entity facts the account scripts look for (name, balance sheet date, dormant flag, ...), a balance
+sheet for the current and previous year, and filler facts, with tunable numbers of facts, contexts, dimensions,
+negative values and units. File names follow the Accounts_Monthly_Data convention
+(Prod223_<run>_<company number>_<balance sheet date>.<ext>) that process_account relies on.
+
+'''
+
+import os
+import random
+import datetime
+
+
+NAMESPACES = {
+    'xbrli': 'http://www.xbrl.org/2003/instance',
+    'xbrldi': 'http://xbrl.org/2006/xbrldi',
+    'link': 'http://www.xbrl.org/2003/linkbase',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'iso4217': 'http://www.xbrl.org/2003/iso4217',
+    'core': 'http://xbrl.frc.org.uk/fr/2021-01-01/core',
+    'bus': 'http://xbrl.frc.org.uk/cd/2021-01-01/business',
+    'ix': 'http://www.xbrl.org/2013/inlineXBRL',
+    'ixt': 'http://www.xbrl.org/inlineXBRL/transformation/2020-02-12',
+}
+
+# balance sheet concepts read by account_processing_Ver_1 and xml_parser
+BALANCE_SHEET = ['FixedAssets', 'PropertyPlantEquipment', 'InvestmentsFixedAssets', 'Debtors', 'CashBankOnHand',
+                 'CurrentAssets', 'Creditors', 'Creditors', 'TotalAssetsLessCurrentLiabilities', 'NetAssetsLiabilities',
+                 'NetAssetsLiabilitiesIncludingPensionAssetLiability', 'Equity']
+
+FILLER = ['TurnoverRevenue', 'CostSales', 'GrossProfitLoss', 'AdministrativeExpenses', 'OperatingProfitLoss',
+          'ProfitLossOnOrdinaryActivitiesBeforeTax', 'TaxTaxCreditOnProfitOrLossOnOrdinaryActivities', 'ProfitLoss',
+          'AverageNumberEmployeesDuringPeriod', 'PrepaymentsAccruedIncome', 'TradeDebtorsTradeReceivables',
+          'TradeCreditorsTradePayables', 'AccruedLiabilitiesDeferredIncome', 'CalledUpShareCapital',
+          'RetainedEarningsAccumulatedLosses', 'IntangibleAssets', 'OtherDebtors', 'BankBorrowings']
+
+UNITS = [('GBP', 'iso4217:GBP'), ('EUR', 'iso4217:EUR'), ('USD', 'iso4217:USD'), ('shares', 'xbrli:shares'),
+         ('pure', 'xbrli:pure')]
+
+
+def filing_name(company_number, balance_sheet_date, ext, run=1):
+    return 'Prod223_{:04d}_{}_{}.{}'.format(run, company_number, balance_sheet_date.strftime('%Y%m%d'), ext)
+
+
+def make_contexts(rng, company_number, balance_sheet_date, num_contexts, num_dimensions):
+    '''
+    Instant and duration contexts for the current and prior years, plus
+    extra dimensioned contexts. Returns a list of context dicts.
+    '''
+    contexts = []
+    for years_back in range(2):
+        end = balance_sheet_date.replace(year=balance_sheet_date.year - years_back)
+        start = end.replace(year=end.year - 1) + datetime.timedelta(days=1)
+        contexts.append({'id': 'i{}'.format(end.isoformat()), 'instant': end, 'members': []})
+        contexts.append({'id': 'd{}'.format(end.isoformat()), 'start': start, 'end': end, 'members': []})
+
+    for i in range(max(0, num_contexts - len(contexts))):
+        base = rng.choice(contexts[:4])
+        members = ['bus:Director{}'.format(rng.randint(1, 9)) for j in range(rng.randint(1, max(1, num_dimensions)))]
+        context = dict(base, id='c{}_{}'.format(i, base['id']), members=members if num_dimensions else [])
+        contexts.append(context)
+
+    return contexts
+
+
+def make_facts(rng, company_name, balance_sheet_date, contexts, num_facts, negative_ratio, units, creditor_notes=False):
+    '''
+    Facts as (concept, context, unit, value, sign) tuples. Text facts have
+    no unit, and a few dimensioned facts are left empty so that their value
+    comes from the context's explicit member. With creditor_notes the
+    balance sheet only has the creditors falling due within one year,
+    those falling due after more than one year come in a note after
+    filler facts, as in real filings.
+    '''
+    instant = [context for context in contexts[:4] if 'instant' in context]
+    duration = [context for context in contexts[:4] if 'instant' not in context]
+    dimensioned = [context for context in contexts if context['members']]
+
+    facts = [
+        ('bus:EntityCurrentLegalOrRegisteredName', duration[0], None, company_name, None),
+        ('bus:EntityCurrentLegalName', duration[0], None, company_name, None),
+        ('bus:BalanceSheetDate', duration[0], None, balance_sheet_date.isoformat(), None),
+        ('bus:EntityDormantTruefalse', duration[0], None, rng.choice(['false', 'true']), None),
+        ('bus:CompanyDormant', duration[0], None, rng.choice(['false', 'true']), None),
+        ('bus:CompanyEntitledToExemptionUnderSection480CompaniesAct2006', duration[0], None, 'true', None),
+    ]
+    balance_sheet = BALANCE_SHEET
+    if creditor_notes:
+        balance_sheet = [concept for i, concept in enumerate(BALANCE_SHEET) if i != BALANCE_SHEET.index('Creditors') + 1]
+    for context in instant:
+        for concept in balance_sheet:
+            value = rng.randint(0, 5000000)
+            sign = '-' if rng.random() < negative_ratio else None
+            facts.append(('core:' + concept, context, units[0][0], value, sign))
+
+    if creditor_notes:
+        for i in range(20):
+            facts.append(('core:' + rng.choice(FILLER), rng.choice(contexts), units[0][0], rng.randint(0, 5000000), None))
+        for context in instant:
+            facts.append(('core:Creditors', context, units[0][0], rng.randint(0, 5000000), None))
+
+    while len(facts) < num_facts:
+        if dimensioned and rng.random() < 0.1:
+            facts.append(('bus:NameEntityOfficer', rng.choice(dimensioned), None, '', None))
+            continue
+        context = rng.choice(contexts)
+        unit = rng.choice(units)[0]
+        sign = '-' if rng.random() < negative_ratio else None
+        facts.append(('core:' + rng.choice(FILLER), context, unit, rng.randint(0, 5000000), sign))
+
+    return facts
+
+
+def context_xml(context):
+    segment = ''
+    if context['members']:
+        segment = '<xbrli:segment>{}</xbrli:segment>'.format(''.join(
+            '<xbrldi:explicitMember dimension="bus:EntityOfficersDimension">{}</xbrldi:explicitMember>'.format(member)
+            for member in context['members']))
+    if 'instant' in context:
+        period = '<xbrli:instant>{}</xbrli:instant>'.format(context['instant'].isoformat())
+    else:
+        period = '<xbrli:startDate>{}</xbrli:startDate><xbrli:endDate>{}</xbrli:endDate>'.format(
+            context['start'].isoformat(), context['end'].isoformat())
+    return ('<xbrli:context id="{}"><xbrli:entity><xbrli:identifier scheme="http://www.companieshouse.gov.uk/">'
+            'ENTITY</xbrli:identifier>{}</xbrli:entity><xbrli:period>{}</xbrli:period></xbrli:context>').format(
+                context['id'], segment, period)
+
+
+def unit_xml(unit_id, measure):
+    return '<xbrli:unit id="{}"><xbrli:measure>{}</xbrli:measure></xbrli:unit>'.format(unit_id, measure)
+
+
+def xbrl_document(contexts, facts, units):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<xbrli:xbrl {}>'.format(' '.join('xmlns:{}="{}"'.format(prefix, uri) for prefix, uri in NAMESPACES.items()
+                                               if prefix not in ('ix', 'ixt')))]
+    lines.extend(context_xml(context) for context in contexts)
+    lines.extend(unit_xml(unit_id, measure) for unit_id, measure in units)
+    for concept, context, unit, value, sign in facts:
+        attrs = 'contextRef="{}"'.format(context['id'])
+        if unit is not None:
+            attrs += ' unitRef="{}" decimals="0"'.format(unit)
+            value = '{:,}'.format(value)
+        if sign:
+            attrs += ' sign="{}"'.format(sign)
+        lines.append('<{0} {1}>{2}</{0}>'.format(concept, attrs, value))
+    lines.append('</xbrli:xbrl>')
+    return '\n'.join(lines)
+
+
+def ixbrl_document(company_name, contexts, facts, units):
+    hidden = []
+    body = []
+    for concept, context, unit, value, sign in facts:
+        if unit is None:
+            fact = '<ix:nonNumeric name="{}" contextRef="{}">{}</ix:nonNumeric>'.format(concept, context['id'], value)
+            (hidden if value == '' else body).append(fact)
+            continue
+        attrs = 'name="{}" contextRef="{}" unitRef="{}" decimals="0" format="ixt:num-dot-decimal"'.format(
+            concept, context['id'], unit)
+        if sign:
+            attrs += ' sign="{}"'.format(sign)
+        body.append('<tr><td>{}</td><td><ix:nonFraction {}>{:,}</ix:nonFraction></td></tr>'.format(
+            concept.split(':')[-1], attrs, value))
+
+    return '\n'.join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<html {}>'.format(' '.join('xmlns:{}="{}"'.format(prefix, uri) for prefix, uri in NAMESPACES.items())
+                           + ' xmlns="http://www.w3.org/1999/xhtml"'),
+        '<head><title>{}</title><style>td {{ padding: 2px; }}</style></head>'.format(company_name),
+        '<body><div style="display:none"><ix:header><ix:hidden>{}</ix:hidden><ix:resources>{}{}</ix:resources>'
+        '</ix:header></div>'.format(''.join(hidden), ''.join(context_xml(context) for context in contexts),
+                                    ''.join(unit_xml(unit_id, measure) for unit_id, measure in units)),
+        '<h1>{}</h1><p>Annual report and unaudited financial statements</p>'.format(company_name),
+        '<table>{}</table>'.format('\n'.join(body)),
+        '</body></html>'])
+
+
+def generate_filing(output_dir, seed, kind='xml', num_facts=150, num_contexts=12, num_dimensions=1,
+                    negative_ratio=0.05, num_units=1, creditor_notes=False):
+    '''
+    Write one synthetic filing and return its path.
+
+    Keyword arguments:
+    output_dir -- directory the filing is written to
+    seed -- seed of the filing, also used for its company number
+    kind -- 'xml' for an XBRL instance, 'html' for inline XBRL
+    num_facts -- total number of facts in the filing
+    num_contexts -- number of contexts, at least the four year contexts
+    num_dimensions -- explicit members per dimensioned context
+    negative_ratio -- share of numeric facts with sign="-"
+    num_units -- number of units (GBP, EUR, USD, shares, pure) used
+    creditor_notes -- move the creditors due after more than one year to a
+                      note after the balance sheet
+    '''
+    rng = random.Random(seed)
+    company_number = '{:08d}'.format(seed % 10**8)
+    company_name = 'SYNTHETIC {} LIMITED'.format(seed)
+    balance_sheet_date = datetime.date(rng.randint(2018, 2022), rng.choice([3, 6, 12]), rng.choice([28, 30]) - 2)
+    units = UNITS[:max(1, num_units)]
+
+    contexts = make_contexts(rng, company_number, balance_sheet_date, num_contexts, num_dimensions)
+    facts = make_facts(rng, company_name, balance_sheet_date, contexts, num_facts, negative_ratio, units, creditor_notes)
+
+    if kind == 'html':
+        document = ixbrl_document(company_name, contexts, facts, units)
+    else:
+        document = xbrl_document(contexts, facts, units)
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, filing_name(company_number, balance_sheet_date, kind))
+    with open(path, 'w') as filing:
+        filing.write(document)
+    return path
+
+
+def generate_corpus(output_dir, num_files, kind='xml', seed=0, **filing_kwargs):
+    '''
+    Write num_files synthetic filings of varying size and return their
+    paths. The number of facts and contexts of each filing is drawn around
+    the values given, so the corpus has small and large filings.
+    '''
+    rng = random.Random(seed)
+    num_facts = filing_kwargs.pop('num_facts', 150)
+    num_contexts = filing_kwargs.pop('num_contexts', 12)
+    paths = []
+    for i in range(num_files):
+        paths.append(generate_filing(output_dir, seed * 10**6 + i + 1, kind,
+                                     num_facts=max(40, int(rng.lognormvariate(0, 0.6) * num_facts)),
+                                     num_contexts=max(4, int(rng.lognormvariate(0, 0.4) * num_contexts)),
+                                     **filing_kwargs))
+    return paths
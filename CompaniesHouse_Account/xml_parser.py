@@ -8,28 +8,27 @@ XML Parser
 Contain functions to clean and collect xml file data from Companies House Account Data Files. Returns four dataframes for year 2018,2019,2020,2021. 
 '''
 
-import os
-import re
-import glob
-import os
-from tqdm import tqdm
-import httpx
-import datetime
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import json
-from datetime import datetime
+import io
+import sys
+from datetime import datetime, date
 from dateutil import parser
-from bs4 import BeautifulSoup as BS 
 import multiprocessing
-import concurrent.futures
+import functools
+from lxml import etree
+import zip_reader
+import account_cli
+import account_pipeline
+import account_manifest
+import account_metrics
+import parse_cache
 
 
-def mapping(date): 
-    avail_year = set(['2018', '2019', '2020', '2021'])
+# Fiscal years read_account_Data splits out, the fact table (read_account_facts) keeps every year
+avail_years = set(['2018', '2019', '2020', '2021'])
+
+def mapping(date, avail_year=avail_years): 
     year = date.split('-')[0]
-    if year not in avail_year: 
+    if avail_year is not None and year not in avail_year: 
         year = 'before'
     return year
 
@@ -52,25 +51,147 @@ def clean_value(string):
 	return(string)
 
 
-def retrieve_unit(soup, element): 
+def index_context(context_id, children, contexts): 
+	"""
+	Add one xbrli:context to the context index. Engine agnostic, children
+	is an iterable of (local tag name, text) pairs for the context's
+	descendants.
+	"""
+	entry = {'instant': None, 'start': None, 'end': None, 'members': []}
+	for tag, text in children: 
+		if tag == "instant": 
+			entry['instant'] = parse_period_date(text)
+		elif tag == "startDate": 
+			entry['start'] = parse_period_date(text)
+		elif tag == "endDate": 
+			entry['end'] = parse_period_date(text)
+		elif tag == "explicitMember": 
+			entry['members'].append((text or "").split(":")[-1].strip())
+
+	entry['date'] = entry['instant'] or entry['end'] or "NA"
+	contexts[context_id] = entry
+
+def index_unit(unit_id, children, units): 
+	"""
+	Add one xbrli:unit to the unit index as unit id -> measure, divided
+	units are stored as numerator/denominator.
+	"""
+	measures = [(text or "").split(":")[-1].strip() for tag, text in children if tag == "measure"]
+	units[unit_id] = "/".join(measures) or unit_id
+
+def bs4_children(element): 
+	return([(child.name.split(":")[-1], child.get_text()) for child in element.find_all()])
+
+def build_context_index(element_set, referenced=None): 
+	"""
+	Single pre-pass over the document's elements collecting every context
+	and unit, so facts can be resolved with dict lookups instead of a
+	soup.find() per fact. If referenced is given, only the contexts and
+	units whose id is in it are indexed.
+
+	Returns (contexts, units)
+	"""
+	contexts = {}
+	units = {}
+	for each in element_set: 
+		tag = each.name.split(":")[-1]
+		if tag != "context" and tag != "unit": 
+			continue
+		if referenced is not None and each.attrs.get('id') not in referenced: 
+			continue
+		if tag == "context": 
+			index_context(each.attrs.get('id'), bs4_children(each), contexts)
+		else: 
+			index_unit(each.attrs.get('id'), bs4_children(each), units)
+
+	return(contexts, units)
+
+def fact_name(tag, name=None, inline_names=False): 
+	"""
+	Lower case local name of a fact. Inline XBRL facts (ix:nonFraction,
+	ix:nonNumeric) carry their concept in the name attribute, which is
+	only used instead of the tag when inline_names is set. Shared by both
+	parse engines so that they name the facts of a file the same way.
+	"""
+	if inline_names and name is not None: 
+		tag = name
+	return(tag.lower().split(":")[-1])
+
+def concept_name(element, inline_names=False): 
+	return(fact_name(element.name, element.attrs.get('name'), inline_names))
+
+def select_facts(element_set, concepts, inline_names=False): 
+	"""
+	Facts of the document whose concept is in the concepts whitelist, their
+	positions among all the facts of the document, and the set of context
+	and unit ids they refer to.
+	"""
+	facts = []
+	positions = []
+	referenced = set()
+	position = -1
+	for each in element_set: 
+		if "contextRef" not in each.attrs: 
+			continue
+		position += 1
+		if concept_name(each, inline_names) in concepts: 
+			facts.append(each)
+			positions.append(position)
+			referenced.add(each.attrs['contextRef'])
+			if 'unitRef' in each.attrs: 
+				referenced.add(each.attrs['unitRef'].strip())
+	return(facts, positions, referenced)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_period_date(text): 
+	try:
+		return(date.fromisoformat(text.strip()).isoformat())
+	except: 
+		pass
+
+	try:
+		return(parser.parse(text).date().isoformat())
+	except: 
+		pass
+
+	return(None)
+
+@functools.lru_cache(maxsize=65536)
+def parse_context_date(contextref): 
+	try:
+		date = parser.parse(contextref[1:]).date().isoformat()
+		return(date)
+	except: 
+		pass
+
+	return("NA")
+
+
+def retrieve_unit(soup, element, units=None): 
 	try: 
 		unit_str = element.attrs['unitRef']
 	except:
 		return("NA")
 
+	if units is not None: 
+		return(units.get(unit_str.strip(), unit_str.strip()))
+
 	return(unit_str.strip())
 
-def retrieve_date(soup, element): 
+def retrieve_date(soup, element, contexts=None): 
 	try:
-		date_info = element.attrs['contextRef'][1:]
-		date = parser.parse(date_info).date().isoformat()
-		return(date)
+		contextref = element.attrs['contextRef']
 	except: 
-		pass
+		return("NA")
 
-	return("NA")
+	# the real xbrli:period wins, the id itself is only a fallback
+	if contexts is not None and contextref in contexts and contexts[contextref]['date'] != "NA": 
+		return(contexts[contextref]['date'])
 
-def retrieve_from_context(soup, contextref):
+	return(parse_context_date(contextref))
+
+def retrieve_from_context(soup, contextref, contexts=None):
 	"""
 	Used where an element of the document contained no data, only a
 	reference to a context element.
@@ -81,18 +202,24 @@ def retrieve_from_context(soup, contextref):
 	Keyword arguments:
 	soup -- BeautifulSoup souped html/xml object
 	contextref -- the id of the context element to be raided
+	contexts -- optional context index from build_context_index
 	"""
-	
+	if contexts is not None: 
+		try: 
+			return(contexts[contextref]['members'][0])
+		except: 
+			return("")
+
 	try:
 		context = soup.find("xbrli:context", id=contextref)
-		contents = context.find("xbrldi:explicitmember").get_text().split(":")[-1].strip()
+		contents = context.find("xbrldi:explicitMember").get_text().split(":")[-1].strip()
 		
 	except:
 		contents = ""
 	
 	return(contents)
 
-def parse_element(soup, element):
+def parse_element(soup, element, contexts=None, units=None, inline_names=False):
 
 	# Only taking relevant blocks
 	if "contextRef" not in element.attrs: 
@@ -103,22 +230,32 @@ def parse_element(soup, element):
 
 	# parse name block
 	try: 
-		element_dict['name'] = element.name.lower().split(":")[-1]
+		element_dict['name'] = concept_name(element, inline_names)
 	except: 
 		pass
 
 	element_dict['value'] = element.get_text()
-	element_dict['unit'] = retrieve_unit(soup, element)
-	element_dict['date'] = retrieve_date(soup, element)
+	element_dict['unit'] = retrieve_unit(soup, element, units)
+	element_dict['date'] = retrieve_date(soup, element, contexts)
 
 	if element_dict['value'] == "":
-		element_dict['value'] = retrieve_from_context(soup, element.attrs['contextref'])
+		element_dict['value'] = retrieve_from_context(soup, element.attrs['contextRef'], contexts)
+
+	return(clean_element(element_dict, element.attrs.get('sign')))
 
+def clean_element(element_dict, sign=None):
+	"""
+	Convert the value of a parsed element to numeric where it carries a
+	unit and apply its sign attribute. Shared by both parse engines.
+	"""
 	if element_dict['unit'] != "NA":
 		element_dict['value'] = clean_value(element_dict['value'])
 
+	if sign is None: 
+		return(element_dict)
+
 	try:
-		element_dict['sign'] = element.attrs['sign']
+		element_dict['sign'] = sign
 		
 		# if it's negative, convert the value then and there
 		if element_dict['sign'].strip() == "-":
@@ -126,32 +263,199 @@ def parse_element(soup, element):
 	except:
 		pass
 
-
 	return(element_dict)
 
-def parse_elements(element_set, soup): 
+def parse_elements(element_set, soup, contexts=None, units=None, inline_names=False, positions=None): 
 	elements = []
-	for each in element_set: 
-		element_dict = parse_element(soup, each)
+	for i, each in enumerate(element_set): 
+		element_dict = parse_element(soup, each, contexts, units, inline_names)
 		if 'name' in element_dict: 
+			if positions is not None: 
+				element_dict['pos'] = positions[i]
 			elements.append(element_dict)
 	return(elements)
 
-def scrape_elements(soup, filepath): 
+def scrape_elements(soup, filepath, concepts=None, inline_names=False): 
+	"""
+	Parse every fact of the soup into an element dict. With a concepts
+	whitelist (lower case local names) only the facts of those concepts,
+	and the contexts and units they refer to, are parsed, and a file only
+	fails when none of them is found. Their element dicts then carry their
+	position among all the facts of the document in 'pos', as the list
+	index of a full parse would be. See fact_name for inline_names.
+	"""
 	try: 
 		element_set = soup.find_all()
-		elements = parse_elements(element_set, soup)
-		if len(elements) <= 5: 
+		if concepts is None: 
+			contexts, units = build_context_index(element_set)
+			elements = parse_elements(element_set, soup, contexts, units, inline_names)
+		else: 
+			facts, positions, referenced = select_facts(element_set, concepts, inline_names)
+			contexts, units = build_context_index(element_set, referenced)
+			elements = parse_elements(facts, soup, contexts, units, inline_names, positions)
+		if len(elements) <= (5 if concepts is None else 0): 
+			account_metrics.outcome('too_few_elements')
 			raise Exception("Elements should be gte 5, was {}".format(len(elements)))
 		return(elements)
-	except: 
-		pass 
+	except Exception as e: 
+		account_metrics.failure('scrape', e)
 
 	return(0)
 
 
+def iterparse_element(element, tag, inline_names=False): 
+	"""
+	lxml counterpart of parse_element. Only reads the name and text, the
+	context and unit are resolved once the whole document has been indexed.
+	"""
+	element_dict = {}
+	element_dict['name'] = fact_name(tag, element.get('name'), inline_names)
+
+	if len(element): 
+		element_dict['value'] = "".join(element.itertext())
+	else: 
+		element_dict['value'] = element.text or ""
+
+	return(element_dict)
+
+def resolve_element(element_dict, contextref, unitref, sign, contexts, units): 
+	context = contexts.get(contextref)
 
-def process_account(filepath):
+	if unitref is None: 
+		element_dict['unit'] = "NA"
+	else: 
+		element_dict['unit'] = units.get(unitref.strip(), unitref.strip())
+
+	if context is not None and context['date'] != "NA": 
+		element_dict['date'] = context['date']
+	else: 
+		element_dict['date'] = parse_context_date(contextref)
+
+	if element_dict['value'] == "": 
+		if context is not None and context['members']: 
+			element_dict['value'] = context['members'][0]
+
+	return(clean_element(element_dict, sign))
+
+def lxml_children(element): 
+	return([(child.tag.rsplit("}", 1)[-1], child.text) for child in element.iter() if child is not element and isinstance(child.tag, str)])
+
+def iterparse_elements(source, concepts=None, inline_names=False): 
+	"""
+	Streaming alternative to soup.find_all() followed by parse_elements.
+	Walks the document with lxml iterparse and clears every node once it
+	has been read, so memory stays flat whatever the size of the document.
+	Contexts and units are indexed on the way through and facts resolved
+	against them at the end, as they are not guaranteed to come first.
+	
+	Returns a list of element dicts in document order
+	
+	Keyword arguments:
+	source -- path or binary file object of the xml/xhtml document
+	concepts -- optional whitelist of lower case concept names, facts of
+	            other concepts are skipped without being read, and only
+	            the contexts the kept facts refer to get their dates parsed.
+	            The kept facts carry their position among all the facts of
+	            the document in 'pos'
+	inline_names -- name inline XBRL facts by their concept, see fact_name
+	"""
+	elements = []
+	references = []
+	contexts = {}
+	units = {}
+	# raw (tag, text) children of the contexts, indexed once the references are known
+	raw_contexts = {}
+	open_facts = []
+	held = 0
+	# position of the last fact started, counting the facts skipped for concepts
+	position = -1
+
+	for event, element in etree.iterparse(source, events=("start", "end"), recover=True, huge_tree=True): 
+		if not isinstance(element.tag, str): 
+			continue
+		tag = element.tag.rsplit("}", 1)[-1]
+		is_fact = "contextRef" in element.attrib
+		if is_fact and event == "start": 
+			position += 1
+		if is_fact and concepts is not None: 
+			is_fact = fact_name(tag, element.get('name'), inline_names) in concepts
+
+		# reserve a slot on the way in so nested facts keep document order,
+		# and hold the subtree until the fact, context or unit has been read
+		if event == "start": 
+			if is_fact: 
+				open_facts.append(len(elements))
+				elements.append(position)
+				references.append(None)
+				held += 1
+			elif tag == "context" or tag == "unit": 
+				held += 1
+			continue
+
+		if is_fact: 
+			held -= 1
+			slot = open_facts.pop()
+			fact_position = elements[slot]
+			elements[slot] = iterparse_element(element, tag, inline_names)
+			if concepts is not None: 
+				elements[slot]['pos'] = fact_position
+			references[slot] = (element.get('contextRef'), element.get('unitRef'), element.get('sign'))
+		elif tag == "context": 
+			held -= 1
+			if concepts is None: 
+				index_context(element.get('id'), lxml_children(element), contexts)
+			else: 
+				raw_contexts[element.get('id')] = lxml_children(element)
+		elif tag == "unit": 
+			held -= 1
+			index_unit(element.get('id'), lxml_children(element), units)
+
+		if held == 0: 
+			element.clear()
+			while element.getprevious() is not None: 
+				del element.getparent()[0]
+
+	for contextref in set(contextref for contextref, unitref, sign in references): 
+		if contextref in raw_contexts: 
+			index_context(contextref, raw_contexts[contextref], contexts)
+
+	for element_dict, (contextref, unitref, sign) in zip(elements, references): 
+		resolve_element(element_dict, contextref, unitref, sign, contexts, units)
+
+	return(elements)
+
+def scrape_elements_lxml(source, filepath, concepts=None, inline_names=False): 
+	try: 
+		elements = iterparse_elements(source, concepts, inline_names)
+		if len(elements) <= (5 if concepts is None else 0): 
+			account_metrics.outcome('too_few_elements')
+			raise Exception("Elements should be gte 5, was {}".format(len(elements)))
+		return(elements)
+	except Exception as e: 
+		account_metrics.failure('scrape', e)
+
+	return(0)
+
+
+@account_metrics.instrument_file
+def process_account(filepath, engine='bs4', content=None, concepts=None, inline_names=False):
+	"""
+	Parse a single account file into a doc dict.
+
+	Keyword arguments:
+	filepath -- path to the xml/xhtml account file, or its member name
+	            when content is given
+	engine -- 'bs4' builds a full BeautifulSoup tree, 'lxml' streams the
+	          document with iterparse and is several times faster
+	content -- raw bytes of the file, e.g. read straight from a monthly
+	           ZIP archive, in which case nothing is opened from disk
+	concepts -- optional whitelist of lower case concept names, only
+	            the facts of these concepts end up in doc['elements']
+	inline_names -- name inline XBRL (.html) facts by the concept in their
+	                name attribute, as xbrl_parser does, rather than by
+	                their ix:nonFraction/ix:nonNumeric tag. Both engines
+	                give the same names either way
+	"""
 	doc = {}
 	doc['doc_name'] = filepath.split("/")[-1]
 	doc['doc_type'] = filepath.split(".")[-1].lower()
@@ -161,30 +465,110 @@ def process_account(filepath):
 
 	doc['doc_companieshouseregisterednumber'] = filepath.split("/")[-1].split(".")[0].split("_")[-2]
 
+	if engine == 'lxml': 
+		try: 
+			with account_metrics.stage('open'): 
+				source = open(filepath, 'rb') if content is None else io.BytesIO(content)
+		except Exception as e: 
+			account_metrics.failure('open', e)
+			print("Failed to open" + filepath)
+			return(1)
+
+		with source: 
+			try: 
+				# iterparse parses and scrapes in one pass
+				with account_metrics.stage('scrape'): 
+					doc['elements'] = scrape_elements_lxml(source, filepath, concepts, inline_names)
+			except Exception as e:
+				account_metrics.failure('scrape', e)
+				doc['Error'] = e
+
+		account_metrics.count_elements(doc.get('elements'))
+		return(doc)
+
+	# imported here so that lxml workers never load bs4
+	from bs4 import BeautifulSoup as BS 
+
 	try: 
-		soup = BS(open(filepath, 'r'), 'xml')
-	except: 
+		with account_metrics.stage('open'): 
+			source = open(filepath, 'r') if content is None else content
+		with account_metrics.stage('parse'): 
+			soup = BS(source, 'xml')
+	except Exception as e: 
+		account_metrics.failure('open' if isinstance(e, OSError) else 'parse', e)
 		print("Failed to open" + filepath)
 		return(1)
 
 	try: 
-		doc['elements'] = scrape_elements(soup, filepath)
+		with account_metrics.stage('scrape'): 
+			doc['elements'] = scrape_elements(soup, filepath, concepts, inline_names)
 	except Exception as e:
+		account_metrics.failure('scrape', e)
 		doc['Error'] = e
+	account_metrics.count_elements(doc.get('elements'))
 
 	try: 
 		return(doc)
 	except Exception as e: 
 		return(e)
 
-def read_account_Data(file): 
+# Cache of parsed files keyed by their content and the parser version, None to turn it off
+cache_dir = 'account_xml_parse_cache'
+cache_max_gb = 20
+parse_cache_store = None
+
+def worker_cache(): 
+    global parse_cache_store
+    if parse_cache_store is None and cache_dir: 
+        parse_cache_store = parse_cache.ParseCache(cache_dir, cache_max_gb * 2**30)
+    return parse_cache_store
+
+# Settings read inside the workers. 'spawn' and 'forkserver' workers import this script afresh and only see its
+# defaults, so init_worker hands them the values of the run (parse_engine and targeted are bound into the read function)
+WORKER_SETTINGS = ['cache_dir', 'cache_max_gb']
+
+def worker_settings(): 
+    return {name: globals()[name] for name in WORKER_SETTINGS}
+
+def init_worker(settings=None): 
+    globals().update(settings or {})
+
+def parse_account(file, engine='bs4', content=None, concepts=None): 
+    """
+    process_account through the parse cache, so rerunning the extraction
+    over files that have not changed skips the xml parse.
+    """
+    cache = worker_cache()
+    if cache is None: 
+        return process_account(file, engine=engine, content=content, concepts=concepts)
+
+    if content is None: 
+        with open(file, 'rb') as f: 
+            content = f.read()
+    version = parse_cache.module_version(sys.modules[__name__]) + engine + parse_cache.concepts_version(concepts)
+    return parse_cache.cached_parse(cache, file, content, version, 
+                                    lambda: process_account(file, engine=engine, content=content, concepts=concepts))
+
+# The only concepts read_account_Data looks at, parsed on their own when targeted is set
+account_concepts = frozenset(['entitycurrentlegalname', 'balancesheetdate', 'netassetsliabilitiesincludingpensionassetliability', 
+                              'companydormant', 'companyentitledtoexemptionundersection480companiesact2006'])
+
+@account_metrics.instrument_file
+def read_account_Data(file, engine='bs4', content=None, concepts=None): 
+    doc = parse_account(file, engine=engine, content=content, concepts=concepts)
+    with account_metrics.stage('extract'): 
+        rows = extract_account_data(doc, file)
+    if not any(rows): 
+        account_metrics.outcome('no_fiscal_year')
+    return rows
+
+def extract_account_data(doc, file): 
+    import pandas as pd
     account_data_2021 = {}
     account_data_2020 = {}
     account_data_2019 = {}
     account_data_2018 = {}
 
-    # try getting the first file (an XML, or XBRL, file)
-    doc = process_account(file)
     # print(doc['elements'])
 
     # display for fun
@@ -283,50 +667,216 @@ def read_account_Data(file):
     return [account_data_2018, account_data_2019, account_data_2020, account_data_2021]
     
 
-# Please Change the directory here! 
-files_1 = glob.glob('Accounts_Monthly_Data-January2022/*.xml')
-files_2 = glob.glob('Accounts_Monthly_Data-February2022/*.xml')
-files_4 = glob.glob('Accounts_Monthly_Data-April2022/*.xml')
-files = files_1
-files.extend(files_2)
-files.extend(files_4)
-files = list(set(files))
-final_2021 = []
-final_2020 = []
-final_2019 = []
-final_2018 = []
+@account_metrics.instrument_file
+def read_account_facts(file, engine='bs4', content=None): 
+    """
+    Parse a file into the long fact table of account_facts, keeping every
+    fact for every year rather than the handful read_account_Data picks.
+    """
+    import account_facts
+    doc = parse_account(file, engine=engine, content=content)
+    with account_metrics.stage('extract'): 
+        return account_facts.doc_facts(doc)
+
+# Pivot of the fact table that gives the same per-year tables as read_account_Data
+fact_concepts = {'netassetsliabilitiesincludingpensionassetliability': 'totalassetslesscurrentliabilities'}
+fact_static = {'entitycurrentlegalname': 'CompanyName', 
+               'companydormant': 'CompanyDormant', 
+               'companyentitledtoexemptionundersection480companiesact2006': 'section_480'}
+year_columns = ['CompanyNumber', 'CompanyName', 'totalassetslesscurrentliabilities', 'CompanyDormant', 'section_480']
+
+def fact_year_frames(facts): 
+    """
+    Per-year tables of read_account_Data pivoted out of a fact table, for
+    every fiscal year found, with its column order and 'no_name' for
+    filings without a company name.
+    """
+    import account_facts
+    frames = account_facts.pivot_fiscal_years(facts, fact_concepts, static=fact_static, 
+                                              required='totalassetslesscurrentliabilities', keep='first')
+    for year, df in frames.items(): 
+        df['CompanyName'] = df['CompanyName'].fillna('no_name')
+        frames[year] = df[year_columns]
+    return frames
+
+# Set from the command line, e.g. 
+#   python xml_parser.py --months 2022-01 2022-02 2022-04
+#   python xml_parser.py 'Accounts_Monthly_Data-April2022/*.xml' --source-month 2022-04
+# or the monthly ZIPs directly without extracting them: python xml_parser.py Accounts_Monthly_Data-April2022.zip
+# Nothing is globbed at import, so spawned workers start straight away
+files = []
+zip_files = []
+# Files read from directories and ZIP archives. The iXBRL .html filings are account_processing_Ver_1's
+ACCOUNT_SUFFIXES = ('.xml',)
 account_before_2018 = []
 no_name_companies = []
 
 num_workers = multiprocessing.cpu_count()
-def main():
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
-        
-        results = executor.map(read_account_Data, files)
-
-    return results
-
-if __name__ == "__main__":
-    print('Start Scraping Account Data')
+# Pool start method, None for the platform default ('fork' on Linux). Under 'forkserver' the parser and pandas are
+# imported once in the server and workers start in milliseconds, under 'spawn' every worker imports them itself.
+# pandas, pyarrow and bs4 are only imported where they are used, so this script itself loads in a few milliseconds
+start_method = None
+preload = ['xml_parser', 'pandas']
+# 'lxml' streams each file with iterparse, 'bs4' is the original BeautifulSoup parser
+parse_engine = 'lxml'
+# 'parquet' appends this month to a dataset partitioned by fiscal year and source month, 'csv' writes one file per year
+output_format = 'parquet'
+output_dir = 'account_xml_parquet'
+source_month = '2022-04'
+# 'years' for the 2018-2021 tables only, 'facts' also keeps every parsed fact in fact_dir and pivots all years out of it
+output_mode = 'facts'
+fact_dir = 'account_xml_facts'
+# Number of files sent to a worker at a time, raise it for 1M+ file months
+chunksize = 64
+# Time every stage of every file and print a report of slow and failed files at the end, saved to metrics_path
+report_metrics = True
+metrics_path = 'account_xml_run_report_{source_month}.json'
+run_metrics = None
+# Only parse account_concepts in 'years' mode, skipping every other fact of the file
+targeted = True
+
+def account_read_fn(): 
+    if output_mode == 'facts': 
+        return functools.partial(read_account_facts, engine=parse_engine)
+    return functools.partial(read_account_Data, engine=parse_engine, concepts=account_concepts if targeted else None)
 
+def main():
+    read_fn = account_read_fn()
+
+    if zip_files: 
+        return zip_reader.process_zip_archives(zip_files, read_fn, num_workers, batch_size=chunksize, suffixes=ACCOUNT_SUFFIXES, 
+                                               initializer=init_worker, initargs=(worker_settings(),), metrics=run_metrics, 
+                                               start_method=start_method, preload=preload)
+
+    return account_pipeline.run_pipeline(files, read_fn, num_workers, chunksize, initializer=init_worker, 
+                                         initargs=(worker_settings(),), metrics=run_metrics, 
+                                         start_method=start_method, preload=preload)
+
+# Skip files already recorded in output_dir/_manifest.jsonl and checkpoint every checkpoint_every files,
+# so a crashed run or a newly added month only parses what is new (parquet output only)
+resume = True
+checkpoint_every = 5000
+# Files that failed are recorded in the manifest and skipped by later runs, True to parse them again
+retry_failed = False
+
+def chunk_frames(results): 
+    """
+    Turn the results of a chunk of files into (fact table or None, dict of
+    fiscal year -> DataFrame). Every filing is pivoted on its own, so
+    chunks give the same rows as the whole month at once.
+    """
+    import pandas as pd
+    import account_facts
+    if output_mode == 'facts': 
+        facts = account_facts.concat_facts(results)
+        return facts, fact_year_frames(facts)
+    return None, {int(year): pd.DataFrame([r[i] for r in results if r[i]]) for i, year in enumerate(sorted(avail_years))}
+
+def write_checkpoint(results, part): 
+    import account_writer
+    facts, frames = chunk_frames(results)
+    if facts is not None: 
+        account_writer.write_fact_parquet(facts, fact_dir, source_month, part=part)
+    account_writer.write_account_parquet(frames, output_dir, source_month, part=part)
+
+def resume_main(): 
+    read_fn = account_read_fn()
+
+    if zip_files: 
+        keyed_files = zip_reader.iter_zip_member_keys(zip_files, ACCOUNT_SUFFIXES)
+        read_fn, batched = functools.partial(zip_reader.read_zip_batch, read_fn=read_fn), True
+    else: 
+        keyed_files = ((account_manifest.file_key(file), file) for file in files)
+        batched = False
+
+    output_dirs = [output_dir, fact_dir] if output_mode == 'facts' else [output_dir]
+    return account_manifest.run_incremental(keyed_files, read_fn, write_checkpoint, output_dirs, checkpoint_every, 
+                                            batched, retry_failed, stream_chunk_files if streaming else None, 
+                                            num_workers=num_workers, chunksize=chunksize, initializer=init_worker, 
+                                            initargs=(worker_settings(),), metrics=run_metrics, start_method=start_method, 
+                                            preload=preload)
+
+def write_run_report(): 
+    print(run_metrics.report())
+    run_metrics.save(metrics_path.format(source_month=source_month))
+
+# Write results as they come back from the workers instead of collecting the whole month first, so the parent only
+# holds stream_chunk_files files of results (parquet output only). With resume (the default) every checkpoint is
+# written in pieces of stream_chunk_files files, so checkpoint_every can be raised to keep fewer parts without holding
+# more results; without resume (--no-resume) each partition is one file written a row group at a time
+streaming = True
+stream_chunk_files = 5000
+row_group_size = 100000
+
+def add_year_totals(totals, fiscal_year, df, top=20): 
+    # Running version of the per-year summary printed at the end of a run
+    import pandas as pd
+    entry = totals.setdefault(fiscal_year, {'rows': 0, 'dormant': 0, 'active': 0, 'value': 0.0, 'top': None})
+    talcl = pd.to_numeric(df['totalassetslesscurrentliabilities'], errors='coerce')
+    entry['rows'] += len(df)
+    entry['dormant'] += int((df['CompanyDormant'] == 'true').sum())
+    entry['active'] += int((df['CompanyDormant'] == 'false').sum())
+    entry['value'] += talcl.sum()
+    largest = df.assign(totalassetslesscurrentliabilities=talcl).nlargest(top, 'totalassetslesscurrentliabilities')
+    largest = largest[['CompanyNumber', 'totalassetslesscurrentliabilities']]
+    if entry['top'] is not None: 
+        largest = pd.concat([entry['top'], largest]).nlargest(top, 'totalassetslesscurrentliabilities')
+    entry['top'] = largest
+
+def stream_main(): 
+    """
+    Run main() and write its results chunk by chunk with an
+    AccountStreamWriter. Returns (number of files, running totals by year)
+    """
+    import account_writer
+    num_parsed = 0
+    totals = {}
+    with account_writer.AccountStreamWriter(output_dir, source_month, fact_dir if output_mode == 'facts' else None, 
+                                            row_group_size=row_group_size) as writer: 
+        for results in account_pipeline.chunked(main(), stream_chunk_files): 
+            facts, frames = chunk_frames(results)
+            if facts is not None: 
+                writer.write_facts(facts)
+            writer.write_years(frames)
+            for fiscal_year, df in frames.items(): 
+                if len(df): 
+                    add_year_totals(totals, fiscal_year, df)
+            num_parsed += len(results)
+    return num_parsed, totals
+
+def collect_main(): 
+    # Original flow: collect the whole run, then write it out
+    import pandas as pd
+    import account_facts
+    import account_writer
     results = main()
 
-    for r in results: 
-        if r[0]: 
-            final_2018.append(r[0])
-        if r[1]:
-            final_2019.append(r[1])
-        if r[2]:
-            final_2020.append(r[2])
-        if r[3]:
-            final_2021.append(r[3])
-        
-    df_2018 = pd.DataFrame(final_2018)
-    df_2019 = pd.DataFrame(final_2019)
-    df_2020 = pd.DataFrame(final_2020)
-    df_2021 = pd.DataFrame(final_2021)
+    num_parsed = 0
+    if output_mode == 'facts': 
+        facts = account_facts.concat_facts(results)
+        account_writer.write_fact_parquet(facts, fact_dir, source_month)
+        frames = fact_year_frames(facts)
+        num_parsed = facts['source_file'].nunique()
+    else: 
+        # local to the run, so that the months of one cli call do not pile up in each other's tables
+        final_2018, final_2019, final_2020, final_2021 = [], [], [], []
+        for r in results: 
+            num_parsed += 1
+            if r[0]: 
+                final_2018.append(r[0])
+            if r[1]:
+                final_2019.append(r[1])
+            if r[2]:
+                final_2020.append(r[2])
+            if r[3]:
+                final_2021.append(r[3])
+        frames = {2018: pd.DataFrame(final_2018), 2019: pd.DataFrame(final_2019), 
+                  2020: pd.DataFrame(final_2020), 2021: pd.DataFrame(final_2021)}
+    
+    df_2020 = frames.get(2020, pd.DataFrame(columns=['CompanyNumber', 'CompanyDormant', 'totalassetslesscurrentliabilities']))
+    df_2021 = frames.get(2021, pd.DataFrame(columns=['CompanyNumber', 'CompanyDormant', 'totalassetslesscurrentliabilities']))
 
-    print("Number of files parsed: {}".format(len(files)))
+    print("Number of files parsed: {}".format(num_parsed))
 
     print("Length of the DataFrame: {}; Number of Dormant Companies: {}".format(len(df_2020), df_2020[df_2020['CompanyDormant']=='true']['CompanyDormant'].count()))
     print("Number of Active Companies (2020) encoded in xml files: {}".format(df_2020[df_2020['CompanyDormant']=='false']['CompanyDormant'].count()))
@@ -334,7 +884,7 @@ if __name__ == "__main__":
     print("Length of the DataFrame: {}; Number of Dormant Companies: {}".format(len(df_2021), df_2021[df_2021['CompanyDormant']=='true']['CompanyDormant'].count()))
     print("Number of Active Companies (2021) encoded in xml files: {}".format(df_2021[df_2021['CompanyDormant']=='false']['CompanyDormant'].count()))
     print("Total Value in 2021 Accounts encoded in xml files: {}".format(df_2021['totalassetslesscurrentliabilities'].sum()))
-    
+
     # value_dist = df_2021['totalassetslesscurrentliabilities']
     # plt.figure(figsize=(15,9))
     # plt.hist(value_dist, bins=1000)
@@ -343,14 +893,88 @@ if __name__ == "__main__":
     print(df_2021.sort_values('totalassetslesscurrentliabilities', ascending=False)[['CompanyNumber', 'totalassetslesscurrentliabilities']][:20])
 
 
-    month = 3
-    # Please Name Based on the month of the data 
-    # Naming Convention: account_20**_1.csv for Account_Monthly_Data-January
-    df_2018.to_csv('account_2018_test_xml{}.csv'.format(month), index=False)
-    df_2019.to_csv('account_2019_test_xml4.csv', index=False)
-    df_2020.to_csv('account_2020_test_xml4.csv', index=False)
-    df_2021.to_csv('account_2021_test_xml4.csv', index=False)
-
-
-
+    month = int(source_month.split('-')[1])
+    if output_format == 'parquet': 
+        account_writer.write_account_parquet(frames, output_dir, source_month)
+    else: 
+        # Named after the month of the data (source_month) 
+        # Naming Convention: account_20**_test_xml1.csv for Account_Monthly_Data-January
+        empty = pd.DataFrame(columns=year_columns)
+        for year in (2018, 2019, 2020, 2021): 
+            frames.get(year, empty).to_csv('account_{}_test_xml{}.csv'.format(year, month), index=False)
+
+def run_inputs(): 
+    """
+    Parse files and zip_files for source_month with the settings of the
+    module, and print the run report, also after a crash to see which
+    file brought the run down.
+    """
+    global run_metrics
+    run_metrics = account_metrics.RunMetrics() if report_metrics else None
+    try: 
+        if resume and output_format == 'parquet': 
+            print("Number of new files parsed: {}".format(resume_main()))
+        elif streaming and output_format == 'parquet': 
+            num_parsed, totals = stream_main()
+            print("Number of files parsed: {}".format(num_parsed))
+            for year in (2020, 2021): 
+                entry = totals.get(year, {'rows': 0, 'dormant': 0, 'active': 0, 'value': 0.0, 'top': None})
+                print("Length of the DataFrame: {}; Number of Dormant Companies: {}".format(entry['rows'], entry['dormant']))
+                print("Number of Active Companies ({}) encoded in xml files: {}".format(year, entry['active']))
+                print("Total Value in {} Accounts encoded in xml files: {}".format(year, entry['value']))
+            if 2021 in totals: 
+                print(totals[2021]['top'])
+        else: 
+            collect_main()
+    finally: 
+        parse_cache.trim_cache(cache_dir, cache_max_gb * 2**30)
+        if run_metrics is not None: 
+            write_run_report()
+
+def run(files=(), zip_files=(), source_month=None, **settings): 
+    """
+    API entry point: parse the given account files and/or monthly ZIP
+    archives as one source month.
+
+    Keyword arguments:
+    files -- paths of xml/html account files
+    zip_files -- paths of Accounts_Monthly_Data ZIP archives
+    source_month -- month the inputs were published, e.g. '2022-04'
+    settings -- any of the module settings, e.g. num_workers=8,
+                output_dir='account_xml_parquet', output_mode='years'
+    """
+    module = sys.modules[__name__]
+    for name, value in settings.items(): 
+        if not hasattr(module, name): 
+            raise TypeError("Unknown setting {}".format(name))
+        setattr(module, name, value)
+    module.files = list(files)
+    module.zip_files = list(zip_files)
+    if source_month is not None: 
+        module.source_month = source_month
+    run_inputs()
+
+def cli(argv=None): 
+    arg_parser = account_cli.build_parser('Parse Companies House account xml files into yearly tables', engines=['lxml', 'bs4'])
+    args = arg_parser.parse_args(argv)
+    settings = account_cli.script_settings(args)
+
+    if args.measure_startup: 
+        # a fork server outlives its first pool, the second one shows what later pools pay
+        for method in multiprocessing.get_all_start_methods(): 
+            for attempt in ('first', 'second'): 
+                startup = account_pipeline.worker_startup(settings.get('num_workers', num_workers), modules=preload, 
+                                                          method=method, preload=preload)
+                print('{} pool, {}: workers ready after {:.3f}s (first) to {:.3f}s (last)'.format(
+                    method, attempt, startup['first_ready'], startup['last_ready']))
+        return
+
+    if not args.inputs and not args.months: 
+        arg_parser.error('give account files, directories or ZIP archives, or --months')
+
+    for month, month_files, month_zip_files in account_cli.month_runs(args, ACCOUNT_SUFFIXES, source_month): 
+        print('Start Scraping Account Data for {}: {} files, {} ZIP archives'.format(month, len(month_files), len(month_zip_files)))
+        run(month_files, month_zip_files, month, **settings)
 
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,94 @@
+'''
+
+Companies House Account ZIP Reader
+
+Read account files straight out of the monthly Accounts_Monthly_Data ZIP archives instead of extracting them to disk first.
+The parent process only reads each archive's central directory and hands out batches of member names, workers open the
+archive themselves and read the members they were given, so file contents never cross the process boundary.
+
+'''
+
+import zipfile
+import functools
+
+import account_pipeline
+import account_manifest
+
+
+ACCOUNT_SUFFIXES = ('.html', '.xml')
+
+# ZipFile handles opened by this process, one per archive
+_archives = {}
+
+
+def open_archive(zip_path):
+    if zip_path not in _archives:
+        _archives[zip_path] = zipfile.ZipFile(zip_path, 'r')
+    return _archives[zip_path]
+
+
+def list_zip_members(zip_path, suffixes=ACCOUNT_SUFFIXES):
+    '''
+    Names of the account files in an archive, in archive order so that
+    workers read it front to back.
+    '''
+    with zipfile.ZipFile(zip_path, 'r') as archive:
+        return [info.filename for info in archive.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(suffixes)]
+
+
+def iter_zip_members(zip_paths, suffixes=ACCOUNT_SUFFIXES):
+    '''
+    Yield (zip_path, member name) for every account file across one or
+    more archives.
+    '''
+    for zip_path in zip_paths:
+        for name in list_zip_members(zip_path, suffixes):
+            yield zip_path, name
+
+
+def iter_zip_member_keys(zip_paths, suffixes=ACCOUNT_SUFFIXES):
+    '''
+    Like iter_zip_members, paired with the manifest key of each member
+    (name, size and CRC from the central directory).
+    '''
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path, 'r') as archive:
+            infos = archive.infolist()
+        for info in infos:
+            if not info.is_dir() and info.filename.lower().endswith(suffixes):
+                yield account_manifest.member_key(zip_path, info), (zip_path, info.filename)
+
+
+def read_zip_batch(members, read_fn):
+    '''
+    Worker side: read each (zip_path, name) member of the batch into memory
+    and pass it to read_fn(name, content=bytes). Returns the list of
+    read_fn results.
+    '''
+    results = []
+    for zip_path, name in members:
+        results.append(read_fn(name, content=open_archive(zip_path).read(name)))
+    return results
+
+
+def process_zip_archives(zip_paths, read_fn, num_workers=None, batch_size=500, suffixes=ACCOUNT_SUFFIXES,
+                         initializer=None, initargs=(), metrics=None, start_method=None, preload=()):
+    '''
+    Run read_fn over every account file in the given archives on the warm
+    worker pool of account_pipeline and yield the results as batches
+    complete.
+
+    Keyword arguments:
+    zip_paths -- list of Accounts_Monthly_Data ZIP archives
+    read_fn -- picklable callable taking (member name, content=bytes)
+    num_workers -- size of the process pool, defaults to cpu_count()
+    batch_size -- number of members sent to a worker at a time
+    initializer -- run once in each worker when it starts, with initargs
+    metrics -- optional account_metrics.RunMetrics, see run_pipeline
+    start_method, preload -- pool start method, see run_pipeline
+    '''
+    return account_pipeline.run_pipeline(iter_zip_members(zip_paths, suffixes), functools.partial(read_zip_batch, read_fn=read_fn),
+                                         num_workers, chunksize=batch_size, initializer=initializer, initargs=initargs,
+                                         batched=True,
+                                         metrics=metrics, start_method=start_method, preload=preload)
@@ -5,6 +5,14 @@ aaron.chen@spc.ox.ac.uk
 
 Companies House Bulk Data Product Prod195_3500 scraper. Returns a dataframe (.csv) file of the all information.
 
+Every snapshot file is parsed in its own worker process (num_workers), its trailer record count is checked against
+the records read, and the per-file tables are merged in file order. Files are decoded column-wise in large blocks by
+snapshot_decoder, set decoder = 'lines' for the original line by line parser below. With output_mode = 'parquet' the
+companies and appointments are written as separate tables, streamed block by block (snapshot_writer), instead of
+building the whole snapshot in memory. output_mode = 'store' loads the snapshot once into a SQLite store
+(snapshot_store) and afterwards only applies the update files (DDDDUPDT) found, in run_number order. For the
+officers of a few companies, company_officers() looks them up through an offset index of the files (snapshot_index).
+
 
 
 '''
@@ -12,11 +20,14 @@ Companies House Bulk Data Product Prod195_3500 scraper. Returns a dataframe (.cs
 import pandas as pd
 from tqdm import tqdm
 import glob
+import functools
+import multiprocessing
+
+import snapshot_decoder
 
 
 def header(line): 
-    header_dict = {'DDDDSNAP':'snapshot_file',
-                  'DDDDUPDT':'update_file'}
+    header_dict = snapshot_decoder.HEADER_TYPES
     header_indicator = line[:8]
     run_number = line[8:12]
     production_date = line[12:20]
@@ -29,11 +40,7 @@ def trailer(line):
     return record_count
 
 def company(line): 
-    company_status_dict = {'C':'Converted/closed company', 
-                          'D':'Dissolved company', 
-                          'L':'Company in liquidation', 
-                          'R':'Company in receivership', 
-                          ' ':'Else'}
+    company_status_dict = snapshot_decoder.COMPANY_STATUS
     company_number = line[:8]
     record_type = line[8:9]
     if record_type != '1':
@@ -48,16 +55,7 @@ def company(line):
     return company_name, company_number, company_status, num_officers
 
 def person(line, i): 
-    appointment_dict = {'00':'Current Secretary',
-                       '01':'Current Director',
-                       '04':'Current non-designated LLP Member',
-                       '05':'Current designated LLP Member',
-                       '11':'Current Judicial Factor',
-                       '12':'Current Receiver or Manager appointed under the Charities Act', 
-                       '13':'Current Manager appointed under the CAICE Act', 
-                       '17':'Current SE Member of Administrative Organ',
-                       '18':'Current SE Member of Supervisory Organ', 
-                       '19':'Current SE Member of Management Organ'}
+    appointment_dict = snapshot_decoder.APPOINTMENT_TYPES
     company_number = line[:8]
     
     record_type = line[8:9]
@@ -106,9 +104,7 @@ def person(line, i):
     data_len = int(line[72:76])
     
     person_info_str = line[76:76+data_len].split('<')
-    person_info_categories = ['title','forenames','surname','honours','care of','po box',\
-                              'address line 1','address line 2','post town','county','country',\
-                              'occupation','nationality','usual residential country','']
+    person_info_categories = snapshot_decoder.PERSON_INFO_CATEGORIES
 #     if i == 2074396: 
 #         person_info_str = person_info_str[1:]
         
@@ -125,61 +121,208 @@ def person(line, i):
     return company_number, appointment, person_number, is_corp, appointment_date, person_postcode, DOB, person_info
     
     
-def main():
-    total_list = list()
-    files_path = glob.glob('Prod195_3500/*')
-    for data in tqdm(files_path[:5]):
-        with open(data, 'r') as file: 
-            officers_details = []
-            officer = {}
-            for i, line in enumerate(file): 
-                
-                # if i >= 100: 
-                #     break
-                
-                if i == 0: 
-                    file_info, run_number, production_date = header(line)
-                    continue
-                
-                if line[:8] == '99999999': 
-                    record_count = trailer(line)
-                    break
-                
-                if line[8] == '1':
-                    officer = {}
-                    officer['company_name'], officer['company_number'], officer['company_status'], \
-                    officer['num_officers'] = company(line)
-                    continue
+def read_snapshot_file(data, decoder='lines', block_size=2**25): 
+    '''
+    Parse one Prod195 file into a DataFrame with a row per appointment.
+
+    Keyword arguments:
+    data -- path of the Prod195 file
+    decoder -- 'columns' for snapshot_decoder, 'lines' for the per-line parser
+    block_size -- bytes decoded at a time by the 'columns' decoder
+
+    Returns (DataFrame, summary of the file), the summary holds the header
+    fields, the trailer record_count and the number of company and person
+    records read
+    '''
+    if decoder == 'columns': 
+        companies, persons, summary = snapshot_decoder.read_snapshot(data, block_size)
+        return snapshot_decoder.appointment_table(companies, persons), summary
+
+    officers_details = []
+    officer = {}
+    summary = {'file': data, 'file_info': None, 'run_number': None, 'production_date': None, 
+               'record_count': None, 'companies': 0, 'persons': 0}
+    with open(data, 'r') as file: 
+        for i, line in enumerate(file): 
+            
+            # if i >= 100: 
+            #     break
+            
+            if i == 0: 
+                summary['file_info'], summary['run_number'], summary['production_date'] = header(line)
+                continue
+            
+            if line[:8] == '99999999': 
+                summary['record_count'] = trailer(line)
+                break
+            
+            if line[8] == '1':
+                officer = {}
+                officer['company_name'], officer['company_number'], officer['company_status'], \
+                officer['num_officers'] = company(line)
+                summary['companies'] += 1
+                continue
+            
+            if line[8] == '2': 
+                company_number, appointment, person_number, is_corp, \
+                appointment_date, person_postcode, DOB, person_info = person(line, i)
+                summary['persons'] += 1
                 
-                if line[8] == '2': 
-                    company_number, appointment, person_number, is_corp, \
-                    appointment_date, person_postcode, DOB, person_info = person(line, i)
+                if company_number == officer['company_number']: 
+                    officer_1 = officer.copy()
+                    officer_1.update(person_info)
+                    officer_1['person_number'], officer_1['is_corp'], \
+                    officer_1['appointment'], officer_1['appointment_date'],\
+                    officer_1['DOB'], officer_1['person_postcode'] = person_number, is_corp, appointment,\
+                    appointment_date, DOB, person_postcode
                     
-                    if company_number == officer['company_number']: 
-                        officer_1 = officer.copy()
-                        officer_1.update(person_info)
-                        officer_1['person_number'], officer_1['is_corp'], \
-                        officer_1['appointment'], officer_1['appointment_date'],\
-                        officer_1['DOB'], officer_1['person_postcode'] = person_number, is_corp, appointment,\
-                        appointment_date, DOB, person_postcode
-                        
-                        officers_details.append(officer_1)
-                    else: 
-                        raise Exception("Person from another company recorded in the wrong officer dictionary")
-                    
-                    continue
+                    officers_details.append(officer_1)
+                else: 
+                    raise Exception("Person from another company recorded in the wrong officer dictionary")
+                
+                continue
+
+    # a DataFrame pickles back from a worker much faster than a list of dicts
+    return pd.DataFrame(officers_details), summary
 
-            total_list.extend(officers_details)
+def check_record_count(summary): 
+    # The trailer counts the company and person records between the header and the trailer
+    records = summary['companies'] + summary['persons']
+    if summary['record_count'] is None: 
+        print(f"{summary['file']}: no trailer record, the file may be truncated ({records} records read)")
+        return False
+    if summary['record_count'] != records: 
+        print(f"{summary['file']}: trailer record count {summary['record_count']} but {records} records read!")
+        return False
+    return True
 
-    total_df = pd.DataFrame(total_list)
+def iter_snapshot_files(files_path, num_workers=None, read_fn=read_snapshot_file): 
+    '''
+    Yield read_fn(file), by default (DataFrame, summary), of every file in
+    files_path, in order. With more than one worker each file is parsed in
+    its own process, so a snapshot of n files takes about as long as its
+    n / num_workers largest.
+    '''
+    if num_workers is None: 
+        num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(files_path))
+    if num_workers <= 1: 
+        for data in tqdm(files_path): 
+            yield read_fn(data)
+        return
+
+    with multiprocessing.Pool(num_workers) as pool: 
+        # one file per task, the files are few and large
+        yield from tqdm(pool.imap(read_fn, files_path, chunksize=1), total=len(files_path))
+
+
+# Prod195 files to parse, limit to only parse the first few of them (None for all of them)
+snapshot_glob = 'Prod195_3500/*'
+limit = None
+# Worker processes, each parses whole files, None for cpu_count() and 1 to parse in this process
+num_workers = None
+# 'columns' decodes whole blocks of records with numpy (snapshot_decoder), 'lines' parses them one by one
+decoder = 'columns'
+# 'table' returns one row per appointment with its company's fields (saved as total_DF.csv), 'parquet' streams a
+# companies and an appointments table linked by company_number to output_dir, one block of records at a time, 'store'
+# keeps them in store_path and applies update files to it instead of parsing a new snapshot
+output_mode = 'table'
+output_dir = 'Prod195_parquet'
+store_path = 'Prod195_store.sqlite'
+# Saved company number index of the files, for company_officers()
+index_path = 'Prod195_3500_index.npz'
+
+def snapshot_files(files_path=None, limit=limit): 
+    if files_path is None: 
+        files_path = sorted(glob.glob(snapshot_glob))
+    if limit is not None: 
+        files_path = files_path[:limit]
+    return files_path
+
+def check_record_counts(summaries): 
+    mismatched = sum(not check_record_count(summary) for summary in summaries)
+    if mismatched: 
+        print(f'{mismatched} of {len(summaries)} files do not match their trailer record count')
+
+def main(files_path=None, num_workers=num_workers, limit=limit, decoder=decoder):
+    files_path = snapshot_files(files_path, limit)
+
+    frames = []
+    summaries = []
+    for df, summary in iter_snapshot_files(files_path, num_workers, functools.partial(read_snapshot_file, decoder=decoder)): 
+        frames.append(df)
+        summaries.append(summary)
+    check_record_counts(summaries)
+
+    total_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
     return total_df
 
+def parquet_main(files_path=None, num_workers=num_workers, limit=limit, output_dir=output_dir): 
+    '''
+    Write the companies and appointments tables of every file to
+    output_dir, see snapshot_writer. Workers send back only the summaries
+    of their files. Returns the summaries
+    '''
+    import snapshot_writer
+    files_path = snapshot_files(files_path, limit)
+    summaries = list(iter_snapshot_files(files_path, num_workers, 
+                                         functools.partial(snapshot_writer.write_snapshot_file, output_dir=output_dir)))
+    check_record_counts(summaries)
+    return summaries
+
+def store_main(files_path=None, limit=limit, store_path=store_path): 
+    '''
+    Bring the store at store_path up to date with the Prod195 files: a
+    snapshot newer than the store replaces it, update files newer than the
+    store are applied on top. Returns the summaries of the files applied
+    '''
+    import snapshot_store
+    files_path = snapshot_files(files_path, limit)
+    headers = {path: snapshot_store.read_header(path) for path in files_path}
+    snapshot_runs = [headers[path][1] for path in files_path if headers[path][0] == 'snapshot_file']
+    # only the files of the latest snapshot
+    snapshot = [path for path in files_path if headers[path][0] == 'snapshot_file' and headers[path][1] == max(snapshot_runs)]
+    updates = [path for path in files_path if headers[path][0] == 'update_file']
+
+    summaries = []
+    with snapshot_store.SnapshotStore(store_path) as store: 
+        if snapshot and (store.run_number is None or max(snapshot_runs) > store.run_number): 
+            summaries += store.load_snapshot(snapshot)
+        summaries += store.apply_updates(updates)
+        print(f'{store_path} is at run {store.run_number}')
+    return summaries
+
+def company_officers(company_numbers, files_path=None, index_path=index_path): 
+    '''
+    Appointments of the given companies, decoded from their own records
+    only. The index is built on first use and reused while it covers the
+    same files (files_path, the snapshot_glob files by default) and they
+    are unchanged.
+    '''
+    import os
+    import snapshot_index
+    files = snapshot_files(files_path, None)
+    if os.path.exists(index_path): 
+        index = snapshot_index.SnapshotIndex.load(index_path, files=files)
+    else: 
+        index = snapshot_index.SnapshotIndex.build(files, index_path)
+    with index: 
+        return index.appointments(company_numbers)
 
 
 
 
 if __name__ == '__main__': 
-	total_df = main()
-	print(len(total_df))
-	total_df.to_csv('total_DF.csv', index=False)
\ No newline at end of file
+	if output_mode == 'store': 
+		summaries = store_main()
+		print(f"{sum(summary['companies'] for summary in summaries)} companies, "
+		      f"{sum(summary['persons'] for summary in summaries)} appointments applied from {len(summaries)} files")
+	elif output_mode == 'parquet': 
+		summaries = parquet_main()
+		print(f"{sum(summary['companies'] for summary in summaries)} companies, "
+		      f"{sum(summary['persons'] for summary in summaries)} appointments written to {output_dir}")
+	else: 
+		total_df = main()
+		print(len(total_df))
+		total_df.to_csv('total_DF.csv', index=False)
@@ -0,0 +1,385 @@
+'''
+
+Companies House Prod195 Bulk Decoder
+
+Column-wise decoder of the Prod195_3500 officers files. The file is read in large blocks cut at company records, the
+line starts of a whole block are found with numpy and every fixed-width field of its type 1 (company) and type 2
+(person) records is decoded at once as an array, including the '<' separated name and address block of the persons.
+Gives the same fields as company() and person() of CompaniesHouse_Snapshot_Scraper without a Python call per record.
+
+Blocks are decoded as bytes when they are plain ASCII, the usual case, and as UTF-32 code points otherwise, so that
+the field offsets always count characters like the per-line parser does. A column of fields is cut out of the block
+with one fancy index and turned into Python strings by a single decode and split.
+
+'''
+
+import sys
+import locale
+
+import numpy as np
+import pandas as pd
+
+
+HEADER_TYPES = {'DDDDSNAP':'snapshot_file',
+                'DDDDUPDT':'update_file'}
+
+COMPANY_STATUS = {'C':'Converted/closed company',
+                  'D':'Dissolved company',
+                  'L':'Company in liquidation',
+                  'R':'Company in receivership',
+                  ' ':'Else'}
+
+APPOINTMENT_TYPES = {'00':'Current Secretary',
+                     '01':'Current Director',
+                     '02':'Resigned Secretary',
+                     '03':'Resigned Director',
+                     '04':'Current non-designated LLP Member',
+                     '05':'Current designated LLP Member',
+                     '06':'Resigned non-designated LLP Member',
+                     '07':'Resigned designated LLP Member',
+                     '11':'Current Judicial Factor',
+                     '12':'Current Receiver or Manager appointed under the Charities Act',
+                     '13':'Current Manager appointed under the CAICE Act',
+                     '14':'Resigned Judicial Factor',
+                     '15':'Resigned Receiver or Manager appointed under the Charities Act',
+                     '16':'Resigned Manager appointed under the CAICE Act',
+                     '17':'Current SE Member of Administrative Organ',
+                     '18':'Current SE Member of Supervisory Organ',
+                     '19':'Current SE Member of Management Organ',
+                     '20':'Resigned SE Member of Administrative Organ',
+                     '21':'Resigned SE Member of Supervisory Organ',
+                     '22':'Resigned SE Member of Management Organ'}
+
+# Resigned appointment types (update files only) and the current type of the appointment they end
+RESIGNED_TYPES = {'02':'00', '03':'01', '06':'04', '07':'05', '14':'11', '15':'12', '16':'13',
+                  '20':'17', '21':'18', '22':'19'}
+
+# Fields of the variable-length block of a person record, the trailing '' is what follows the last '<'
+PERSON_INFO_CATEGORIES = ['title','forenames','surname','honours','care of','po box',
+                          'address line 1','address line 2','post town','county','country',
+                          'occupation','nationality','usual residential country','']
+
+COMPANY_COLUMNS = ['company_name', 'company_number', 'company_status', 'num_officers']
+PERSON_COLUMNS = ['company_row', 'company_number'] + PERSON_INFO_CATEGORIES[:-1] + \
+                 ['person_number', 'is_corp', 'appointment', 'appointment_date', 'DOB', 'person_postcode']
+
+TRAILER = '99999999'
+NEWLINE = ord('\n')
+RETURN = ord('\r')
+DELIMITER = ord('<')
+SPACE = ord(' ')
+# code points in native byte order, as np.uint32 reads them
+UTF32 = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
+
+
+def code_units(block, encoding):
+    # One array element per character: the bytes of an ASCII block, the code points of anything else
+    codes = np.frombuffer(block, dtype=np.uint8)
+    if not (codes >= 128).any():
+        return codes
+    return np.frombuffer(block.decode(encoding).encode(UTF32), dtype=np.uint32)
+
+
+def codec(codes):
+    return 'ascii' if codes.dtype == np.uint8 else UTF32
+
+
+def lay_out(codes, starts, ends):
+    # codes[starts[i]:ends[i]] of every i one after the other, each followed by a line break
+    widths = np.maximum(ends - starts, 0)
+    sizes = widths + 1
+    offsets = np.cumsum(sizes) - sizes
+    index = np.arange(sizes.sum()) + np.repeat(starts - offsets, sizes)
+    flat = codes[np.minimum(index, len(codes) - 1)]
+    flat[offsets + widths] = NEWLINE
+    return flat
+
+
+def gather(codes, starts, ends):
+    '''
+    codes[starts[i]:ends[i]] for every i as a list of str, the column-wise
+    equivalent of slicing each line. Fields never span a line break, so the
+    fields are laid out one per line and decoded and split in one go.
+    '''
+    return lay_out(codes, starts, ends).tobytes().decode(codec(codes)).split('\n')[:-1]
+
+
+def fixed_part(codes, starts, ends, width):
+    '''
+    (n, width) array of the first width characters of every line, padded
+    with spaces past the end of a short line. Rows are taken from a strided
+    view of the block, without building an index of every character.
+    '''
+    if len(codes) < width or (len(starts) and starts[-1] + width > len(codes)):
+        codes = np.concatenate([codes, np.full(width, SPACE, dtype=codes.dtype)])
+    fixed = np.lib.stride_tricks.sliding_window_view(codes, width)[starts]
+    short = np.flatnonzero(ends - starts < width)
+    if len(short):
+        fixed[short[:, None], np.arange(width)] = np.where(np.arange(width) >= (ends - starts)[short, None], 
+                                                           SPACE, fixed[short])
+    return fixed
+
+
+def fixed_column(fixed, start, end):
+    # line[start:end] of every row of a fixed_part() array as a list of str
+    column = np.full((len(fixed), end - start + 1), NEWLINE, dtype=fixed.dtype)
+    column[:, :-1] = fixed[:, start:end]
+    return column.tobytes().decode(codec(fixed)).split('\n')[:-1]
+
+
+def fixed_ints(fixed, start, end, lines=None):
+    '''
+    int() of a fixed-width number field. Fields that are not all digits
+    (padded with spaces, or invalid) go through int() itself, which raises
+    on the invalid ones like the per-line parser.
+    '''
+    digits = fixed[:, start:end].astype(np.int64) - ord('0')
+    plain = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    values = digits @ (10 ** np.arange(end - start - 1, -1, -1))
+    for i in np.flatnonzero(~plain):
+        try:
+            values[i] = int(fixed_column(fixed[i:i+1], start, end)[0])
+        except ValueError:
+            line = '' if lines is None else ' in line {}'.format(lines[i] + 1)
+            raise ValueError('Invalid number field{}'.format(line))
+    return values
+
+
+def to_objects(values, strip=False):
+    # None for the empty strings like the per-line parser, after stripping the fixed-width padding if asked
+    if strip:
+        return [value.strip() or None for value in values]
+    return [value or None for value in values]
+
+
+def last_company_start(buf):
+    # Offset of the last complete line break in buf that is followed by a company record
+    pos = len(buf)
+    while True:
+        pos = buf.rfind(b'\n', 0, pos)
+        if pos < 0:
+            return 0
+        if buf[pos+9:pos+10] == b'1':
+            return pos + 1
+
+
+def iter_blocks(path, block_size):
+    '''
+    Yield the file in blocks of about block_size bytes, cut in front of a
+    company record so that a company and its persons are never split.
+    '''
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            chunk = f.read(block_size)
+            if not chunk:
+                if rest:
+                    yield rest
+                return
+            buf = rest + chunk
+            cut = last_company_start(buf)
+            if cut <= 0:
+                rest = buf
+                continue
+            yield buf[:cut]
+            rest = buf[cut:]
+
+
+def decode_header(line):
+    return HEADER_TYPES[line[:8]], line[8:12], line[12:20]
+
+
+def decode_block(block, summary, first_line=0, encoding=None):
+    '''
+    Decode one block of records into (companies, persons) dicts of column
+    name -> list or array. The header (first block) and trailer fields go
+    into summary, as well as the number of records read. The company_row
+    of a person is the position of its company in the companies of this
+    block.
+
+    Keyword arguments:
+    block -- bytes of whole lines
+    summary -- dict updated with the file level fields, see read_snapshot
+    first_line -- line number of the first line of the block in the file
+    encoding -- encoding of non-ASCII blocks, None for the locale default
+    '''
+    codes = code_units(block, encoding or locale.getpreferredencoding(False))
+    breaks = np.flatnonzero(codes == NEWLINE)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(codes)]])
+    if starts[-1] == len(codes):
+        starts, ends = starts[:-1], ends[:-1]
+    ends = ends - ((ends > starts) & (codes[np.maximum(ends - 1, 0)] == RETURN))
+    lines = np.arange(len(starts)) + first_line
+
+    if first_line == 0 and len(starts):
+        summary['file_info'], summary['run_number'], summary['production_date'] = decode_header(
+            gather(codes, starts[:1], ends[:1])[0])
+        starts, ends, lines = starts[1:], ends[1:], lines[1:]
+
+    # nothing after the trailer is read
+    first8 = fixed_part(codes, starts, ends, len(TRAILER))
+    trailer = np.flatnonzero((first8 == ord('9')).all(axis=1))
+    if len(trailer):
+        t = trailer[0]
+        summary['record_count'] = int(gather(codes, starts[t:t+1], ends[t:t+1])[0].strip()[8:16])
+        summary['stop'] = True
+        starts, ends, lines = starts[:t], ends[:t], lines[:t]
+
+    record_type = np.where(ends - starts > 8, codes[np.minimum(starts + 8, len(codes) - 1)], 0)
+    is_company = record_type == ord('1')
+    is_person = record_type == ord('2')
+
+    companies = decode_companies(codes, starts[is_company], ends[is_company], lines[is_company])
+    company_row = np.cumsum(is_company)[is_person] - 1
+    persons = decode_persons(codes, starts[is_person], ends[is_person], lines[is_person])
+
+    if (company_row < 0).any():
+        raise Exception("Person record before any company record in line {}".format(lines[is_person][0] + 1))
+    company_starts = starts[is_company]
+    person_starts = starts[is_person]
+    if len(company_row) and (fixed_part(codes, person_starts, person_starts + 8, 8) != 
+                             fixed_part(codes, company_starts[company_row], company_starts[company_row] + 8, 8)).any():
+        raise Exception("Person from another company recorded in the wrong officer dictionary")
+    persons['company_row'] = company_row
+
+    summary['companies'] += int(is_company.sum())
+    summary['persons'] += len(company_row)
+    return companies, persons
+
+
+def decode_companies(codes, starts, ends, lines):
+    fixed = fixed_part(codes, starts, ends, 40)
+    status = pd.Series(fixed_column(fixed, 9, 10), dtype=object).map(COMPANY_STATUS)
+    if status.isna().any():
+        raise KeyError('Unknown company status in line {}'.format(lines[np.flatnonzero(status.isna())[0]] + 1))
+
+    name_len = fixed_ints(fixed, 36, 40, lines)
+    return {'company_name': gather(codes, starts + 40, np.minimum(starts + 39 + name_len, ends)),
+            'company_number': fixed_column(fixed, 0, 8),
+            'company_status': status.tolist(),
+            'num_officers': fixed_ints(fixed, 32, 36, lines)}
+
+
+def person_info_columns(codes, data_starts, data_ends, lines):
+    '''
+    Columns of the '<' separated block of every person, as a dict of
+    category -> list. A block of 16 pieces drops its first piece, anything
+    else but 15 pieces is an error, as in person().
+    '''
+    # with '<' turned into line breaks as well, one split gives the pieces of every person in a row
+    flat = lay_out(codes, data_starts, data_ends)
+    delimiters = flat == DELIMITER
+    sizes = np.maximum(data_ends - data_starts, 0) + 1
+    counts = np.add.reduceat(delimiters, np.cumsum(sizes) - sizes) if len(sizes) else np.zeros(0, dtype=np.int64)
+
+    pieces = len(PERSON_INFO_CATEGORIES)
+    bad = np.flatnonzero((counts != pieces - 1) & (counts != pieces))
+    if len(bad):
+        i = bad[0]
+        raise AssertionError(f"Length of variable {counts[i] + 1} info not equal to predefined categories length "
+                             f"{pieces}! \n In Line {int(lines[i])+1}! ")
+
+    flat[delimiters] = NEWLINE
+    values = [value or None for value in flat.tobytes().decode(codec(codes)).split('\n')[:-1]]
+    extra = counts == pieces
+    if not extra.any():
+        return {category: values[j::pieces] for j, category in enumerate(PERSON_INFO_CATEGORIES[:-1])}
+
+    first = np.cumsum(counts + 1) - (counts + 1) + extra
+    return {category: [values[k] for k in first + j] for j, category in enumerate(PERSON_INFO_CATEGORIES[:-1])}
+
+
+def decode_persons(codes, starts, ends, lines):
+    fixed = fixed_part(codes, starts, ends, 76)
+    columns = {'company_number': fixed_column(fixed, 0, 8)}
+
+    data_len = fixed_ints(fixed, 72, 76, lines)
+    columns.update(person_info_columns(codes, starts + 76, np.minimum(starts + 76 + data_len, ends), lines))
+
+    columns['person_number'] = fixed_column(fixed, 12, 24)
+    columns['is_corp'] = fixed[:, 24] == ord('Y')
+
+    appointment_type = pd.Series(fixed_column(fixed, 10, 12), dtype=object)
+    appointment = appointment_type.map(APPOINTMENT_TYPES)
+    unknown = appointment.isna()
+    if unknown.any():
+        for appointment_code, count in appointment_type[unknown].value_counts().items():
+            print(f'New appointment type : {appointment_code} not included in the dictionary! ({count} records)')
+        appointment[unknown] = appointment_type[unknown]
+    columns['appointment'] = appointment.tolist()
+
+    columns['appointment_date'] = to_objects(fixed_column(fixed, 32, 40), strip=True)
+    # not a column of the tables (see PERSON_COLUMNS), snapshot_store reads it to apply the resignations of updates
+    columns['resignation_date'] = to_objects(fixed_column(fixed, 40, 48), strip=True)
+    # the full date of birth when given, the partial one otherwise
+    columns['DOB'] = [full.strip() or partial.strip() or None 
+                      for full, partial in zip(fixed_column(fixed, 64, 72), fixed_column(fixed, 56, 64))]
+    columns['person_postcode'] = to_objects(fixed_column(fixed, 48, 56), strip=True)
+
+    return columns
+
+
+def new_summary(path):
+    return {'file': path, 'file_info': None, 'run_number': None, 'production_date': None,
+            'record_count': None, 'companies': 0, 'persons': 0, 'stop': False}
+
+
+def iter_snapshot_blocks(path, summary, block_size=2**25, encoding=None):
+    '''
+    Yield the (companies, persons) columns of the file block by block (see
+    decode_block), filling summary (see new_summary) as the file is read.
+    company_row of the persons counts from the first company of the file.
+    '''
+    first_line = 0
+    first_company = 0
+    for block in iter_blocks(path, block_size):
+        companies, persons = decode_block(block, summary, first_line, encoding)
+        persons['company_row'] += first_company
+        first_company += len(companies['company_number'])
+        first_line += block.count(b'\n')
+        yield companies, persons
+        if summary['stop']:
+            break
+
+
+def concat_columns(blocks, names):
+    columns = {}
+    for name in names:
+        parts = [block[name] for block in blocks]
+        if parts and isinstance(parts[0], np.ndarray):
+            columns[name] = np.concatenate(parts)
+        else:
+            columns[name] = [value for part in parts for value in part]
+    return columns
+
+
+def to_frames(companies, persons):
+    # DataFrames of decoded columns, built once per table so that every column gets one dtype
+    return pd.DataFrame(companies, columns=COMPANY_COLUMNS), pd.DataFrame(persons, columns=PERSON_COLUMNS)
+
+
+def read_snapshot(path, block_size=2**25, encoding=None):
+    '''
+    Decode a whole Prod195 file.
+
+    Keyword arguments:
+    path -- snapshot (DDDDSNAP) or update (DDDDUPDT) file
+    block_size -- bytes decoded at a time, bounds the memory of the arrays
+    encoding -- encoding of non-ASCII blocks, None for the locale default
+
+    Returns (companies, persons, summary) with DataFrames of the companies
+    and persons, where persons['company_row'] is the row of the company of
+    each person in companies
+    '''
+    summary = new_summary(path)
+    blocks = list(iter_snapshot_blocks(path, summary, block_size, encoding))
+    companies, persons = to_frames(concat_columns([b[0] for b in blocks], COMPANY_COLUMNS),
+                                   concat_columns([b[1] for b in blocks], PERSON_COLUMNS))
+    return companies, persons, summary
+
+
+def appointment_table(companies, persons):
+    # One row per appointment with the fields of its company in front, as built by the per-line scraper
+    table = companies.iloc[persons['company_row'].to_numpy()].reset_index(drop=True)
+    return pd.concat([table, persons.drop(columns=['company_row', 'company_number']).reset_index(drop=True)], axis=1)
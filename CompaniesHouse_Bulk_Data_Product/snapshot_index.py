@@ -0,0 +1,159 @@
+'''
+
+Companies House Prod195 Snapshot Index
+
+Random access to the officers of single companies in the raw Prod195 files. Every file is memory-mapped once and
+scanned for its company (type 1) records; the index keeps the byte range of each company record together with the run
+of person (type 2) records that follows it, sorted by company number. A lookup then decodes only the lines of the
+requested companies (with snapshot_decoder.decode_block) instead of parsing the whole snapshot. The index can be saved
+next to the files and loaded again as long as it was saved for the same files and they are unchanged.
+
+'''
+
+import os
+import mmap
+
+import numpy as np
+
+import snapshot_decoder
+
+
+def company_ranges(buf, chunk_size=2**26):
+    '''
+    Byte ranges of the companies of a mapped Prod195 file.
+
+    Returns (company numbers, starts, ends), where buf[start:end] is the
+    company record and its person records
+    '''
+    codes = np.frombuffer(buf, dtype=np.uint8)
+    size = len(codes)
+    # the records end where the trailer begins
+    trailer = buf.rfind(b'\n' + snapshot_decoder.TRAILER.encode())
+    end = trailer + 1 if trailer >= 0 else size
+
+    starts = []
+    for offset in range(0, end, chunk_size):
+        # every line but the first (header) starts after a line break
+        line_starts = np.flatnonzero(codes[offset:min(offset + chunk_size, end)] == snapshot_decoder.NEWLINE) + offset + 1
+        line_starts = line_starts[line_starts + 9 <= end]
+        starts.append(line_starts[codes[line_starts + 8] == ord('1')])
+    starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+
+    numbers = np.lib.stride_tricks.sliding_window_view(codes, 8)[starts].copy().view('S8').ravel()
+    ends = np.append(starts[1:], end)
+    return numbers, starts.astype(np.int64), ends.astype(np.int64)
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class SnapshotIndex:
+    '''
+    Company number index over the memory-mapped Prod195 files.
+
+    Keyword arguments:
+    files -- Prod195 files to index, e.g. the files of one snapshot
+    encoding -- encoding of non-ASCII records, None for the locale default
+    index -- (numbers, file ids, starts, ends) arrays of a saved index,
+             see load, instead of scanning the files
+    '''
+
+    def __init__(self, files, encoding=None, index=None):
+        self.files = list(files)
+        self.encoding = encoding
+        self.maps = []
+        for path in self.files:
+            with open(path, 'rb') as f:
+                self.maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        if index is None:
+            parts = [company_ranges(buf) for buf in self.maps]
+            numbers = np.concatenate([part[0] for part in parts]) if parts else np.zeros(0, dtype='S8')
+            file_ids = np.concatenate([np.full(len(part[0]), i, dtype=np.int32) for i, part in enumerate(parts)]) \
+                if parts else np.zeros(0, dtype=np.int32)
+            starts = np.concatenate([part[1] for part in parts]) if parts else np.zeros(0, dtype=np.int64)
+            ends = np.concatenate([part[2] for part in parts]) if parts else np.zeros(0, dtype=np.int64)
+            # stable, so that a company found in several files keeps the order of the files
+            order = np.argsort(numbers, kind='stable')
+            index = numbers[order], file_ids[order], starts[order], ends[order]
+        self.numbers, self.file_ids, self.starts, self.ends = index
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __contains__(self, company_number):
+        key = np.array([company_number.encode()], dtype='S8')
+        i = np.searchsorted(self.numbers, key)[0]
+        return i < len(self.numbers) and self.numbers[i] == key[0]
+
+    def close(self):
+        for buf in self.maps:
+            buf.close()
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def positions(self, company_numbers):
+        # Index positions of the requested companies, in the order asked for, unknown numbers are left out
+        keys = np.array([number.encode() for number in company_numbers], dtype='S8')
+        left = np.searchsorted(self.numbers, keys, side='left')
+        right = np.searchsorted(self.numbers, keys, side='right')
+        return np.concatenate([np.arange(l, r) for l, r in zip(left, right)]) if len(keys) else np.zeros(0, dtype=np.int64)
+
+    def lookup(self, company_numbers):
+        '''
+        Decode the records of the given companies.
+
+        Returns (companies, persons) DataFrames as snapshot_decoder.read_snapshot,
+        persons['company_row'] being the row of each person's company
+        '''
+        positions = self.positions(company_numbers)
+        block = b''.join(self.maps[self.file_ids[i]][self.starts[i]:self.ends[i]] for i in positions)
+        summary = snapshot_decoder.new_summary(None)
+        # first_line > 0, the block does not start with the header
+        companies, persons = snapshot_decoder.decode_block(block, summary, first_line=1, encoding=self.encoding)
+        return snapshot_decoder.to_frames(companies, persons)
+
+    def appointments(self, company_numbers):
+        # One row per appointment of the given companies, as in the scraper's table
+        return snapshot_decoder.appointment_table(*self.lookup(company_numbers))
+
+    def save(self, path):
+        # Store the index arrays with the size and modification time of the files they were built from
+        stamps = np.array([file_stamp(file) for file in self.files], dtype=np.int64).reshape(-1, 2)
+        np.savez(path, files=np.array(self.files, dtype=str), stamps=stamps, numbers=self.numbers,
+                 file_ids=self.file_ids, starts=self.starts, ends=self.ends)
+
+    @classmethod
+    def load(cls, path, encoding=None, files=None):
+        '''
+        Open a saved index. It is built again (see build) when files are
+        given and are not the ones it was saved for, or when its files
+        changed since it was saved.
+        '''
+        with np.load(path) as saved:
+            saved_files = [str(file) for file in saved['files']]
+            if files is not None and list(files) != saved_files:
+                print('{} indexes other files, indexing the files given'.format(path))
+                return cls.build(files, path, encoding)
+            files = saved_files
+            stamps = [tuple(stamp) for stamp in saved['stamps'].tolist()]
+            if any(not os.path.exists(file) or file_stamp(file) != stamp for file, stamp in zip(files, stamps)):
+                print('{} is out of date, indexing the files again'.format(path))
+                return cls.build(files, path, encoding)
+            index = saved['numbers'], saved['file_ids'], saved['starts'], saved['ends']
+        return cls(files, encoding, index)
+
+    @classmethod
+    def build(cls, files, path=None, encoding=None):
+        # Index the files and save the index to path if given
+        index = cls(files, encoding)
+        if path is not None:
+            index.save(path)
+        return index
@@ -0,0 +1,223 @@
+'''
+
+Companies House Prod195 Snapshot Store
+
+Persistent SQLite store of the officers snapshot, keyed by company number (companies) and by company number, person
+number and appointment type (appointments). A full snapshot (DDDDSNAP files) is loaded once, after which every update
+file (DDDDUPDT) is applied on top of it in run_number order. An update file only lists the appointments that
+changed, so its records are applied one by one in file order: a company record replaces the stored company, a current
+appointment is inserted or replaces the stored one, and a resigned appointment (a resigned appointment type or a
+resignation date) deletes the appointment it ends. The other appointments of the company are kept. A refresh then only
+reads and writes the records of the update files. Every file applied is recorded with its run number, so an update is
+never applied twice and gaps in the run numbers are reported. A file without its trailer record is refused.
+
+'''
+
+import os
+import sqlite3
+import itertools
+
+import pandas as pd
+
+import snapshot_decoder
+
+
+COMPANY_FIELDS = ['company_number', 'company_name', 'company_status', 'num_officers']
+APPOINTMENT_FIELDS = ['company_number', 'person_number', 'appointment'] + \
+                     snapshot_decoder.PERSON_INFO_CATEGORIES[:-1] + \
+                     ['is_corp', 'appointment_date', 'DOB', 'person_postcode']
+
+
+# Appointment a resigned appointment type ends, e.g. 'Resigned Director' -> 'Current Director'
+ENDED_APPOINTMENTS = {snapshot_decoder.APPOINTMENT_TYPES[resigned]: snapshot_decoder.APPOINTMENT_TYPES[current]
+                      for resigned, current in snapshot_decoder.RESIGNED_TYPES.items()}
+
+
+def sql_name(field):
+    # 'address line 1' -> address_line_1
+    return field.replace(' ', '_')
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS companies (
+    company_number TEXT PRIMARY KEY,
+    company_name TEXT,
+    company_status TEXT,
+    num_officers INTEGER,
+    run_number INTEGER
+);
+CREATE TABLE IF NOT EXISTS appointments (
+    {appointment_columns},
+    run_number INTEGER,
+    PRIMARY KEY (company_number, person_number, appointment)
+);
+CREATE INDEX IF NOT EXISTS appointments_person ON appointments (person_number);
+CREATE TABLE IF NOT EXISTS runs (
+    file TEXT,
+    file_info TEXT,
+    run_number INTEGER,
+    production_date TEXT,
+    companies INTEGER,
+    appointments INTEGER
+);
+'''.format(appointment_columns=',\n    '.join('{} {}'.format(sql_name(field), 'INTEGER' if field == 'is_corp' else 'TEXT')
+                                                for field in APPOINTMENT_FIELDS))
+
+
+def ended_appointments(persons):
+    # The appointment each person record ends, None for the records of current appointments
+    return [ENDED_APPOINTMENTS.get(appointment, appointment if resignation_date else None)
+            for appointment, resignation_date in zip(persons['appointment'], persons['resignation_date'])]
+
+
+def read_header(path):
+    # (file_info, run_number, production_date) from the header record of a Prod195 file
+    with open(path, 'r') as file:
+        file_info, run_number, production_date = snapshot_decoder.decode_header(file.readline())
+    return file_info, int(run_number), production_date
+
+
+class SnapshotStore:
+    '''
+    SQLite store of the companies and appointments of the latest snapshot
+    with its updates applied.
+
+    Keyword arguments:
+    path -- SQLite database file, created if it does not exist
+    block_size -- bytes of a Prod195 file decoded at a time
+    '''
+
+    def __init__(self, path, block_size=2**25):
+        self.path = path
+        self.block_size = block_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def run_number(self):
+        # run number of the last snapshot or update applied, None for an empty store
+        return self.connection.execute('SELECT MAX(run_number) FROM runs').fetchone()[0]
+
+    def runs(self):
+        return pd.read_sql_query('SELECT * FROM runs ORDER BY rowid', self.connection)
+
+    def write_block(self, companies, persons, run_number):
+        '''
+        Write the companies and appointments of a decoded block. The person
+        records are applied in file order, a run of current appointments
+        at a time (inserted or replacing the stored ones) and a run of
+        resigned ones at a time (deleting the appointments they end).
+        '''
+        numbers = companies['company_number']
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO companies VALUES (?, ?, ?, ?, ?)',
+            zip(numbers, companies['company_name'], companies['company_status'],
+                (int(n) for n in companies['num_officers']), [run_number] * len(numbers)))
+
+        columns = [persons[field] if field != 'is_corp' else [int(corp) for corp in persons[field]]
+                   for field in APPOINTMENT_FIELDS]
+        rows = list(zip(*columns, [run_number] * len(persons['company_number'])))
+        ended = ended_appointments(persons)
+        for resigned, run in itertools.groupby(range(len(rows)), key=lambda i: ended[i] is not None):
+            if resigned:
+                self.connection.executemany(
+                    'DELETE FROM appointments WHERE company_number = ? AND person_number = ? AND appointment = ?',
+                    ((persons['company_number'][i], persons['person_number'][i], ended[i]) for i in run))
+            else:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO appointments VALUES ({})'.format(', '.join('?' * (len(APPOINTMENT_FIELDS) + 1))),
+                    (rows[i] for i in run))
+
+    def write_file(self, path, expected):
+        '''
+        Decode one Prod195 file into the store and record it in runs,
+        within the current transaction. Returns its summary
+        '''
+        summary = snapshot_decoder.new_summary(path)
+        for companies, persons in snapshot_decoder.iter_snapshot_blocks(path, summary, self.block_size):
+            if summary['file_info'] != expected:
+                raise ValueError('{} is a {}, expected a {}'.format(path, summary['file_info'], expected))
+            self.write_block(companies, persons, int(summary['run_number']))
+
+        records = summary['companies'] + summary['persons']
+        # a file cut short would lose the changes of the records it is missing
+        if summary['record_count'] is None:
+            raise ValueError('{}: no trailer record, the file is incomplete'.format(path))
+        if summary['record_count'] != records:
+            raise ValueError('{}: trailer record count {} but {} records read'.format(path, summary['record_count'], records))
+        self.connection.execute('INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)',
+                                (os.path.basename(path), summary['file_info'], int(summary['run_number']),
+                                 summary['production_date'], summary['companies'], summary['persons']))
+        return summary
+
+    def load_snapshot(self, files):
+        '''
+        Replace the whole store with a snapshot, given as the list of its
+        DDDDSNAP files, which all share one run number.
+        '''
+        runs = {read_header(path)[1] for path in files}
+        if len(runs) != 1:
+            raise ValueError('Snapshot files of different runs: {}'.format(sorted(runs)))
+
+        with self.connection:
+            for table in ('companies', 'appointments', 'runs'):
+                self.connection.execute('DELETE FROM {}'.format(table))
+            summaries = [self.write_file(path, 'snapshot_file') for path in files]
+        return summaries
+
+    def apply_updates(self, files):
+        '''
+        Apply update (DDDDUPDT) files in run number order. Files at or
+        below the run number of the store are skipped, as already applied,
+        and a gap in the run numbers is reported. Each file is applied in
+        its own transaction. Returns the summaries of the files applied
+        '''
+        current = self.run_number
+        if current is None:
+            raise ValueError('Load a snapshot before applying updates')
+
+        summaries = []
+        for run_number, path in sorted((read_header(path)[1], path) for path in files):
+            if run_number <= current:
+                print('{}: run {} is already applied (store at run {}), skipped'.format(path, run_number, current))
+                continue
+            if run_number != current + 1:
+                print('{}: run {} follows run {}, the runs in between are missing!'.format(path, run_number, current))
+            with self.connection:
+                summaries.append(self.write_file(path, 'update_file'))
+            current = run_number
+        return summaries
+
+    def company(self, company_number):
+        '''
+        (company row, DataFrame of its appointments) of one company, the
+        company row is None if it is not in the store.
+        '''
+        company = pd.read_sql_query('SELECT * FROM companies WHERE company_number = ?', self.connection,
+                                    params=(company_number,))
+        appointments = pd.read_sql_query('SELECT * FROM appointments WHERE company_number = ?', self.connection,
+                                         params=(company_number,))
+        return (company.iloc[0] if len(company) else None), self.field_names(appointments)
+
+    def tables(self):
+        # The whole store as (companies, appointments) DataFrames, in the columns of snapshot_writer's tables
+        companies = pd.read_sql_query('SELECT * FROM companies', self.connection)
+        appointments = pd.read_sql_query('SELECT * FROM appointments', self.connection)
+        return companies, self.field_names(appointments)
+
+    @staticmethod
+    def field_names(appointments):
+        appointments = appointments.rename(columns={sql_name(field): field for field in APPOINTMENT_FIELDS})
+        appointments['is_corp'] = appointments['is_corp'].astype(bool)
+        return appointments
@@ -0,0 +1,122 @@
+'''
+
+Companies House Prod195 Parquet Writer
+
+Normalised output of the snapshot scraper: a companies table with one row per company and an appointments table with
+one row per person record, linked by company_number, instead of the company fields copied into every appointment.
+Each Prod195 file is written block by block as it is decoded (see snapshot_decoder.iter_snapshot_blocks), to
+<output_dir>/companies/<file>.parquet and <output_dir>/appointments/<file>.parquet, so a worker only ever holds one
+block and the files of a snapshot together form one dataset.
+
+'''
+
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import snapshot_decoder
+
+
+COMPANY_SCHEMA = pa.schema([('company_number', pa.string()),
+                            ('company_name', pa.string()),
+                            ('company_status', pa.dictionary(pa.int8(), pa.string())),
+                            ('num_officers', pa.int32())])
+
+APPOINTMENT_SCHEMA = pa.schema([('company_number', pa.string())] +
+                               [(category, pa.string()) for category in snapshot_decoder.PERSON_INFO_CATEGORIES[:-1]] +
+                               [('person_number', pa.string()),
+                                ('is_corp', pa.bool_()),
+                                ('appointment', pa.dictionary(pa.int8(), pa.string())),
+                                ('appointment_date', pa.string()),
+                                ('DOB', pa.string()),
+                                ('person_postcode', pa.string())])
+
+
+def block_table(columns, schema):
+    # Decoded columns of a block as a table of the fixed schema, so every block of every file has the same types
+    arrays = []
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(columns[field.name], type=pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(columns[field.name], type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class SnapshotWriter:
+    '''
+    Stream the companies and appointments of one Prod195 file to Parquet.
+    The files are written under a temporary name and moved in place on
+    close, so a rerun replaces the output of the file and a crashed run
+    leaves no half written file behind.
+
+    Keyword arguments:
+    output_dir -- root directory of the companies and appointments tables
+    name -- name of the output files, e.g. the Prod195 file name
+    row_group_size -- maximum number of rows per Parquet row group
+    '''
+
+    def __init__(self, output_dir, name, row_group_size=100000):
+        self.row_group_size = row_group_size
+        self.paths = {}
+        self.writers = {}
+        for table, schema in (('companies', COMPANY_SCHEMA), ('appointments', APPOINTMENT_SCHEMA)):
+            os.makedirs(os.path.join(output_dir, table), exist_ok=True)
+            self.paths[table] = os.path.join(output_dir, table, name + '.parquet')
+            self.writers[table] = pq.ParquetWriter(self.temp_path(table), schema)
+        self.rows = {'companies': 0, 'appointments': 0}
+
+    def temp_path(self, table):
+        # hidden, so that readers of the dataset skip it
+        directory, name = os.path.split(self.paths[table])
+        return os.path.join(directory, '.' + name + '.tmp')
+
+    def write(self, companies, persons):
+        for table, columns, schema in (('companies', companies, COMPANY_SCHEMA),
+                                       ('appointments', persons, APPOINTMENT_SCHEMA)):
+            block = block_table(columns, schema)
+            self.writers[table].write_table(block, row_group_size=self.row_group_size)
+            self.rows[table] += block.num_rows
+
+    def close(self):
+        for table, writer in self.writers.items():
+            writer.close()
+            os.replace(self.temp_path(table), self.paths[table])
+
+    def abort(self):
+        for table, writer in self.writers.items():
+            writer.close()
+            os.remove(self.temp_path(table))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_snapshot_file(data, output_dir, block_size=2**25, row_group_size=100000):
+    '''
+    Decode one Prod195 file block by block into the companies and
+    appointments tables of output_dir. Returns the summary of the file (see
+    snapshot_decoder.new_summary)
+    '''
+    summary = snapshot_decoder.new_summary(data)
+    with SnapshotWriter(output_dir, os.path.basename(data), row_group_size) as writer:
+        for companies, persons in snapshot_decoder.iter_snapshot_blocks(data, summary, block_size):
+            writer.write(companies, persons)
+    return summary
+
+
+def read_snapshot_tables(output_dir, columns=None):
+    '''
+    Read the companies and appointments tables back as DataFrames.
+    columns optionally restricts the appointment columns read.
+    '''
+    companies = pq.read_table(os.path.join(output_dir, 'companies')).to_pandas()
+    appointments = pq.read_table(os.path.join(output_dir, 'appointments'), columns=columns).to_pandas()
+    return companies, appointments
@@ -25,9 +25,13 @@ from random import randint
 from multiprocessing import Pool, cpu_count
 import operator
 
+import namesake_classifier
+import namesake_resolver
+import officer_loader
 
-def person_classifier(row, persons_dict, person_number): 
-    if row['DOB'] != '0-0':
+
+def person_classifier(row, persons_dict, person_number, no_dob='0-0'): 
+    if row['DOB'] != no_dob:
         if row['DOB'] in persons_dict:
             return persons_dict[row['DOB']]
         else:
@@ -45,7 +49,7 @@ def person_classifier(row, persons_dict, person_number):
     return '*'
 
 
-def worker_function(names_chunk, officer_data_DF):
+def worker_function(names_chunk, officer_data_DF, no_dob='0-0'):
 	output = pd.DataFrame()
 	if len(names_chunk) == 0: 
 		return output
@@ -54,24 +58,52 @@ def worker_function(names_chunk, officer_data_DF):
 		entries = officer_data_DF[officer_data_DF['name'] == name].copy()
 		persons_dict = {}
 		person_number = [1]
-		entries['person_classification'] = entries.apply(lambda row: person_classifier(row, persons_dict, person_number), axis=1)
+		entries['person_classification'] = entries.apply(lambda row: person_classifier(row, persons_dict, person_number, no_dob), axis=1)
 		output = pd.concat([output, entries])
 	return output
 
 
-def name_classifier(officer_data_DF): 
+# 'groups' classifies every name at once with vectorised group operations (namesake_classifier), 'shared' does the
+# same on a worker pool reading the table from shared memory, 'rows' runs person_classifier over the rows of each name
+# on a worker pool. 'resolve' links rows through their DOB and postal code regardless of the row order
+# (namesake_resolver) and adds a person_id over all names, so main() resolves every person row with it, not only the
+# duplicated names, and keeps person_id in the output
+classifier_engine = 'groups'
+
+
+def name_classifier(officer_data_DF, engine=classifier_engine, no_dob='0-0', missing_dob=None): 
+    # no_dob and missing_dob are the unknown and missing DOB of the table, officer_loader's NO_DOB and MISSING_DOB
+    # for parsed dates of birth. The classifiers are given a missing DOB as NaN, as read from the merge files
+    classify_DF = officer_data_DF
+    if missing_dob is not None: 
+        dob = officer_data_DF['DOB']
+        classify_DF = officer_data_DF.assign(DOB=dob.astype(object).where(dob != missing_dob, np.nan))
+
+    if engine in ('groups', 'shared', 'resolve'): 
+        output = officer_data_DF.copy()
+        if engine == 'resolve': 
+            output[['person_id', 'person_classification']] = namesake_resolver.resolve_namesakes(classify_DF, no_dob=no_dob)
+        elif engine == 'shared': 
+            output['person_classification'] = namesake_classifier.classify_namesakes_shared(classify_DF, no_dob=no_dob)
+        else: 
+            output['person_classification'] = namesake_classifier.classify_namesakes(classify_DF, no_dob=no_dob)
+        print(f'output dataframe length : {len(output)}')
+        return output
+
     names = list(set(officer_data_DF['name'].values))
     # Split the names into chunks, one for each CPU core
     num_cores = cpu_count()
     names_chunks = [names[i::num_cores] for i in range(num_cores)]
     
     with Pool(num_cores) as pool:
-        results = pool.starmap(worker_function, [(chunk, officer_data_DF) for chunk in names_chunks])
+        results = pool.starmap(worker_function, [(chunk, classify_DF, no_dob) for chunk in names_chunks])
         
     for r in results: 
     	print(f'dataframe length : {len(r)}')
     # Concatenate the results from all the workers
     output = pd.concat(results)
+    if missing_dob is not None: 
+        output['DOB'] = officer_data_DF['DOB'].loc[output.index]
     print(f'output dataframe length : {len(output)}')
     return output
 
@@ -87,38 +119,68 @@ def process_row(row, Names, CompanyDict):
         return row['name'], False
 
 
-def main():
-	merge_1_2 = pd.read_csv('merge_1_2_monthly.csv', dtype = str)
-	merge_3_5_6 = pd.read_csv('merge_3_5_6_monthly.csv', dtype = str)
-	merge_4 = pd.read_csv('merge_4_monthly.csv', dtype = str)
-	merge_7_12 = pd.read_csv('merge_7_12_monthly.csv', dtype = str)
-	merge = pd.concat([merge_1_2, merge_3_5_6, merge_4, merge_7_12])
-	# merge = pd.concat([merge_1_2, merge_4])
-	del merge_1_2, merge_3_5_6, merge_7_12, merge_4
+COMPANY_NUMBER_PATTERN = re.compile(r'\w{2}\d{6}')
+COMPANY_NAME_PATTERN = re.compile('(?i)LIMITED|LTD')
 
 
+def route_rows(names, CompanyDict): 
+    '''
+    process_row over a whole column of names at once: every distinct name
+    is looked up in CompanyDict (a hash join) and matched against the
+    company number and company name patterns once.
 
-	merge.drop_duplicates(subset=['name', 'company_id', 'type'], keep='last', inplace=True)
-	merge.drop_duplicates(subset=['name', 'company_id', 'DOB'], keep='last', inplace=True)
-	merge.drop_duplicates(subset=['name', 'company_id', 'postal_code'], keep='last', inplace=True)
-	merge.reset_index(drop=True, inplace=True)
+    Returns (names with the known company names replaced by their number,
+    comp_link boolean array)
+    '''
+    codes, uniques = pd.factorize(names, use_na_sentinel=False)
+    uniques = pd.Series(np.asarray(uniques, dtype=object))
+    position = pd.Index(list(CompanyDict.keys()), dtype=object).get_indexer(uniques)
+    known = position >= 0
+    # str() of every name, as process_row searches, kept as object so that the compiled patterns run with Python's
+    # (Unicode) \w rather than on an Arrow string column
+    text = pd.Series([str(name) for name in uniques], dtype=object)
+    is_company = known | text.str.contains(COMPANY_NUMBER_PATTERN).to_numpy() | text.str.contains(COMPANY_NAME_PATTERN).to_numpy()
+
+    routed = uniques.to_numpy(copy=True)
+    routed[known] = np.asarray(list(CompanyDict.values()), dtype=object)[position[known]]
+    return routed[codes], is_company[codes]
+
+
+# Monthly merge files of the collector notebook, read in chunks of load_chunksize rows into dictionary encoded columns,
+# datetime64 start and end dates and int32 dates of birth, and deduplicated on their integer codes (officer_loader).
+# spill_dir keeps the encoded chunks and the deduplication keys on disk while loading, None to keep them in memory
+merge_files = ['merge_1_2_monthly.csv', 'merge_3_5_6_monthly.csv', 'merge_4_monthly.csv', 'merge_7_12_monthly.csv']
+load_chunksize = 10**6
+spill_dir = None
+
+
+def main():
+	merge = officer_loader.load_merge_files(merge_files, chunksize=load_chunksize, spill_dir=spill_dir, parse_dates=True)
+	dob_values = {'no_dob': officer_loader.NO_DOB, 'missing_dob': officer_loader.MISSING_DOB}
 
 
 
 	CompanyNumberName = pd.read_csv('CompanyNumberName.csv')
 	CompanyDict = CompanyNumberName.set_index('CompanyName')['CompanyNumber'].to_dict()
-	Names = set(CompanyDict.keys())
+	merge['name'], comp_link = route_rows(merge['name'], CompanyDict)
 
-	results = merge.apply(lambda row: process_row(row, Names, CompanyDict), axis=1)
-	merge.loc[:, 'name'], comp_link = zip(*results)
-
-	comp_link = list(comp_link)
 	pers_link = np.logical_not(comp_link)
 	merge_comp = merge[comp_link]
 	merge_pers = merge[pers_link]
 	print(f'merge length {len(merge)}; comp_link {len(merge_comp)}; pers_link {len(merge_pers)}')
 	# assert len(merge_comp) + len(merge_pers) == len(merge), f'merge length {len(merge)} is not the sum of comp_link {len(merge_comp)} and pers_link {len(merge_pers)}'
 
+	if classifier_engine == 'resolve': 
+		# person_id numbers the persons over the whole table, so every person row is resolved, not only the names
+		# found more than once, and the id is kept in the output
+		print('Start Processing （っ＾▿＾)っ!')
+		pers_set = name_classifier(merge_pers, engine='resolve', **dob_values)
+		output_set = officer_loader.merge_text(pd.concat([merge_comp, pers_set]))
+		output_set.to_csv('FINAL_OUTPUT_MONTHLY.csv', index = False)
+		print(f'OUTPUT LENGTH : {len(output_set)}, INPUT LENGTH : {len(merge)}')
+		print(f'persons : {pers_set["person_id"].max() + 1} ; unlinked rows : {(pers_set["person_id"] < 0).sum()}')
+		return
+
 	no_dup = merge_pers.drop_duplicates(subset=['name'], keep=False, inplace=False)
 	no_dup.reset_index(drop=True, inplace=True)
 	good_set = pd.concat([merge_comp, no_dup])
@@ -131,13 +193,13 @@ def main():
 
 
 	print('Start Processing （っ＾▿＾)っ!')
-	dups = name_classifier(duplicates)
+	dups = name_classifier(duplicates, **dob_values)
 	print(f'duplicates length : {len(duplicates)} ; ####### output length : {len(dups)}')
 
 	# dups['name'] = dups['name'] + ' ' + dups['person_classification'].astype(str)
-	fixed_dup_set = dups[['name', 'relation', 'kind', 'company_id', 'start', 'end', 'postal_code', 'DOB', 'type', 'person_classification']]
+	fixed_dup_set = dups[list(duplicates.columns) + ['person_classification']]
 
-	output_set = pd.concat([good_set, fixed_dup_set])
+	output_set = officer_loader.merge_text(pd.concat([good_set, fixed_dup_set]))
 	# print(len(output_set))
 	output_set.to_csv('FINAL_OUTPUT_MONTHLY.csv', index = False)
 	print(f'OUTPUT LENGTH : {len(output_set)}, INPUT LENGTH : {len(merge)}')
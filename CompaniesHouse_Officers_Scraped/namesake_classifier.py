@@ -0,0 +1,256 @@
+'''
+
+Company House Officers Namesake Classifier
+
+Vectorised version of the person_classifier rules of CompanyOfficers_Namesake_Fix.py, run over all names at once
+instead of filtering the table once per name. Within every name, rows are taken in table order and numbered from 1:
+
+- a row with a date of birth gets the number of the first row with that date of birth, or a new number if it is the
+  first, which also becomes the number of its postal code;
+- a row without a date of birth but with a postal code gets the number last given to that postal code, or a new
+  number if the postal code has not been seen yet;
+- a row with neither is classified as '*'.
+
+The table is factorised into integer codes once, and the rules become duplicated, cumsum, first and forward fill
+operations grouped by (name), (name, date of birth) and (name, postal code). person_classifier keeps the dates of birth
+and postal codes of a name in one dict, so a value found in both (e.g. missing values) links them; the few names where
+that happens are numbered row by row instead, with the same dict logic on the integer codes.
+
+classify_namesakes_shared runs the same classification on a worker pool, handing the encoded table to the workers
+through shared memory instead of pickling it to every one of them.
+
+'''
+
+from multiprocessing import Pool, cpu_count, shared_memory
+
+import numpy as np
+import pandas as pd
+
+
+def codes(values):
+    # Integer code of every value, missing values being a value of their own as in the per-row dict
+    return pd.factorize(values, use_na_sentinel=False)[0].astype(np.int64)
+
+
+def shared_codes(first, second):
+    # Codes of two columns in one code space, so that equal values of either column get the same code
+    joint = codes(pd.concat([first, second], ignore_index=True))
+    return joint[:len(first)], joint[len(first):]
+
+
+def pair_key(first, second):
+    # One int64 key per (first, second) pair of codes
+    return first * (int(second.max()) + 1 if len(second) else 1) + second
+
+
+def first_in_group(keys):
+    # True for the first row of every key, in row order
+    return ~pd.Series(keys).duplicated().to_numpy()
+
+
+def classify_codes(names, dobs, postcodes, has_dob, has_postcode):
+    '''
+    Person numbers of the rows from their integer codes, 0 for the rows
+    classified as '*'.
+
+    Keyword arguments:
+    names, dobs, postcodes -- int64 codes of the name, DOB and postal code
+    has_dob -- rows with a date of birth
+    has_postcode -- rows without a date of birth but with a postal code
+    '''
+    n = len(names)
+    dob_key = pair_key(names, dobs)
+    postcode_key = pair_key(names, postcodes)
+
+    # first row of every (name, DOB)
+    dob_rows = np.flatnonzero(has_dob)
+    new_dob = np.zeros(n, dtype=bool)
+    new_dob[dob_rows] = first_in_group(dob_key[dob_rows])
+
+    # rows that set or look up the number of a postal code: a postal code is new unless an earlier new DOB or
+    # postal code row of the name had it
+    postcode_rows = np.flatnonzero(new_dob | has_postcode)
+    new_postcode = np.zeros(n, dtype=bool)
+    new_postcode[postcode_rows] = first_in_group(postcode_key[postcode_rows]) & has_postcode[postcode_rows]
+
+    new = new_dob | new_postcode
+    number = pd.Series(new.astype(np.int64)).groupby(names, sort=False).cumsum().to_numpy()
+    person = np.where(new, number, 0)
+
+    # a known DOB takes the number of its first row
+    person[dob_rows] = pd.Series(person[dob_rows]).groupby(dob_key[dob_rows], sort=False).transform('first').to_numpy()
+
+    # a known postal code takes the number its latest new DOB or new postal code row gave it
+    setters = pd.Series(np.where(new[postcode_rows], person[postcode_rows], np.nan))
+    latest = setters.groupby(postcode_key[postcode_rows], sort=False).ffill().to_numpy()
+    lookups = has_postcode[postcode_rows] & ~new[postcode_rows]
+    person[postcode_rows[lookups]] = latest[lookups].astype(np.int64)
+    return person
+
+
+def shared_key_names(names, dobs, postcodes, has_dob, has_postcode):
+    '''
+    Codes of the names where a value looked up as a date of birth is also
+    a postal code key of the name, given shared_codes() of DOB and postcode.
+    '''
+    top = int(max(dobs.max(), postcodes.max())) + 1 if len(names) else 1
+    postcode_rows = has_dob | has_postcode
+    shared = pd.Series(names[has_dob] * top + dobs[has_dob]).isin(names[postcode_rows] * top + postcodes[postcode_rows])
+    return pd.unique(names[has_dob][shared.to_numpy()])
+
+
+def classify_rows(rows, names, dobs, postcodes, has_dob, has_postcode, person):
+    '''
+    person_classifier on the integer codes of the given rows, one dict of
+    DOB and postal code keys per name. Sets person (0 for '*') in place.
+    '''
+    persons_dicts = {}
+    for i in rows:
+        persons_dict, person_number = persons_dicts.setdefault(names[i], ({}, [1]))
+        if has_dob[i]:
+            if dobs[i] not in persons_dict:
+                persons_dict[dobs[i]] = person_number[0]
+                persons_dict[postcodes[i]] = person_number[0]
+                person_number[0] += 1
+            person[i] = persons_dict[dobs[i]]
+        elif has_postcode[i]:
+            if postcodes[i] not in persons_dict:
+                persons_dict[postcodes[i]] = person_number[0]
+                person_number[0] += 1
+            person[i] = persons_dict[postcodes[i]]
+        else:
+            person[i] = 0
+
+
+def encode_officers(officer_data_DF, name='name', dob='DOB', postcode='postal_code', no_dob='0-0', no_postcode='0'):
+    '''
+    Integer codes of the officers table, the input of classify_person_codes.
+
+    Keyword arguments:
+    officer_data_DF -- officers table
+    name, dob, postcode -- columns of the name, date of birth and postal code
+    no_dob, no_postcode -- values standing for a missing DOB and postal code
+    '''
+    has_dob = (officer_data_DF[dob] != no_dob).to_numpy()
+    has_postcode = ~has_dob & (officer_data_DF[postcode] != no_postcode).to_numpy()
+    dobs, postcodes = shared_codes(officer_data_DF[dob], officer_data_DF[postcode])
+    return {'names': codes(officer_data_DF[name]), 'dobs': dobs, 'postcodes': postcodes,
+            'has_dob': has_dob, 'has_postcode': has_postcode}
+
+
+def classify_person_codes(names, dobs, postcodes, has_dob, has_postcode):
+    # classify_codes, with the names that share a DOB and postal code key numbered row by row
+    person = classify_codes(names, dobs, postcodes, has_dob, has_postcode)
+    shared = shared_key_names(names, dobs, postcodes, has_dob, has_postcode)
+    if len(shared):
+        classify_rows(np.flatnonzero(np.isin(names, shared)), names, dobs, postcodes, has_dob, has_postcode, person)
+    return person
+
+
+def to_classification(person, index):
+    # person numbers as the person_classification column, '*' for 0
+    classification = pd.Series(person, index=index, dtype=object)
+    classification[person == 0] = '*'
+    return classification
+
+
+def classify_namesakes(officer_data_DF, **columns):
+    '''
+    Person classification of every row, as person_classifier would number
+    the rows of each name in table order. columns are passed on to
+    encode_officers.
+
+    Returns a Series on the index of officer_data_DF of the person numbers,
+    '*' where a row has neither a DOB nor a postal code
+    '''
+    person = classify_person_codes(**encode_officers(officer_data_DF, **columns))
+    return to_classification(person, officer_data_DF.index)
+
+
+def share_arrays(arrays):
+    '''
+    Copy arrays into shared memory blocks. Returns (blocks, descriptor),
+    the descriptor is what a worker needs to attach to them (see
+    attach_arrays). The caller closes and unlinks the blocks.
+    '''
+    blocks = []
+    descriptor = {}
+    for key, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        descriptor[key] = (block.name, array.dtype.str, array.shape)
+    return blocks, descriptor
+
+
+def attach_arrays(descriptor):
+    # Zero-copy views of the arrays of share_arrays, with the blocks to keep open while they are used
+    blocks = {key: shared_memory.SharedMemory(name=name) for key, (name, dtype, shape) in descriptor.items()}
+    arrays = {key: np.ndarray(shape, dtype=dtype, buffer=blocks[key].buf) for key, (name, dtype, shape) in descriptor.items()}
+    return blocks, arrays
+
+
+# Arrays of the officers table attached by a worker, see init_worker
+worker_blocks = None
+worker_arrays = None
+
+
+def init_worker(descriptor):
+    global worker_blocks, worker_arrays
+    worker_blocks, worker_arrays = attach_arrays(descriptor)
+
+
+def classify_range(row_range):
+    '''
+    Worker: classify rows start:end of the shared, name sorted table. The
+    range holds whole names, so it is classified on its own. Returns
+    (start, int32 person numbers)
+    '''
+    start, end = row_range
+    part = {key: array[start:end] for key, array in worker_arrays.items()}
+    person = classify_person_codes(part['names'].astype(np.int64), part['dobs'].astype(np.int64),
+                                   part['postcodes'].astype(np.int64), part['has_dob'], part['has_postcode'])
+    return start, person.astype(np.int32)
+
+
+def name_ranges(names, chunk_rows):
+    # (start, end) row ranges of about chunk_rows rows over the sorted name codes, cut only between two names
+    breaks = np.flatnonzero(np.diff(names)) + 1
+    cuts = np.unique(breaks[np.minimum(np.searchsorted(breaks, np.arange(chunk_rows, len(names), chunk_rows)),
+                                       len(breaks) - 1)]) if len(breaks) else np.zeros(0, dtype=np.int64)
+    bounds = np.concatenate([[0], cuts, [len(names)]])
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def classify_namesakes_shared(officer_data_DF, num_workers=None, chunk_rows=2**20, **columns):
+    '''
+    classify_namesakes on a worker pool. The table is encoded once, sorted
+    by name and copied into shared memory as compact integer and boolean
+    arrays that the workers attach to without copying. Workers are sent
+    only row ranges holding whole names and send back int32 person numbers.
+
+    Keyword arguments:
+    officer_data_DF -- officers table
+    num_workers -- number of worker processes, None for cpu_count()
+    chunk_rows -- about the number of rows classified per task
+    columns -- passed on to encode_officers
+    '''
+    encoded = encode_officers(officer_data_DF, **columns)
+    order = np.argsort(encoded['names'], kind='stable')
+    arrays = {key: (array[order].astype(np.int32) if array.dtype != bool else array[order])
+              for key, array in encoded.items()}
+    del encoded
+
+    person = np.zeros(len(order), dtype=np.int64)
+    blocks, descriptor = share_arrays(arrays)
+    try:
+        ranges = name_ranges(arrays['names'], chunk_rows)
+        del arrays
+        with Pool(num_workers or cpu_count(), initializer=init_worker, initargs=(descriptor,)) as pool:
+            for start, part in pool.imap_unordered(classify_range, ranges):
+                person[order[start:start + len(part)]] = part
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return to_classification(person, officer_data_DF.index)
@@ -0,0 +1,134 @@
+'''
+
+Company House Officers Namesake Resolver
+
+Entity resolution of officers (and persons with significant control) sharing a name, independent of the row order.
+Rows are linked through two blocking indexes: rows with the same name and date of birth, and rows with the same name
+and postal code. A postal code block with two or more known dates of birth only links its rows without one, so that
+two people of the same name living at one address (e.g. parent and child) stay apart. The links are merged with an
+array-based disjoint set (union-find), so a row linking two earlier clusters merges them, unlike person_classifier.
+
+Every cluster gets a person_id over the whole table and a person_classification numbered from 1 within its name, both
+ordered by the values of the cluster (name, then its smallest date of birth, then its smallest postal code) rather
+than by the rows. Rows with neither a date of birth nor a postal code cannot be linked and get -1 and '*'.
+
+'''
+
+import numpy as np
+import pandas as pd
+
+import namesake_classifier
+
+
+def sorted_codes(values):
+    # Integer codes in the sort order of the values, so that they do not depend on the row order
+    return pd.factorize(values, sort=True, use_na_sentinel=False)[0].astype(np.int64)
+
+
+def find_roots(parent):
+    # Root of every node, by pointer jumping until every parent is a root
+    while True:
+        grandparent = parent[parent]
+        if (grandparent == parent).all():
+            return parent
+        parent = grandparent
+
+
+def union_find(n, left, right):
+    '''
+    Disjoint set of n nodes joined by the edges (left[i], right[i]).
+    Roots are hooked under the smaller root until no edge joins two sets.
+
+    Returns the root of every node, the smallest node of its set
+    '''
+    parent = np.arange(n)
+    while len(left):
+        parent = find_roots(parent)
+        left_root, right_root = parent[left], parent[right]
+        apart = left_root != right_root
+        left, right = left[apart], right[apart]
+        low = np.minimum(left_root[apart], right_root[apart])
+        high = np.maximum(left_root[apart], right_root[apart])
+        np.minimum.at(parent, high, low)
+    return find_roots(parent)
+
+
+def block_edges(rows, keys):
+    # Edges from every row of a block to the first row of the block
+    first = pd.Series(rows).groupby(keys, sort=False).transform('first').to_numpy()
+    linked = first != rows
+    return rows[linked], first[linked]
+
+
+def resolve_codes(names, dobs, postcodes, has_dob, has_postcode):
+    '''
+    Cluster root of every row from the sorted codes of name, DOB and postal
+    code.
+
+    Keyword arguments:
+    names, dobs, postcodes -- int64 codes, see sorted_codes
+    has_dob, has_postcode -- rows with a known DOB and postal code
+    '''
+    dob_rows = np.flatnonzero(has_dob)
+    dob_keys = namesake_classifier.pair_key(names, dobs)[dob_rows]
+
+    postcode_rows = np.flatnonzero(has_postcode)
+    postcode_keys = namesake_classifier.pair_key(names, postcodes)[postcode_rows]
+    # in postal code blocks with two or more known DOBs only the rows without a DOB are linked
+    dated = has_dob[postcode_rows]
+    block_dobs = pd.DataFrame({'block': postcode_keys[dated], 'dob': dobs[postcode_rows[dated]]}).drop_duplicates()
+    crowded = block_dobs['block'].value_counts()
+    linked = ~dated | ~np.isin(postcode_keys, crowded.index[crowded.to_numpy() > 1].to_numpy())
+
+    left_dob, right_dob = block_edges(dob_rows, dob_keys)
+    left_postcode, right_postcode = block_edges(postcode_rows[linked], postcode_keys[linked])
+    return union_find(len(names), np.concatenate([left_dob, left_postcode]), np.concatenate([right_dob, right_postcode]))
+
+
+def number_clusters(roots, names, dobs, postcodes, has_dob, has_postcode):
+    '''
+    (person_id, person number within the name) of every row, ordered by
+    the (name, smallest DOB, smallest postal code) of the clusters, -1 and
+    0 for rows that cannot be linked.
+    '''
+    keyed = np.flatnonzero(has_dob | has_postcode)
+    missing = np.iinfo(np.int64).max
+    clusters = pd.DataFrame({'root': roots[keyed], 'name': names[keyed],
+                             'dob': np.where(has_dob, dobs, missing)[keyed],
+                             'postcode': np.where(has_postcode, postcodes, missing)[keyed]})
+    clusters = clusters.groupby('root', sort=False).agg(name=('name', 'first'), dob=('dob', 'min'), postcode=('postcode', 'min'))
+    clusters = clusters.sort_values(['name', 'dob', 'postcode'], kind='stable')
+    clusters['person_id'] = np.arange(len(clusters))
+    clusters['number'] = clusters.groupby('name', sort=False).cumcount() + 1
+
+    person_id = np.full(len(roots), -1, dtype=np.int64)
+    number = np.zeros(len(roots), dtype=np.int64)
+    person_id[keyed] = clusters['person_id'].reindex(roots[keyed]).to_numpy()
+    number[keyed] = clusters['number'].reindex(roots[keyed]).to_numpy()
+    return person_id, number
+
+
+def resolve_namesakes(officer_data_DF, name='name', dob='DOB', postcode='postal_code', no_dob='0-0', no_postcode='0'):
+    '''
+    Resolve the persons behind the rows of the officers table.
+
+    Keyword arguments:
+    officer_data_DF -- officers and/or PSC table
+    name, dob, postcode -- columns of the name, date of birth and postal code
+    no_dob, no_postcode -- values standing for a missing DOB and postal code,
+                           missing values (NaN) are unknown as well
+
+    Returns a DataFrame on the index of officer_data_DF with person_id and
+    person_classification
+    '''
+    has_dob = (officer_data_DF[dob].notna() & (officer_data_DF[dob] != no_dob)).to_numpy()
+    has_postcode = (officer_data_DF[postcode].notna() & (officer_data_DF[postcode] != no_postcode)).to_numpy()
+    names = sorted_codes(officer_data_DF[name])
+    dobs = sorted_codes(officer_data_DF[dob])
+    postcodes = sorted_codes(officer_data_DF[postcode])
+
+    roots = resolve_codes(names, dobs, postcodes, has_dob, has_postcode)
+    person_id, number = number_clusters(roots, names, dobs, postcodes, has_dob, has_postcode)
+    return pd.DataFrame({'person_id': person_id,
+                         'person_classification': namesake_classifier.to_classification(number, officer_data_DF.index)},
+                        index=officer_data_DF.index)
@@ -0,0 +1,211 @@
+'''
+
+Companies House Scraped Officer/ VIPs Data Collector
+
+Importable version of the collector in Investigation_Clean_Ver._Part_1.ipynb. The scraped tree (data_2/<company
+id>/company_officers.json and company_VIP.json) holds millions of small files, so it is packed once into a few JSON
+Lines shards: worker processes read and decode the files in batches and the shards are written sequentially, one line
+per file holding its company id, its kind ('officers' or 'VIP') and the document. Later runs read the shards, in
+parallel and in large sequential blocks, instead of the tree. orjson is used to decode and encode when it is
+installed, json otherwise.
+
+The rows are the ones of the notebook's merge table: name, relation, kind, company_id, start, end, postal_code, DOB
+and type, with one VIP row per nature of control.
+
+'''
+
+import os
+from multiprocessing import Pool, cpu_count
+
+import pandas as pd
+from tqdm import tqdm
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    import json
+
+    loads = json.loads
+
+    def dumps(document):
+        return json.dumps(document, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+DOCUMENTS = {'company_officers.json': 'officers', 'company_VIP.json': 'VIP'}
+MERGE_COLUMNS = ['name', 'relation', 'kind', 'company_id', 'start', 'end', 'postal_code', 'DOB', 'type']
+
+empty_DOB = {'month': 0, 'year': 0}
+empty_address = {'postal_code': '0'}
+
+
+def scan_tree(root='data_2'):
+    '''
+    (company id, kind, path) of every officers and VIP file of the tree,
+    sorted by company id. One directory listing per company instead of a
+    glob over the whole tree.
+    '''
+    files = []
+    with os.scandir(root) as companies:
+        for company in companies:
+            if not company.is_dir():
+                continue
+            with os.scandir(company.path) as entries:
+                for entry in entries:
+                    if entry.name in DOCUMENTS:
+                        files.append((company.name, DOCUMENTS[entry.name], entry.path))
+    return sorted(files)
+
+
+def read_batch(batch):
+    # Worker: the shard lines of a batch of files, as one block of bytes
+    lines = []
+    for company_id, kind, path in batch:
+        with open(path, 'rb') as f:
+            document = loads(f.read())
+        lines.append(dumps({'company_id': company_id, 'kind': kind, 'document': document}))
+    return b'\n'.join(lines) + b'\n' if lines else b''
+
+
+def pack_tree(root='data_2', output_dir='data_2_packed', num_shards=16, num_workers=None, batch_size=1000):
+    '''
+    Pack the officers and VIP files of the tree into JSON Lines shards.
+
+    Keyword arguments:
+    root -- scraped tree, one directory per company
+    output_dir -- directory of the shards, officers-<i>.jsonl
+    num_shards -- number of shard files, batches are dealt out in turn
+    num_workers -- worker processes reading the files, None for cpu_count()
+    batch_size -- number of files read per task
+
+    Returns the paths of the shards
+    '''
+    files = scan_tree(root)
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    os.makedirs(output_dir, exist_ok=True)
+    paths = [os.path.join(output_dir, 'officers-{:05d}.jsonl'.format(i)) for i in range(num_shards)]
+
+    # written under a temporary name so that a failed run leaves no partial shards behind
+    shards = [open(path + '.tmp', 'wb') for path in paths]
+    try:
+        with Pool(num_workers or cpu_count()) as pool:
+            for i, block in enumerate(tqdm(pool.imap(read_batch, batches), total=len(batches))):
+                shards[i % num_shards].write(block)
+    except BaseException:
+        for shard in shards:
+            shard.close()
+            os.remove(shard.name)
+        raise
+    for shard, path in zip(shards, paths):
+        shard.close()
+        os.replace(shard.name, path)
+    print(f'{len(files)} files of {root} packed into {num_shards} shards in {output_dir}')
+    return paths
+
+
+def shard_paths(output_dir='data_2_packed'):
+    return sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir)
+                  if name.startswith('officers-') and name.endswith('.jsonl'))
+
+
+def iter_documents(path):
+    # (company id, kind, document) of every line of a shard
+    with open(path, 'rb', buffering=2**24) as f:
+        for line in f:
+            record = loads(line)
+            yield record['company_id'], record['kind'], record['document']
+
+
+def registration_name(registration_number, pad=False):
+    # Registration number of a corporate officer or PSC as its name. The notebook only zero pads the officers' numbers
+    # (pad) to the 8 digits of a company number, the PSC ones are kept as given like in the earlier merge files
+    name = str(registration_number).upper()
+    if pad and len(name) == 7:
+        name = '0' + name
+    return name
+
+
+def date_of_birth(item):
+    # 'year-month', '0-0' when unknown
+    DOB = item.get('date_of_birth', empty_DOB)
+    return f"{DOB.get('year', 0)}-{DOB.get('month', 0)}"
+
+
+def officer_rows(company_id, document):
+    # Merge table rows of a company_officers.json document
+    rows = []
+    for i in document['items']:
+        try:
+            name = registration_name(i['identification']['registration_number'], pad=True)
+        except Exception:
+            name = i.get('name', 'no_name')
+        role = i.get('officer_role', 'no_role')
+        rows.append((name, role, role, company_id, i.get('appointed_on', 'no_appointed_date'),
+                     i.get('resigned_on', 'still_appointed'), i.get('address', empty_address).get('postal_code', '0'),
+                     date_of_birth(i), 'officer'))
+    return rows
+
+
+def vip_rows(company_id, document):
+    # Merge table rows of a company_VIP.json document, one per nature of control
+    rows = []
+    for i in document['items']:
+        try:
+            name = registration_name(i['identification']['registration_number'])
+        except Exception:
+            try:
+                name = i['name_elements']['surname'].upper() + ', ' + i['name_elements']['forename']
+            except Exception:
+                name = i.get('name', 'protected')
+        natures = i.get('natures_of_control', 'no_info')
+        if not isinstance(natures, list):
+            natures = [natures]
+        # an empty list explodes into one row without a relation
+        for nature in natures or [None]:
+            rows.append((name, nature, i.get('kind', 'no_info'), company_id, i.get('notified_on', 'no_info'),
+                         i.get('ceased_on', 'active'), i.get('address', empty_address).get('postal_code', '0'),
+                         date_of_birth(i), 'vip'))
+    return rows
+
+
+def shard_rows(path):
+    # Worker: (officer rows, VIP rows) of a shard
+    officers = []
+    vips = []
+    for company_id, kind, document in iter_documents(path):
+        if kind == 'officers':
+            officers.extend(officer_rows(company_id, document))
+        else:
+            vips.extend(vip_rows(company_id, document))
+    return officers, vips
+
+
+def load_merge(output_dir='data_2_packed', num_workers=None):
+    '''
+    The notebook's merge table (officers, then VIPs) from the packed
+    shards, one shard per task.
+    '''
+    officers = []
+    vips = []
+    with Pool(num_workers or cpu_count()) as pool:
+        for officer_part, vip_part in tqdm(pool.imap(shard_rows, shard_paths(output_dir))):
+            officers.extend(officer_part)
+            vips.extend(vip_part)
+    return pd.DataFrame(officers + vips, columns=MERGE_COLUMNS)
+
+
+# Scraped tree, its packed shards and the merge table written from them (naming convention: merge_{start month}_{end
+# month}.csv). The tree is only packed when packed_dir holds no shards yet
+tree_root = 'data_2'
+packed_dir = 'data_2_packed'
+merge_csv = 'merge_7_12.csv'
+num_workers = None
+
+if __name__ == '__main__':
+    if not os.path.isdir(packed_dir) or not shard_paths(packed_dir):
+        pack_tree(tree_root, packed_dir, num_workers=num_workers)
+    merge = load_merge(packed_dir, num_workers)
+    merge.to_csv(merge_csv, index=False)
+    print(f'{len(merge)} rows written to {merge_csv}')
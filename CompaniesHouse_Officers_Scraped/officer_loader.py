@@ -0,0 +1,270 @@
+'''
+
+Company House Officers Merge Loader
+
+Load the merge_*_monthly.csv files of the officer and PSC collector in bounded memory. The files are read in chunks
+and every column is dictionary encoded on the fly: each value gets an integer code from a vocabulary shared by all
+chunks and files, so only the codes of the rows and one copy of every distinct value are kept, instead of a Python
+string per cell. With parse_dates the start and end dates become datetime64 and the 'year-month' dates of birth int32
+year * 100 + month ('0-0' being NO_DOB); the placeholders of the dates ('no_info', 'still_appointed'...) are kept in
+small categorical start_text and end_text columns, so that merge_text gives back the values of the files exactly.
+The encoded chunks can be spilled to disk (spill_dir) and memory-mapped back.
+
+The three drop_duplicates passes of CompanyOfficers_Namesake_Fix (on name, company_id and type, then DOB, then
+postal_code, each keeping the last row) run on the integer codes without building the table first: name and
+company_id, shared by every key set, are combined into one key once, then every key set is built from it chunk by
+chunk into one int64 key per row (spilled as well), and each pass is a duplicated() over the keys of the rows left by
+the pass before, as with the DataFrame passes. Only the rows kept are then read back out of the chunks, into a
+DataFrame of categorical (and datetime and DOB) columns in file order.
+
+'''
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+DEDUPLICATE_KEYS = [['name', 'company_id', 'type'], ['name', 'company_id', 'DOB'], ['name', 'company_id', 'postal_code']]
+DATE_COLUMNS = ['start', 'end']
+DATE_FORMAT = '%Y-%m-%d'
+DOB_COLUMN = 'DOB'
+# '0-0', an unknown date of birth, and a missing (empty) one as parsed DOBs
+NO_DOB = 0
+MISSING_DOB = -1
+
+
+class Vocabulary:
+    '''
+    Integer codes of the values of one column across all chunks, -1 for
+    missing values like pandas.Categorical.
+    '''
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, values):
+        chunk_codes, uniques = pd.factorize(values)
+        lookup = np.array([self.codes.setdefault(value, len(self.codes)) for value in uniques], dtype=np.int32)
+        return np.where(chunk_codes >= 0, lookup[chunk_codes] if len(lookup) else -1, -1).astype(np.int32)
+
+    def categories(self):
+        return pd.Index(list(self.codes), dtype=object)
+
+
+class ChunkStore:
+    '''
+    Column arrays of the chunks read so far, in memory or as .npy files in
+    spill_dir (memory-mapped when read back).
+    '''
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.chunks = []
+
+    def append(self, arrays):
+        if self.spill_dir is None:
+            self.chunks.append(arrays)
+            return
+        paths = {}
+        for column, array in arrays.items():
+            paths[column] = os.path.join(self.spill_dir, '{}_{}.npy'.format(len(self.chunks), len(paths)))
+            np.save(paths[column], array)
+        self.chunks.append(paths)
+
+    def parts(self, column):
+        # The arrays of one column, chunk by chunk
+        for chunk in self.chunks:
+            yield chunk[column] if self.spill_dir is None else np.load(chunk[column], mmap_mode='r')
+
+    def column(self, column, rows=None):
+        # One column over all chunks, only the given rows (a boolean mask) if any
+        parts = list(self.parts(column))
+        if rows is None:
+            return np.concatenate(parts)
+        bounds = np.cumsum([0] + [len(part) for part in parts])
+        return np.concatenate([part[rows[start:end]] for part, start, end in zip(parts, bounds[:-1], bounds[1:])])
+
+
+def parse_dob(values, file):
+    # 'year-month' dates of birth as int32 year * 100 + month, MISSING_DOB for missing values
+    values = values.astype(object)
+    known = values.notna().to_numpy()
+    parts = values[known].str.split('-')
+    valid = parts.str.len().eq(2).to_numpy() & parts.str[0].str.isdigit().to_numpy() & parts.str[1].str.isdigit().to_numpy()
+    if not valid.all():
+        raise ValueError('{}: date of birth {!r} is not year-month'.format(file, values[known].iloc[np.flatnonzero(~valid)[0]]))
+    dob = np.full(len(values), MISSING_DOB, dtype=np.int32)
+    if known.any():
+        dob[known] = parts.str[0].astype(np.int64).to_numpy() * 100 + parts.str[1].astype(np.int64).to_numpy()
+    return dob
+
+
+def parse_date(values, vocabulary):
+    '''
+    (datetime64 dates, int32 codes of the other values) of a date column.
+    Only zero padded year-month-day values are parsed, so that they are
+    written back exactly as read; the rest (placeholders, missing values)
+    goes into the vocabulary.
+    '''
+    is_date = values.str.fullmatch(r'\d{4}-\d{2}-\d{2}').fillna(False).to_numpy(dtype=bool)
+    dates = pd.to_datetime(values.where(is_date), format=DATE_FORMAT, errors='coerce').to_numpy('datetime64[s]')
+    return dates, vocabulary.encode(values.where(np.isnat(dates)))
+
+
+def merge_text(merge):
+    '''
+    The table with the parsed start, end and DOB columns of parse_dates
+    turned back into the values of the merge files, and the start_text and
+    end_text columns folded into them.
+    '''
+    merge = merge.copy()
+    for column in DATE_COLUMNS:
+        if column + '_text' in merge:
+            text = merge.pop(column + '_text').astype(object)
+            merge[column] = merge[column].dt.strftime(DATE_FORMAT).astype(object).where(merge[column].notna(), text)
+    if DOB_COLUMN in merge and pd.api.types.is_integer_dtype(merge[DOB_COLUMN].dtype):
+        dob = merge[DOB_COLUMN].to_numpy()
+        text = pd.Series(dob // 100, index=merge.index).astype(str) + '-' + pd.Series(dob % 100, index=merge.index).astype(str)
+        merge[DOB_COLUMN] = text.astype(object).where(dob != MISSING_DOB, None)
+    return merge
+
+
+def code_range(store, column):
+    # (smallest, largest) value of an integer column over all chunks
+    low, high = 0, 0
+    for part in store.parts(column):
+        if len(part):
+            low, high = min(low, int(part.min())), max(high, int(part.max()))
+    return low, high
+
+
+def combined_key(columns):
+    # One int64 key per row for a set of code columns, re-factorised after every column so it cannot overflow
+    key = np.zeros(len(columns[0]), dtype=np.int64)
+    for codes in columns:
+        codes = codes.astype(np.int64) + 1
+        key = pd.factorize(key * (int(codes.max()) + 1 if len(codes) else 1) + codes)[0].astype(np.int64)
+    return key
+
+
+def build_keys(store, key_sets, spill_dir=None):
+    '''
+    Combined int64 key of every row for each key set, built chunk by chunk.
+    The columns the key sets all start with are combined once, over all
+    rows, and each key set adds its own column to that one chunk at a time,
+    so that only one key column is held at a time besides the keys. With
+    spill_dir the keys are memory-mapped .npy files there.
+    '''
+    shared = 0
+    while all(len(keys) > shared + 1 and keys[shared] == key_sets[0][shared] for keys in key_sets):
+        shared += 1
+    bounds = np.cumsum([0] + [len(part) for part in store.parts(key_sets[0][0])])
+    if shared:
+        base = combined_key([store.column(column) for column in key_sets[0][:shared]])
+    else:
+        base = np.zeros(bounds[-1], dtype=np.int64)
+
+    keys = []
+    for i, key_set in enumerate(key_sets):
+        if spill_dir is None:
+            key = np.empty(len(base), dtype=np.int64)
+        else:
+            key = np.lib.format.open_memmap(os.path.join(spill_dir, 'key_{}.npy'.format(i)), mode='w+',
+                                            dtype=np.int64, shape=(len(base),))
+        key[:] = base
+        for column in key_set[shared:]:
+            # non-negative codes below size, which keep the key below len(rows) * size
+            low, high = code_range(store, column)
+            size = high - low + 1
+            if len(base) and size > np.iinfo(np.int64).max // (int(key.max()) + 1):
+                raise OverflowError('Key set {} does not fit an int64 key'.format(key_set))
+            for part, start, end in zip(store.parts(column), bounds[:-1], bounds[1:]):
+                key[start:end] = key[start:end] * size + (np.asarray(part, dtype=np.int64) - low)
+        keys.append(key)
+    return keys
+
+
+def keep_last(key_sets):
+    '''
+    Rows kept by drop_duplicates(subset=..., keep='last') run once per key
+    set, each over the rows left by the one before. key_sets are combined
+    keys of all rows.
+    '''
+    keep = np.ones(len(key_sets[0]), dtype=bool)
+    for keys in key_sets:
+        rows = np.flatnonzero(keep)
+        keep[rows] = ~pd.Series(keys[rows]).duplicated(keep='last').to_numpy()
+    return keep
+
+
+def load_merge_files(files, chunksize=10**6, spill_dir=None, parse_dates=False, deduplicate_keys=DEDUPLICATE_KEYS):
+    '''
+    Load and deduplicate the monthly merge files.
+
+    Keyword arguments:
+    files -- merge_*_monthly.csv files, concatenated in this order
+    chunksize -- rows read at a time
+    spill_dir -- directory to keep the encoded chunks and the deduplication
+                 keys in until the end of the load instead of memory, a
+                 temporary directory if True
+    parse_dates -- parse start and end into datetime64 (their other values
+                   into start_text and end_text) and DOB into int32
+                   year * 100 + month instead of dictionary encoding them,
+                   see merge_text for the values of the files
+    deduplicate_keys -- key sets of the drop_duplicates passes, None to
+                        keep every row; DOB may be in them but not the
+                        parsed start and end
+
+    Returns a DataFrame of categorical (and datetime and DOB) columns.
+    The parsed dates take 8 bytes a row against the 1 to 4 of the codes,
+    they are for comparing and sorting rather than memory
+    '''
+    temporary = spill_dir is True
+    if temporary:
+        spill_dir = tempfile.mkdtemp(prefix='officer_merge_')
+    elif spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+
+    try:
+        vocabularies = {}
+        store = ChunkStore(spill_dir)
+        columns = None
+        for file in files:
+            rows = 0
+            for chunk in pd.read_csv(file, dtype=str, chunksize=chunksize):
+                if columns is None:
+                    columns = list(chunk.columns)
+                elif list(chunk.columns) != columns:
+                    raise ValueError('{} has the columns {}, expected {}'.format(file, list(chunk.columns), columns))
+                arrays = {}
+                for column in columns:
+                    if parse_dates and column in DATE_COLUMNS:
+                        arrays[column], arrays[column + '_text'] = parse_date(
+                            chunk[column], vocabularies.setdefault(column + '_text', Vocabulary()))
+                    elif parse_dates and column == DOB_COLUMN:
+                        arrays[column] = parse_dob(chunk[column], file)
+                    else:
+                        arrays[column] = vocabularies.setdefault(column, Vocabulary()).encode(chunk[column])
+                store.append(arrays)
+                rows += len(chunk)
+            print(f'{file}: {rows} rows')
+        if columns is None:
+            return pd.DataFrame()
+
+        keep = None
+        if deduplicate_keys:
+            keep = keep_last(build_keys(store, deduplicate_keys, spill_dir))
+
+        table = {}
+        for column in columns + [column + '_text' for column in DATE_COLUMNS if parse_dates and column in columns]:
+            values = store.column(column, keep)
+            if column in vocabularies:
+                values = pd.Categorical.from_codes(values, categories=vocabularies[column].categories())
+            table[column] = values
+        return pd.DataFrame(table)
+    finally:
+        if temporary:
+            shutil.rmtree(spill_dir, ignore_errors=True)